@@ -0,0 +1,166 @@
+# analytics.py
+
+from datetime import date, datetime, timedelta
+from typing import Any, Iterator, Optional, Sequence
+
+import numpy as np
+
+from database import Database
+
+KCAL_PER_GRAM = np.array([4.0, 9.0, 4.0])  # белки, жиры, углеводы
+
+
+class DailyMatrix:
+    """Дневные итоги группы пользователей за период в виде массивов.
+
+    values[k, u, d] — k-й показатель (calories, protein, fat, carbs)
+    пользователя u в день start + d; logged[u, d] — был ли в этот день
+    хоть один приём пищи. Пропущенные дни заполнены нулями.
+    """
+
+    FIELDS = ('calories', 'protein', 'fat', 'carbs')
+
+    def __init__(self, user_ids: np.ndarray, targets: np.ndarray, start: date, days: int):
+        self.user_ids = user_ids
+        self.targets = targets  # daily_calories, NaN если не задана
+        self.start = start
+        self.days = days
+        self.values = np.zeros((len(self.FIELDS), len(user_ids), days))
+        self.logged = np.zeros((len(user_ids), days), dtype=bool)
+
+    @property
+    def calories(self) -> np.ndarray:
+        return self.values[0]
+
+    def fill(self, rows: Sequence[tuple]) -> 'DailyMatrix':
+        """Раскладывает строки get_daily_totals по ячейкам одной операцией"""
+        if not rows:
+            return self
+        # один проход по строкам на уровне C, дальше — срезы столбцов
+        table = np.array(rows, dtype=object)
+        uid = table[:, 0].astype(np.int64)
+        col = (table[:, 1].astype('datetime64[D]') - np.datetime64(self.start, 'D')).astype(np.int64)
+        row = np.searchsorted(self.user_ids, uid).clip(max=len(self.user_ids) - 1)
+        keep = (self.user_ids[row] == uid) & (col >= 0) & (col < self.days)
+        row, col = row[keep], col[keep]
+        self.values[:, row, col] = table[keep, 2:6].T.astype(np.float64)
+        self.logged[row, col] = True
+        return self
+
+
+def rolling_mean(values: np.ndarray, logged: np.ndarray, window: int) -> np.ndarray:
+    """Скользящее среднее за window дней по дням с записями (NaN, если записей нет)"""
+    pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+    sums = np.pad(np.cumsum(np.where(logged, values, 0.0), axis=-1), pad)
+    counts = np.pad(np.cumsum(logged, axis=-1), pad)
+    window_sums = sums[..., window:] - sums[..., :-window]
+    window_counts = counts[..., window:] - counts[..., :-window]
+    head_sums, head_counts = sums[..., 1:window], counts[..., 1:window]
+    total = np.concatenate([head_sums, window_sums], axis=-1)
+    n = np.concatenate([head_counts, window_counts], axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def streaks(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Текущая (заканчивается последним днём) и самая длинная серия True по последней оси"""
+    runs = np.cumsum(mask, axis=-1)
+    # длина серии = накопленное число True минус значение на последнем False
+    runs = runs - np.maximum.accumulate(np.where(mask, 0, runs), axis=-1)
+    return runs[..., -1], runs.max(axis=-1, initial=0)
+
+
+def reports(matrix: DailyMatrix, window: int = 7, tolerance: float = 0.1) -> list[dict[str, Any]]:
+    """Отчёты по всем пользователям матрицы, все вычисления по осям массивов.
+
+    balance — потребление минус daily_calories по дням с записями
+    (отрицательное — дефицит); день «в норме», если отклонение не
+    больше tolerance от нормы.
+    """
+    calories, logged, targets = matrix.calories, matrix.logged, matrix.targets
+    logged_days = logged.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_calories = np.where(logged_days > 0, calories.sum(axis=1) / logged_days, np.nan)
+        balance = np.where(logged, calories - targets[:, None], 0.0)
+        total_balance = np.where(np.isnan(targets), np.nan, balance.sum(axis=1))
+        avg_balance = total_balance / logged_days
+
+        macro_kcal = matrix.values[1:].sum(axis=2).T * KCAL_PER_GRAM  # (users, 3)
+        macro_total = macro_kcal.sum(axis=1, keepdims=True)
+        ratios = np.where(macro_total > 0, macro_kcal / macro_total, np.nan)
+
+        on_target = logged & (np.abs(calories - targets[:, None]) <= tolerance * targets[:, None])
+    rolling = rolling_mean(calories, logged, window)[:, -1]
+    last_day = np.where(logged[:, -1], calories[:, -1], np.nan)
+    log_streak, log_longest = streaks(logged)
+    target_streak, target_longest = streaks(on_target)
+
+    def numbers(x: np.ndarray) -> list[Optional[float]]:
+        return [None if v != v else v for v in np.round(x, 1).tolist()]  # NaN -> None
+
+    columns = {
+        "user_id": matrix.user_ids.tolist(),
+        "logged_days": logged_days.tolist(),
+        "target": numbers(targets),
+        "avg_calories": numbers(avg_calories),
+        "last_day_calories": numbers(last_day),
+        f"rolling_{window}d": numbers(rolling),
+        "avg_balance": numbers(avg_balance),
+        "total_balance": numbers(total_balance),
+        "protein_pct": numbers(ratios[:, 0] * 100),
+        "fat_pct": numbers(ratios[:, 1] * 100),
+        "carbs_pct": numbers(ratios[:, 2] * 100),
+        "logging_streak": log_streak.tolist(),
+        "longest_logging_streak": log_longest.tolist(),
+        "target_streak": target_streak.tolist(),
+        "longest_target_streak": target_longest.tolist(),
+    }
+    period = {"start": matrix.start.isoformat(),
+              "end": (matrix.start + timedelta(days=matrix.days - 1)).isoformat()}
+    keys = list(columns)
+    return [{**period, **dict(zip(keys, values))} for values in zip(*columns.values())]
+
+
+def _period(days: int, end: Optional[str]) -> tuple[date, date]:
+    end_day = datetime.strptime(end, '%Y-%m-%d').date() if end else date.today()
+    return end_day - timedelta(days=days - 1), end_day
+
+
+def user_report(db: Database, user_id: int, days: int = 30, end: Optional[str] = None,
+                window: int = 7, tolerance: float = 0.1) -> dict[str, Any]:
+    """Отчёт одного пользователя за days дней, заканчивая end (по умолчанию сегодня)"""
+    start, end_day = _period(days, end)
+    user = db.get_user_data(user_id) or {}
+    target = user.get('daily_calories')
+    matrix = DailyMatrix(np.array([user_id], dtype=np.int64),
+                         np.array([np.nan if target is None else target]), start, days)
+    matrix.fill(db.get_daily_totals(start.isoformat(), end_day.isoformat(), user_id, user_id))
+    return reports(matrix, window, tolerance)[0]
+
+
+def reports_for_users(db: Database, users: Sequence[tuple[int, Optional[float]]], days: int = 7,
+                      end: Optional[str] = None, window: int = 7,
+                      tolerance: float = 0.1) -> list[dict[str, Any]]:
+    """Отчёты для списка (user_id, daily_calories), упорядоченного по user_id, одним запросом"""
+    if not users:
+        return []
+    start, end_day = _period(days, end)
+    user_ids = np.array([uid for uid, _ in users], dtype=np.int64)
+    goals = np.array([np.nan if goal is None else goal for _, goal in users], dtype=np.float64)
+    matrix = DailyMatrix(user_ids, goals, start, days)
+    matrix.fill(db.get_daily_totals(start.isoformat(), end_day.isoformat(),
+                                    int(user_ids[0]), int(user_ids[-1])))
+    return reports(matrix, window, tolerance)
+
+
+def batch_reports(db: Database, days: int = 7, end: Optional[str] = None, window: int = 7,
+                  tolerance: float = 0.1, chunk_users: int = 5000) -> Iterator[dict[str, Any]]:
+    """Отчёты всех зарегистрированных пользователей за один проход.
+
+    Пользователи обрабатываются пачками по chunk_users: на пачку один
+    запрос к daily_totals по диапазону user_id и одна матрица, так что
+    память ограничена chunk_users × days ячеек.
+    """
+    targets = db.get_calorie_targets()
+    for i in range(0, len(targets), chunk_users):
+        yield from reports_for_users(db, targets[i:i + chunk_users], days, end, window, tolerance)
@@ -0,0 +1,938 @@
+# bench.py
+"""Нагрузочные замеры бота.
+
+    python bench.py db --users 5000 --meals 5 [--batch --synchronous FULL]
+    python bench.py nutrition --rows 10000000 --users 10000
+    python bench.py food-index --index food_index.json [--remote]
+    python bench.py webhook --updates 20000 --users 2000
+    python bench.py shards --workers 1 2 4 --updates 20000
+    python bench.py flow --users 1000 --compare            # с закоммиченным bench_baseline.json
+    python bench.py flow --users 1000 --save-baseline      # обновить его в том же PR, что и ускорение
+    python bench.py flow --replay updates.jsonl
+    python bench.py analytics --users 10000 --days 90
+    python bench.py digests --users 5000 --rate 25 [--flaky 0.05 --crash-after 1000 --recipe]
+    python bench.py persistence --users 100000 --active 2000
+    python bench.py gateway --requests 2000 --tail 0.05 --outage
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+
+from database import Database, AsyncDatabase
+from food_index import FoodIndex, describe_per_100g
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(title: str, latencies: list[float], elapsed: float) -> None:
+    print(f"{title}: {len(latencies)} ops за {elapsed:.2f} с "
+          f"({len(latencies) / elapsed:.0f} ops/s)")
+    print(f"  p50={percentile(latencies, 0.5) * 1000:.2f} мс "
+          f"p99={percentile(latencies, 0.99) * 1000:.2f} мс "
+          f"mean={statistics.fmean(latencies) * 1000:.2f} мс")
+
+
+# ============ Хранилище: конкурентные пользователи ============
+async def _db_user(db: AsyncDatabase, user_id: int, meals: int, latencies: list[float]) -> None:
+    async def timed(coro):
+        t0 = time.perf_counter()
+        result = await coro
+        latencies.append(time.perf_counter() - t0)
+        return result
+
+    await timed(db.save_user_data({
+        "user_id": user_id, "username": f"user{user_id}", "first_name": "Bench",
+        "gender": "М", "age": 30, "height": 175, "weight": 70.0,
+        "activity_level": "1. Малоподвижный образ жизни", "bmr": 1650.0, "daily_calories": 1980.0,
+    }))
+    for i in range(meals):
+        await timed(db.save_meal(user_id, {"food_name": f"блюдо {i}", "calories": 250.0, "weight": 200.0}))
+        await timed(db.get_daily_nutrition(user_id))
+    await timed(db.get_user_data(user_id))
+    await timed(db.get_user_meals(user_id))
+
+
+async def bench_db(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = AsyncDatabase(Database(os.path.join(tmp, "bench.db"), synchronous=args.synchronous),
+                           readers=args.readers, meal_batching=args.batch, durability=args.durability)
+        latencies: list[float] = []
+        t0 = time.perf_counter()
+        await asyncio.gather(*(_db_user(db, uid, args.meals, latencies) for uid in range(1, args.users + 1)))
+        await db.flush()
+        elapsed = time.perf_counter() - t0
+        db.close()
+    report(f"db ({args.users} пользователей)", latencies, elapsed)
+    if db.meal_queue is not None:
+        print(f"  батчи: {db.meal_queue.summary()}")
+
+
+# ============ Дневная сводка на большой истории ============
+def _fill_meals(path: str, rows: int, users: int, days: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    start = datetime.now() - timedelta(days=days)
+    rnd = random.Random(42)
+    chunk = 100_000
+    for offset in range(0, rows, chunk):
+        batch = []
+        for _ in range(min(chunk, rows - offset)):
+            moment = start + timedelta(seconds=rnd.randrange(days * 86400))
+            batch.append((rnd.randint(1, users), "блюдо", 250.0, 10.0, 8.0, 30.0, 200.0,
+                          moment.strftime('%Y-%m-%d %H:%M:%S')))
+        conn.executemany("INSERT INTO meals (user_id, food_name, calories, protein, fat, carbs, weight, date) "
+                         "VALUES (?,?,?,?,?,?,?,?)", batch)
+        conn.commit()
+    conn.close()
+
+
+async def bench_nutrition(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        Database(path).close()
+        t0 = time.perf_counter()
+        _fill_meals(path, args.rows, args.users, args.days)
+        print(f"заполнено {args.rows} строк за {time.perf_counter() - t0:.1f} с")
+
+        db = Database(path)
+        t0 = time.perf_counter()
+        db.rebuild_daily_totals()
+        print(f"daily_totals пересобрана за {time.perf_counter() - t0:.1f} с")
+        rnd = random.Random(7)
+        queries = [(rnd.randint(1, args.users),
+                    (datetime.now() - timedelta(days=rnd.randrange(args.days))).strftime('%Y-%m-%d'))
+                   for _ in range(args.queries)]
+
+        # прежний запрос: LIKE по префиксу даты без индекса
+        conn = db._get_connection()
+        latencies = []
+        t0 = time.perf_counter()
+        for user_id, day in queries[:args.legacy_queries]:
+            q0 = time.perf_counter()
+            conn.execute("SELECT COALESCE(SUM(calories),0) FROM meals NOT INDEXED "
+                         "WHERE user_id=? AND date LIKE ?", (user_id, f"{day}%")).fetchone()
+            latencies.append(time.perf_counter() - q0)
+        report("LIKE, полный проход", latencies, time.perf_counter() - t0)
+
+        latencies = []
+        t0 = time.perf_counter()
+        for user_id, day in queries:
+            q0 = time.perf_counter()
+            db.get_daily_nutrition(user_id, day)
+            latencies.append(time.perf_counter() - q0)
+        report("get_daily_nutrition", latencies, time.perf_counter() - t0)
+        db.close()
+
+
+# ============ Аналитика: NumPy против цикла по строкам ============
+def report_loop(user_id: int, target: Optional[float], rows: list[tuple], start, days: int,
+                window: int = 7, tolerance: float = 0.1) -> dict:
+    """Тот же отчёт, что analytics.reports, обычным циклом по строкам"""
+    calories, logged = [0.0] * days, [False] * days
+    macros = [0.0, 0.0, 0.0]
+    for _, day, kcal, protein, fat, carbs in rows:
+        i = (datetime.strptime(day, '%Y-%m-%d').date() - start).days
+        if 0 <= i < days:
+            calories[i] = kcal
+            logged[i] = True
+            macros[0] += protein * 4
+            macros[1] += fat * 9
+            macros[2] += carbs * 4
+
+    def streak(flags):
+        current = longest = 0
+        for flag in flags:
+            current = current + 1 if flag else 0
+            longest = max(longest, current)
+        return current, longest
+
+    def number(x):
+        return None if x is None else round(float(x), 1)
+
+    logged_days = sum(logged)
+    total = sum(c for c, ok in zip(calories, logged) if ok)
+    tail = [c for c, ok in zip(calories[-window:], logged[-window:]) if ok]
+    balance = None if target is None else sum(c - target for c, ok in zip(calories, logged) if ok)
+    on_target = [ok and target is not None and abs(c - target) <= tolerance * target
+                 for c, ok in zip(calories, logged)]
+    macro_total = sum(macros)
+    log_streak, log_longest = streak(logged)
+    target_streak, target_longest = streak(on_target)
+    return {
+        "user_id": user_id,
+        "start": start.isoformat(),
+        "end": (start + timedelta(days=days - 1)).isoformat(),
+        "logged_days": logged_days,
+        "target": number(target),
+        "avg_calories": number(total / logged_days) if logged_days else None,
+        "last_day_calories": number(calories[-1]) if logged[-1] else None,
+        f"rolling_{window}d": number(sum(tail) / len(tail)) if tail else None,
+        "avg_balance": number(balance / logged_days) if balance is not None and logged_days else None,
+        "total_balance": number(balance),
+        "protein_pct": number(macros[0] / macro_total * 100) if macro_total else None,
+        "fat_pct": number(macros[1] / macro_total * 100) if macro_total else None,
+        "carbs_pct": number(macros[2] / macro_total * 100) if macro_total else None,
+        "logging_streak": log_streak,
+        "longest_logging_streak": log_longest,
+        "target_streak": target_streak,
+        "longest_target_streak": target_longest,
+    }
+
+
+async def bench_analytics(args) -> None:
+    import analytics
+
+    end = datetime.now().date()
+    start = end - timedelta(days=args.days - 1)
+    rnd = random.Random(11)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        db.save_users([{"user_id": uid, "first_name": f"user{uid}", "daily_calories": rnd.uniform(1600, 3000)}
+                       for uid in range(1, args.users + 1)])
+        rows = [
+            (uid, (start + timedelta(days=d)).isoformat(), rnd.uniform(1200, 3500),
+             rnd.uniform(40, 180), rnd.uniform(30, 120), rnd.uniform(100, 400), 3)
+            for uid in range(1, args.users + 1) for d in range(args.days)
+            if rnd.random() < args.fill
+        ]
+        with db._write() as conn:
+            conn.executemany("INSERT INTO daily_totals VALUES (?,?,?,?,?,?,?)", rows)
+        print(f"{args.users} пользователей, {len(rows)} дней с записями")
+
+        t0 = time.perf_counter()
+        vectorized = list(analytics.batch_reports(db, days=args.days, end=end.isoformat()))
+        numpy_seconds = time.perf_counter() - t0
+        print(f"NumPy, batch_reports: {numpy_seconds:.3f} с ({len(vectorized) / numpy_seconds:.0f} отчётов/с)")
+
+        # дальше только вычисления: строки и нормы уже в памяти
+        t0 = time.perf_counter()
+        all_rows = db.get_daily_totals(start.isoformat(), end.isoformat(), 1, args.users)
+        targets = db.get_calorie_targets()
+        print(f"выборка daily_totals: {time.perf_counter() - t0:.3f} с")
+
+        t0 = time.perf_counter()
+        matrix = analytics.DailyMatrix(
+            np.array([uid for uid, _ in targets], dtype=np.int64),
+            np.array([np.nan if t is None else t for _, t in targets]), start, args.days
+        ).fill(all_rows)
+        analytics.reports(matrix)
+        numpy_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        by_user: dict[int, list[tuple]] = {}
+        for row in all_rows:
+            by_user.setdefault(row[0], []).append(row)
+        looped = [report_loop(uid, target, by_user.get(uid, []), start, args.days) for uid, target in targets]
+        loop_seconds = time.perf_counter() - t0
+        print(f"вычисления: NumPy {numpy_seconds:.3f} с, цикл Python {loop_seconds:.3f} с "
+              f"(NumPy быстрее в {loop_seconds / numpy_seconds:.1f} раза)")
+
+        mismatches = sum(
+            1 for a, b in zip(vectorized, looped)
+            if any(a[k] != b[k] and not (isinstance(a[k], float) and abs(a[k] - b[k]) <= 0.11) for k in a)
+        )
+        print(f"расхождений с циклом: {mismatches}")
+        db.close()
+
+
+async def bench_digests(args) -> None:
+    from telegram import Bot
+    from digests import DigestScheduler, SendLimiter
+
+    request = _fake_bot_api_request(args.api_latency)
+    do_request = request.do_request
+    rnd = random.Random(5)
+
+    async def flaky_request(url, method, *a, **kw):
+        # часть отправок получает 502, PTB превращает его в NetworkError
+        if rnd.random() < args.flaky and "/send" in url:
+            return 502, b'{"ok": false, "error_code": 502, "description": "Bad Gateway"}'
+        return await do_request(url, method, *a, **kw)
+
+    request.do_request = flaky_request
+    logging.getLogger("digests").setLevel(logging.ERROR)
+    now = datetime.now()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        db.save_users([{"user_id": uid, "first_name": f"user{uid}", "daily_calories": 2000.0,
+                        "digest_time": "00:00", "digest_period": "daily" if uid % 7 else "weekly"}
+                       for uid in range(1, args.users + 1)])
+        with db._write() as conn:
+            conn.executemany("INSERT INTO daily_totals VALUES (?,?,?,?,?,?,?)", [
+                (uid, (now.date() - timedelta(days=d)).isoformat(), rnd.uniform(1500, 2500), 80, 70, 250, 3)
+                for uid in range(1, args.users + 1) for d in range(30) if rnd.random() < 0.7
+            ])
+
+        bot = Bot("123456:bench", request=request)
+        await bot.initialize()
+
+        async def send_recipe(bot, chat_id: int) -> None:
+            await bot.send_photo(chat_id=chat_id, photo="recipe-file-id", caption="🍴 Ваш ежедневный рецепт")
+
+        async_db = AsyncDatabase(db)
+        scheduler = DigestScheduler(async_db, bot, send_recipe=send_recipe if args.recipe else None,
+                                    limiter=SendLimiter(args.rate, per_chat_interval=0.0),
+                                    chunk_size=args.chunk_size, backoff=0.05, weekly_day=now.weekday())
+        t0 = time.perf_counter()
+        if args.crash_after:
+            # падение посреди рассылки: задача отменяется, второй прогон продолжает с того же места
+            run = asyncio.create_task(scheduler.run_once(now))
+            while request.calls["sendMessage"] < args.crash_after:
+                await asyncio.sleep(0.01)
+            run.cancel()
+            await asyncio.gather(run, return_exceptions=True)
+            print(f"прервано после {request.calls['sendMessage']} сообщений")
+            await scheduler.run_once(now)
+        else:
+            await scheduler.run_once(now)
+        elapsed = time.perf_counter() - t0
+        await bot.shutdown()
+
+        statuses = Counter(dict(db._get_connection().execute(
+            "SELECT status, COUNT(*) FROM digest_runs GROUP BY status").fetchall()))
+        sent = request.calls["sendMessage"]
+        print(f"{args.users} пользователей за {elapsed:.2f} с ({statuses['sent'] / elapsed:.1f} сводок/с "
+              f"при лимите {args.rate:.0f}/с)")
+        print(f"статусы: {dict(statuses)}, повторов {scheduler.stats['retries']}, "
+              f"вызовов sendMessage {sent} (текст сводки ушёл повторно {sent - statuses['sent']} раз)")
+        async_db.close()
+
+
+async def bench_persistence(args) -> None:
+    from persistence import SQLitePersistence
+
+    rnd = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        persistence = SQLitePersistence(path)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            coro for uid in range(1, args.users + 1) for coro in (
+                persistence.update_conversation("main", (uid, uid), rnd.randint(0, 9)),
+                persistence.update_user_data(uid, {"first_run": True}),
+            )
+        ))
+        await persistence.flush()
+        print(f"запись {args.users} диалогов и user_data одной транзакцией: {time.perf_counter() - t0:.2f} с")
+
+        # перезапуск: новый экземпляр читает всё с диска
+        for workers in (1, args.workers):
+            restored = SQLitePersistence(path, shard=(0, workers) if workers > 1 else None)
+            t0 = time.perf_counter()
+            conversations = await restored.get_conversations("main")
+            user_data = await restored.get_user_data()
+            print(f"восстановление, процессов {workers}: {len(conversations)} диалогов и "
+                  f"{len(user_data)} user_data за {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+        # один цикл update_interval: active пользователей сменили состояние, остальные без изменений
+        restored = SQLitePersistence(path)
+        await restored.get_user_data()
+        t0 = time.perf_counter()
+        for uid in range(1, args.active + 1):
+            await restored.update_conversation("main", (uid, uid), rnd.randint(0, 9))
+        for uid in range(1, args.users + 1):
+            await restored.update_user_data(uid, {"first_run": True})
+        await restored.flush()
+        print(f"цикл сохранения: {args.active} изменений за {(time.perf_counter() - t0) * 1000:.0f} мс, "
+              f"без изменений пропущено {restored.stats['skipped_unchanged']}")
+
+
+class FaultyUpstream:
+    """Заглушка внешнего API: задержки с длинным хвостом, ошибки и полный отказ (зависание)"""
+
+    def __init__(self, latency: float, tail: float, tail_latency: float, error_rate: float):
+        self.latency = latency
+        self.tail = tail
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.down = False
+        self.calls = 0
+        self._rnd = random.Random(7)
+
+    async def __call__(self) -> str:
+        import httpx
+
+        self.calls += 1
+        if self.down:
+            await asyncio.sleep(3600)
+        slow = self._rnd.random() < self.tail
+        await asyncio.sleep(self.tail_latency if slow else self.latency * self._rnd.uniform(0.5, 1.5))
+        if self._rnd.random() < self.error_rate:
+            raise httpx.ConnectError("injected failure")
+        return "ok"
+
+
+async def _drive(call, requests: int, concurrency: int) -> tuple[list[float], Counter]:
+    """requests вызовов не больше concurrency одновременно: задержки и исходы"""
+    slots = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    outcomes: Counter[str] = Counter()
+
+    async def one() -> None:
+        async with slots:
+            t0 = time.perf_counter()
+            try:
+                await call()
+                outcomes["ok"] += 1
+            except Exception as e:
+                outcomes[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies, outcomes
+
+
+async def bench_gateway(args) -> None:
+    from gateway import Upstream
+
+    def show(title: str, latencies: list[float], outcomes: Counter, stub: FaultyUpstream) -> None:
+        print(f"{title}: p50={percentile(latencies, 0.5) * 1000:.0f} мс "
+              f"p99={percentile(latencies, 0.99) * 1000:.0f} мс "
+              f"max={max(latencies) * 1000:.0f} мс, исходы {dict(outcomes)}, вызовов API {stub.calls}")
+
+    def stub() -> FaultyUpstream:
+        return FaultyUpstream(args.latency, args.tail, args.tail_latency, args.error_rate)
+
+    def gateway() -> Upstream:
+        return Upstream("bench", args.concurrency, min_timeout=0.05, max_timeout=args.max_timeout,
+                        queue_timeout=args.queue_timeout, reset_timeout=1.0)
+
+    print(f"задержка {args.latency * 1000:.0f} мс, {args.tail:.0%} запросов по {args.tail_latency:.1f} с, "
+          f"ошибок {args.error_rate:.0%}, таймаут без шлюза {args.max_timeout:.0f} с")
+
+    raw = stub()
+    show("без шлюза", *await _drive(lambda: asyncio.wait_for(raw(), args.max_timeout),
+                                    args.requests, args.concurrency), raw)
+    for hedge in (False, True):
+        api, upstream = stub(), gateway()
+        show(f"шлюз{', хеджирование' if hedge else ''}",
+             *await _drive(lambda: upstream.call("search", api, hedge=hedge), args.requests, args.concurrency), api)
+
+    if args.outage:
+        # сервис перестаёт отвечать: без шлюза каждый ждёт полный таймаут
+        requests = args.concurrency * 4
+        raw, api, upstream = stub(), stub(), gateway()
+        raw.down = api.down = True
+        for _ in range(50):
+            await upstream.call("search", FaultyUpstream(args.latency, 0, 0, 0))  # прогрев таймаута
+        t0 = time.perf_counter()
+        latencies, outcomes = await _drive(lambda: asyncio.wait_for(raw(), args.max_timeout),
+                                           requests, args.concurrency)
+        show(f"отказ, без шлюза ({time.perf_counter() - t0:.1f} с)", latencies, outcomes, raw)
+        t0 = time.perf_counter()
+        latencies, outcomes = await _drive(lambda: upstream.call("search", api), requests, args.concurrency)
+        show(f"отказ, шлюз ({time.perf_counter() - t0:.1f} с)", latencies, outcomes, api)
+        print(f"автомат: {upstream.breaker.state}, размыканий {upstream.breaker.trips}")
+
+
+# ============ Локальный индекс продуктов против FatSecret ============
+def _synthetic_index(size: int) -> FoodIndex:
+    rnd = random.Random(3)
+    syllables = ["гре", "ку", "ри", "ца", "тво", "рог", "ов", "ся", "ба", "нан", "сыр", "мо",
+                 "chi", "ck", "en", "ri", "ce", "ap", "ple", "sal", "mon", "pa", "sta", "yo"]
+    kinds = ["отварной", "жареный", "запечённый", "boiled", "grilled", "raw", "домашний", "light"]
+
+    def word() -> str:
+        return "".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4)))
+
+    foods = [{"food_name": f"{word()} {word()} {rnd.choice(kinds)}",
+              "food_description": describe_per_100g(rnd.uniform(20, 600), 10, 5, 20)}
+             for _ in range(size)]
+    foods += [{"food_name": name, "food_description": describe_per_100g(120, 10, 5, 20)}
+              for name in ("гречка отварная", "куриная грудка", "chicken breast", "творог 5%", "яблоко")]
+    return FoodIndex.build(foods)
+
+
+async def bench_food_index(args) -> None:
+    if args.index:
+        index = FoodIndex.load(args.index)
+    else:
+        index = _synthetic_index(args.size)
+    queries = ["гречка", "куриная гр", "chiken", "творог", "яблако", "гречка отварная"]
+    latencies = []
+    t0 = time.perf_counter()
+    for i in range(args.queries):
+        q0 = time.perf_counter()
+        index.search(queries[i % len(queries)], k=5)
+        latencies.append(time.perf_counter() - q0)
+    report(f"локальный индекс ({len(index)} продуктов)", latencies, time.perf_counter() - t0)
+
+    if args.remote:
+        from bot import FatSecretAPI, FATSECRET_CLIENT_ID, FATSECRET_CLIENT_SECRET
+        from http_client import HttpTransport
+
+        http = HttpTransport()
+        api = FatSecretAPI(FATSECRET_CLIENT_ID, FATSECRET_CLIENT_SECRET, http)
+        latencies = []
+        t0 = time.perf_counter()
+        for query in queries:
+            q0 = time.perf_counter()
+            await api.search_food(query)
+            latencies.append(time.perf_counter() - q0)
+        report("FatSecret foods.search", latencies, time.perf_counter() - t0)
+        await http.aclose()
+
+
+# ============ Bot API без сети ============
+def _fake_bot_api_request(latency: float):
+    """BaseRequest, который отвечает на вызовы Bot API локально"""
+    from telegram.request import BaseRequest
+
+    class FakeTelegramRequest(BaseRequest):
+        def __init__(self):
+            self.calls: Counter[str] = Counter()
+            self._message_id = 0
+
+        @property
+        def read_timeout(self):
+            return 5.0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, params: dict) -> dict:
+            self._message_id += 1
+            message = {"message_id": self._message_id, "date": int(time.time()),
+                       "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+            if "text" in params:
+                message["text"] = params["text"]
+            if "photo" in params:
+                message["photo"] = [{"file_id": f"photo-{self._message_id}",
+                                     "file_unique_id": f"u{self._message_id}", "width": 1, "height": 1}]
+            return message
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            name = url.rsplit("/", 1)[-1]
+            self.calls[name] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            params = request_data.parameters if request_data else {}
+            if name == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif name.startswith(("send", "edit")):
+                result = self._message(params)
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeTelegramRequest()
+
+
+def synthetic_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def _isolated_bot_env(tmp: str) -> None:
+    """Бот из бенчмарка пишет только во временную папку"""
+    os.environ["DB_NAME"] = os.path.join(tmp, "bench.db")
+    os.environ["FOOD_INDEX_PATH"] = os.path.join(tmp, "missing_index.json")
+    os.environ["SESSION_PERSIST"] = "0"
+
+
+# ============ Webhook под нагрузкой ============
+async def bench_webhook(args) -> None:
+    import httpx
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _isolated_bot_env(tmp)
+        import bot
+
+        controller = bot.BotController()
+        request = _fake_bot_api_request(args.api_latency)
+        app = controller.build_application(token="123456:BENCH", request=request)
+        secret = "bench-secret"
+        await app.initialize()
+        await controller.startup(app)
+        await app.updater.start_webhook(listen="127.0.0.1", port=args.port, url_path="telegram",
+                                        secret_token=secret)
+        await app.start()
+
+        url = f"http://127.0.0.1:{args.port}/telegram"
+        texts = ["/start", "Ежедневный рецепт", "Профиль", "что-то ещё"]
+        latencies: list[float] = []
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def post(client, update_id: int):
+            user_id = 1 + update_id % args.users
+            body = synthetic_update(update_id, user_id, texts[update_id // args.users % len(texts)])
+            async with limit:
+                t0 = time.perf_counter()
+                resp = await client.post(url, json=body, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                latencies.append(time.perf_counter() - t0)
+                resp.raise_for_status()
+
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            # без секрета сервер должен отказать
+            rejected = await client.post(url, json=synthetic_update(0, 1, "/start"))
+            print(f"запрос без секрета: HTTP {rejected.status_code}")
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(post(client, i) for i in range(1, args.updates + 1)))
+            await app.update_queue.join()
+            elapsed = time.perf_counter() - t0
+
+        report("webhook: ответ HTTP", latencies, elapsed)
+        processor = app.update_processor
+        print(f"обработчики: {processor.processed} ok, {processor.failed} ошибок, "
+              f"{processor.latency_percentiles()}")
+        print(f"вызовы Bot API: {dict(request.calls)}")
+
+        await app.updater.stop()
+        await app.stop()
+        await controller.shutdown(app)
+        await app.shutdown()
+
+
+# ============ Масштабирование по процессам ============
+async def bench_shards(args) -> None:
+    from functools import partial
+    from telegram import Update
+    from sharding import ShardedBot
+
+    texts = ["/start", "Ежедневный рецепт", "Профиль", "что-то ещё"]
+    updates = [
+        Update.de_json(synthetic_update(i, 1 + i % args.users, texts[i // args.users % len(texts)]), None)
+        for i in range(1, args.updates + 1)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        _isolated_bot_env(tmp)
+        Database(os.environ["DB_NAME"]).close()
+        baseline = None
+        for workers in args.workers:
+            sharded = ShardedBot("123456:BENCH", workers, inbox_size=args.inbox,
+                                 request_factory=partial(_fake_bot_api_request, args.api_latency))
+            sharded.start()
+            await sharded.wait_ready()
+
+            t0 = time.perf_counter()
+            for update in updates:
+                await sharded.dispatch(update)
+            stats = await sharded.drain()
+            elapsed = time.perf_counter() - t0
+
+            processed = sum(s["processed"] for s in stats.values())
+            failed = sum(s["failed"] for s in stats.values())
+            rate = processed / elapsed
+            baseline = baseline or rate
+            p99 = max((s["p99_ms"] for s in stats.values()), default=0.0)
+            print(f"{workers} проц.: {processed} обновлений за {elapsed:.2f} с "
+                  f"({rate:.0f}/с, x{rate / baseline:.2f}), ошибок {failed}, "
+                  f"p99 обработчика {p99:.1f} мс, по процессам {sharded.dispatched}")
+
+
+# ============ Сценарии диалога ============
+FOOD_DESCRIPTION = "Per 100g - Calories: 120kcal | Fat: 3.00g | Carbs: 15.00g | Protein: 8.00g"
+DISHES = ["гречка", "куриная грудка", "овсянка", "творог", "борщ", "банан", "омлет", "рис"]
+QUESTIONS = ["сколько калорий в банане", "сколько белка в твороге", "чем заменить сахар",
+             "сколько калорий в 100 г гречки", "что съесть после тренировки"]
+
+
+class FakeFatSecret:
+    """FatSecretAPI без сети: ответ того же вида через latency секунд"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.token_stats: dict = {}
+
+    async def search_food(self, query: str) -> dict:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        food = {"food_id": str(self.calls), "food_name": query.title(), "food_description": FOOD_DESCRIPTION}
+        # как и FatSecret: единственное совпадение приходит объектом, а не списком
+        return {"foods": {"food": food if " " not in query.strip() else [food]}}
+
+    def close(self) -> None:
+        pass
+
+
+class FakeYandexGPT:
+    """YandexGPTAPI без сети: ответ приходит chunks частями за latency секунд"""
+
+    ERROR_TEXT = "Извините, произошла ошибка при обработке вашего запроса."
+
+    def __init__(self, latency: float, chunks: int = 5):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+        self.stream_stats: dict = {}
+
+    def _answer(self, message: str) -> str:
+        return f"Ответ на «{message}»: примерно 100 ккал на порцию."
+
+    async def complete(self, message: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._answer(message)
+
+    async def get_response(self, message: str) -> str:
+        return await self.complete(message)
+
+    async def stream_response(self, message: str):
+        self.calls += 1
+        answer = self._answer(message)
+        step = max(1, len(answer) // self.chunks)
+        for end in range(step, len(answer) + step, step):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield answer[:end]
+
+
+def user_script(user_id: int) -> list[str]:
+    """Регистрация, профиль, блюдо, блюдо из нескольких ингредиентов, рецепт дня и чат с AI одного пользователя"""
+    rnd = random.Random(user_id)
+    return [
+        "/start", "Регистрация", rnd.choice("МЖ"), str(rnd.randint(18, 70)),
+        str(rnd.randint(150, 200)), f"{rnd.uniform(45, 120):.1f}", str(rnd.randint(1, 6)),
+        "Профиль",
+        "Подсчёт ккал блюда", rnd.choice(DISHES), str(rnd.randint(50, 400)),
+        "Подсчёт ккал блюда", ", ".join(f"{rnd.randint(10, 300)} г {dish}" for dish in rnd.sample(DISHES, 3)),
+        "Ежедневный рецепт",
+        "AI подсчёт ккал", rnd.choice(QUESTIONS), "/cancel",
+    ]
+
+
+def synthetic_flow(users: int) -> list[dict]:
+    """Сценарии всех пользователей вперемешку: шаг 1 у всех, затем шаг 2..."""
+    scripts = [user_script(user_id) for user_id in range(1, users + 1)]
+    updates, update_id = [], 0
+    for step in range(max(map(len, scripts))):
+        for user_id, script in enumerate(scripts, start=1):
+            if step < len(script):
+                update_id += 1
+                updates.append(synthetic_update(update_id, user_id, script[step]))
+    return updates
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+async def run_flow(bot, updates: list[dict], args) -> dict:
+    from telegram import Update
+    from metrics import REGISTRY
+
+    REGISTRY.reset()
+    controller = bot.BotController()
+    controller.fatsecret_api.close()
+    controller.fatsecret_api = FakeFatSecret(args.fatsecret_latency)
+    controller.yandex_gpt = FakeYandexGPT(args.ai_latency)
+    app = controller.build_application(token="123456:BENCH",
+                                       request=_fake_bot_api_request(args.api_latency))
+    await app.initialize()
+    await controller.startup(app)
+    await app.start()
+
+    t0 = time.perf_counter()
+    for data in updates:
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    await app.update_queue.join()
+    elapsed = time.perf_counter() - t0
+
+    processor = app.update_processor
+    result = {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "throughput": len(updates) / elapsed,
+        "failed": processor.failed,
+        **processor.latency_percentiles(),
+        "handlers": {name: {"count": hist.count,
+                            "p50_ms": hist.percentile(0.5) * 1000,
+                            "p99_ms": hist.percentile(0.99) * 1000}
+                     for (kind, name), hist in sorted(REGISTRY.histograms.items()) if kind == "handler"},
+    }
+    await app.stop()
+    await controller.shutdown(app)
+    await app.shutdown()
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+# baseline хранится в репозитории: PR сравнивается с ним без отдельного прогона main
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def compare_flow(baseline: dict, results: dict, tolerance: float) -> list[str]:
+    """Регрессии относительно baseline: пропускная способность, p99 и память"""
+    problems = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            problems.append(f"{name}: throughput {current['throughput']:.0f}/с < {base['throughput']:.0f}/с")
+        if current["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p99 {current['p99_ms']:.1f} мс > {base['p99_ms']:.1f} мс")
+        if current["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            problems.append(f"{name}: RSS {current['peak_rss_mb']:.0f} МБ > {base['peak_rss_mb']:.0f} МБ")
+    return problems
+
+
+async def bench_flow(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        _isolated_bot_env(tmp)
+        import bot
+        logging.getLogger().setLevel(logging.WARNING)
+
+        if args.replay:
+            with open(args.replay, encoding="utf-8") as f:
+                runs = {f"replay:{os.path.basename(args.replay)}": [json.loads(line) for line in f if line.strip()]}
+        else:
+            runs = {f"users:{users}": synthetic_flow(users) for users in sorted(args.users)}
+
+        results = {}
+        for name, updates in runs.items():
+            # у каждого прогона своя база
+            bot.DB_NAME = os.path.join(tmp, f"{name.replace(':', '_')}.db")
+            result = results[name] = await run_flow(bot, updates, args)
+            print(f"{name}: {result['updates']} обновлений за {result['seconds']:.2f} с "
+                  f"({result['throughput']:.0f}/с), p50={result['p50_ms']:.1f} мс "
+                  f"p99={result['p99_ms']:.1f} мс, ошибок {result['failed']}, "
+                  f"пик RSS {result['peak_rss_mb']:.0f} МБ")
+            for handler, h in result["handlers"].items():
+                print(f"  {handler}: n={h['count']} p50={h['p50_ms']:.1f} мс p99={h['p99_ms']:.1f} мс")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"baseline сохранён в {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            problems = compare_flow(json.load(f), results, args.tolerance)
+        for problem in problems:
+            print(f"РЕГРЕССИЯ {problem}")
+        if problems:
+            raise SystemExit(1)
+        print(f"регрессий нет (допуск {args.tolerance:.0%})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("db", help="конкурентные пользователи против файловой БД")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--meals", type=int, default=5)
+    p.add_argument("--readers", type=int, default=4)
+    p.add_argument("--batch", action="store_true", help="групповая запись save_meal")
+    p.add_argument("--durability", choices=("commit", "buffered"), default="commit")
+    p.add_argument("--synchronous", default="NORMAL")
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("nutrition", help="дневная сводка на большой таблице meals")
+    p.add_argument("--rows", type=int, default=10_000_000)
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--queries", type=int, default=10_000)
+    p.add_argument("--legacy-queries", type=int, default=20)
+    p.set_defaults(func=bench_nutrition)
+
+    p = sub.add_parser("food-index", help="задержка поиска в локальном индексе")
+    p.add_argument("--index", help="готовый индекс; по умолчанию синтетический")
+    p.add_argument("--size", type=int, default=20_000)
+    p.add_argument("--queries", type=int, default=5_000)
+    p.add_argument("--remote", action="store_true", help="сравнить с FatSecret (нужны ключи в .env)")
+    p.set_defaults(func=bench_food_index)
+
+    p = sub.add_parser("webhook", help="синтетические обновления в локальный webhook")
+    p.add_argument("--updates", type=int, default=20_000)
+    p.add_argument("--users", type=int, default=2_000)
+    p.add_argument("--concurrency", type=int, default=100, help="одновременных HTTP-запросов")
+    p.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    p.add_argument("--port", type=int, default=8765)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("shards", help="пропускная способность при разном числе процессов")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--updates", type=int, default=20_000)
+    p.add_argument("--users", type=int, default=2_000)
+    p.add_argument("--inbox", type=int, default=1024, help="очередь процесса-обработчика")
+    p.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("flow", help="сценарии диалога с поддельными FatSecret и YandexGPT")
+    p.add_argument("--users", type=int, nargs="+", default=[1_000])
+    p.add_argument("--replay", help="JSONL с обновлениями Telegram вместо синтетических сценариев")
+    p.add_argument("--api-latency", type=float, default=0.0, help="задержка Bot API, с")
+    p.add_argument("--fatsecret-latency", type=float, default=0.2)
+    p.add_argument("--ai-latency", type=float, default=1.0)
+    p.add_argument("--save-baseline", nargs="?", const=BASELINE, metavar="PATH",
+                   help=f"сохранить результаты в JSON (по умолчанию {BASELINE})")
+    p.add_argument("--compare", nargs="?", const=BASELINE, metavar="PATH",
+                   help=f"сравнить с сохранённым baseline (по умолчанию {BASELINE}), код 1 при регрессии")
+    p.add_argument("--tolerance", type=float, default=0.10)
+    p.set_defaults(func=bench_flow)
+
+    p = sub.add_parser("analytics", help="отчёты по daily_totals: NumPy против цикла")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--days", type=int, default=90)
+    p.add_argument("--fill", type=float, default=0.7, help="доля дней с записями")
+    p.set_defaults(func=bench_analytics)
+
+    p = sub.add_parser("digests", help="рассылка сводок через поддельный Bot API")
+    p.add_argument("--users", type=int, default=2_000)
+    p.add_argument("--rate", type=float, default=25.0, help="сообщений в секунду")
+    p.add_argument("--chunk-size", type=int, default=200)
+    p.add_argument("--api-latency", type=float, default=0.05, help="задержка Bot API, с")
+    p.add_argument("--flaky", type=float, default=0.0, help="доля отправок с ошибкой 502")
+    p.add_argument("--crash-after", type=int, default=0, help="прервать рассылку после N сообщений")
+    p.add_argument("--recipe", action="store_true", help="к сводке ещё и картинка рецепта (sendPhoto)")
+    p.set_defaults(func=bench_digests)
+
+    p = sub.add_parser("persistence", help="запись и восстановление состояний диалогов")
+    p.add_argument("--users", type=int, default=100_000)
+    p.add_argument("--active", type=int, default=2_000, help="сменивших состояние за цикл")
+    p.add_argument("--workers", type=int, default=4, help="восстановление одного из процессов")
+    p.set_defaults(func=bench_persistence)
+
+    p = sub.add_parser("gateway", help="шлюз к внешним API против заглушки с внесёнными сбоями")
+    p.add_argument("--requests", type=int, default=2_000)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.add_argument("--latency", type=float, default=0.05, help="обычная задержка, с")
+    p.add_argument("--tail", type=float, default=0.05, help="доля медленных ответов")
+    p.add_argument("--tail-latency", type=float, default=1.0, help="задержка медленного ответа, с")
+    p.add_argument("--error-rate", type=float, default=0.0, help="доля ошибок соединения")
+    p.add_argument("--max-timeout", type=float, default=3.0, help="прежний фиксированный таймаут, с")
+    p.add_argument("--queue-timeout", type=float, default=1.0, help="ожидание свободного слота шлюза, с")
+    p.add_argument("--outage", action="store_true", help="ещё и полный отказ сервиса")
+    p.set_defaults(func=bench_gateway)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
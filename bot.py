@@ -1,14 +1,33 @@
 import os
+import asyncio
+import secrets
+import tempfile
+import json
 import logging
-from database import Database
+import math
+import time
+from database import Database, AsyncDatabase
+from http_client import HttpTransport
+from cache import ResponseCache, TieredCache, normalize_query
+from food_index import FoodIndex
+from nutrition import Macros, attach_macros, food_macros, search_results, ingredient_macros, parse_ingredients
+from recipes import RecipeCatalog
+from sessions import SessionStore, UserSession
+from update_processor import BackpressureQueue, PerUserUpdateProcessor
+from sharding import run_sharded
+from metrics import REGISTRY, SamplingProfiler, serve_metrics
+from export import available_formats, export_table
+from analytics import user_report
+from digests import DigestScheduler, SendLimiter
+from persistence import SQLitePersistence
+from gateway import Upstream, UpstreamUnavailable
 from datetime import datetime
-import requests
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
-import random
-from PIL import Image
 from telegram import (
-    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+    Update, Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     ContextTypes, filters, ConversationHandler
@@ -29,6 +48,65 @@ FATSECRET_CLIENT_SECRET = os.getenv("FATSECRET_CLIENT_SECRET")
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")  # Ключ для Yandex Cloud API
 YANDEX_FOLDER_ID = os.getenv("YANDEX_FOLDER_ID")  # ID каталога в Yandex Cloud
 IMAGE_RECIPES_DIR = os.getenv("IMAGE_RECIPES_DIR", "image_recipes")
+RECIPE_REFRESH_INTERVAL = float(os.getenv("RECIPE_REFRESH_INTERVAL", 60))  # секунды
+# Сессии: вытеснение после SESSION_IDLE_TTL секунд простоя или сверх бюджета памяти
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", 3600))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+# Состояния диалогов и user_data в SQLite: сохраняются раз в PERSISTENCE_INTERVAL секунд
+PERSISTENCE_ENABLED = os.getenv("PERSISTENCE_ENABLED", "1") == "1"
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 5))
+# ответы регистрации живут в сессиях: без них восстановленный диалог не продолжить
+SESSION_PERSIST = os.getenv("SESSION_PERSIST", "1" if PERSISTENCE_ENABLED else "0") == "1"
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com/telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Не больше MAX_CONCURRENT_UPDATES обработчиков одновременно и MAX_PENDING_UPDATES в очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", 256))
+# BOT_WORKERS > 1: процессы-обработчики, пользователи распределяются по user_id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+SHARD_DRAIN_TIMEOUT = float(os.getenv("SHARD_DRAIN_TIMEOUT", 30))  # секунды
+# Метрики: METRICS_PORT=0 отключает HTTP-эндпоинт, /stats доступна пользователям из ADMIN_IDS
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Сводки по расписанию: DIGEST_RATE — сообщений в секунду на все процессы (лимит Telegram ~30)
+DIGESTS_ENABLED = os.getenv("DIGESTS_ENABLED", "1") == "1"
+DIGEST_RATE = float(os.getenv("DIGEST_RATE", 25))
+DIGEST_WEEKDAY = int(os.getenv("DIGEST_WEEKDAY", 6))  # 0 — понедельник, 6 — воскресенье
+DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", 60))  # секунды
+DB_NAME = os.getenv("DB_NAME", "fitness_bot.db")
+FOOD_CACHE_TTL = float(os.getenv("FOOD_CACHE_TTL", 24 * 3600))  # секунды
+# сколько ещё хранить просроченные ответы FatSecret на случай его недоступности
+FOOD_CACHE_STALE_GRACE = float(os.getenv("FOOD_CACHE_STALE_GRACE", 7 * 24 * 3600))
+FOOD_INDEX_PATH = os.getenv("FOOD_INDEX_PATH", "food_index.json")
+LOCAL_MATCH_SCORE = float(os.getenv("LOCAL_MATCH_SCORE", 0.5))  # ниже — идём в FatSecret
+# FatSecret недоступен: локальное совпадение слабее этого не выдаём за ответ
+LOCAL_FALLBACK_SCORE = float(os.getenv("LOCAL_FALLBACK_SCORE", 0.3))
+MAX_INGREDIENTS = int(os.getenv("MAX_INGREDIENTS", 20))  # ингредиентов в одном рецепте
+# Групповая запись приёмов пищи: MEAL_BATCHING=1, DB_DURABILITY=commit|buffered
+MEAL_BATCHING = os.getenv("MEAL_BATCHING", "0") == "1"
+DB_DURABILITY = os.getenv("DB_DURABILITY", "commit")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+# Потоковые ответы AI: сообщение редактируется не чаще раза в AI_EDIT_INTERVAL секунд
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+AI_EDIT_INTERVAL = float(os.getenv("AI_EDIT_INTERVAL", 1.0))
+# Кэш ответов AI: AI_CACHE_SIMILARITY=0 отключает поиск похожих вопросов
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", 7 * 24 * 3600))
+AI_CACHE_SIMILARITY = float(os.getenv("AI_CACHE_SIMILARITY", 0.95))
+AI_COST_PER_CALL = float(os.getenv("AI_COST_PER_CALL", 0.4))  # ₽ за запрос, для отчёта об экономии
+# Когда AI недоступен, отвечаем из кэша по более слабому совпадению
+AI_DEGRADED_SIMILARITY = float(os.getenv("AI_DEGRADED_SIMILARITY", 0.6))
+# Шлюз к внешним API: одновременных запросов на сервис и размыкание после UPSTREAM_FAILURES ошибок подряд
+FATSECRET_CONCURRENCY = int(os.getenv("FATSECRET_CONCURRENCY", 10))
+YANDEX_CONCURRENCY = int(os.getenv("YANDEX_CONCURRENCY", 10))
+UPSTREAM_FAILURES = int(os.getenv("UPSTREAM_FAILURES", 5))
+UPSTREAM_RESET_TIMEOUT = float(os.getenv("UPSTREAM_RESET_TIMEOUT", 30))  # секунды до пробного запроса
 
 # ============ Константы для состояний ============
 GENDER, AGE, HEIGHT, WEIGHT, ACTIVITY_LEVEL = range(5)
@@ -48,60 +126,131 @@ ACTIVITY_FACTORS = {lvl: factor for lvl, factor in zip(ACTIVITY_LEVELS, [1.2, 1.
 # ============ Класс для работы с YandexGPT API ============
 class YandexGPTAPI:
     API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    TIMEOUT = HttpTransport.timeout(connect=5.0, read=30.0)
+    ERROR_TEXT = "Извините, произошла ошибка при обработке вашего запроса."
 
-    def __init__(self, api_key: str, folder_id: str):
+    def __init__(self, api_key: str, folder_id: str, http: HttpTransport):
         self.api_key = api_key
         self.folder_id = folder_id
+        self.http = http
+        self.stream_stats = {
+            "streams": 0,
+            "ttft_ms_last": 0.0,
+            "ttft_ms_total": 0.0,
+            "ttft_ms_max": 0.0,
+        }
+
+    def _request(self, message: str, stream: bool) -> tuple[dict, dict]:
+        headers = {
+            "Authorization": f"Api-Key {self.api_key}",
+            "Content-Type": "application/json",
+        }
+
+        data = {
+            "modelUri": f"gpt://{self.folder_id}/yandexgpt-lite",
+            "completionOptions": {
+                "stream": stream,
+                "temperature": 0.7,
+                "maxTokens": 2000
+            },
+            "messages": [
+                {
+                    "role": "system",
+                    "text": "Ты - полезный ассистент в телеграм-боте."
+                },
+                {
+                    "role": "user",
+                    "text": message
+                }
+            ]
+        }
+        return headers, data
+
+    @REGISTRY.instrument("upstream", "yandexgpt.complete")
+    async def complete(self, message: str) -> str:
+        """Полный ответ YandexGPT; ошибки пробрасываются вызывающему"""
+        headers, data = self._request(message, stream=False)
+        response = await self.http.post(self.API_URL, headers=headers, json=data, timeout=self.TIMEOUT)
+        response.raise_for_status()
+
+        result = response.json()
+        return result['result']['alternatives'][0]['message']['text']
 
     async def get_response(self, message: str) -> str:
         """Получение ответа от YandexGPT API"""
         try:
-            headers = {
-                "Authorization": f"Api-Key {self.api_key}",
-                "Content-Type": "application/json",
-            }
-
-            data = {
-                "modelUri": f"gpt://{self.folder_id}/yandexgpt-lite",
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": 0.7,
-                    "maxTokens": 2000
-                },
-                "messages": [
-                    {
-                        "role": "system",
-                        "text": "Ты - полезный ассистент в телеграм-боте."
-                    },
-                    {
-                        "role": "user",
-                        "text": message
-                    }
-                ]
-            }
-
-            response = requests.post(self.API_URL, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-
-            result = response.json()
-            return result['result']['alternatives'][0]['message']['text']
-
+            return await self.complete(message)
         except Exception as e:
             logger.error(f"YandexGPT API error: {e}")
-            return "Извините, произошла ошибка при обработке вашего запроса."
+            return self.ERROR_TEXT
+
+    async def stream_response(self, message: str) -> AsyncIterator[str]:
+        """Потоковый ответ: каждая строка ответа API содержит весь текст на текущий момент"""
+        headers, data = self._request(message, stream=True)
+        started = time.perf_counter()
+        first = True
+        with REGISTRY.track("upstream", "yandexgpt.stream"):
+            async with self.http.stream("POST", self.API_URL, headers=headers, json=data,
+                                        timeout=self.TIMEOUT) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    text = chunk['result']['alternatives'][0]['message']['text']
+                    if first:
+                        self._record_ttft((time.perf_counter() - started) * 1000)
+                        first = False
+                    yield text
+
+    def _record_ttft(self, ttft_ms: float):
+        self.stream_stats["streams"] += 1
+        self.stream_stats["ttft_ms_last"] = ttft_ms
+        self.stream_stats["ttft_ms_total"] += ttft_ms
+        self.stream_stats["ttft_ms_max"] = max(self.stream_stats["ttft_ms_max"], ttft_ms)
 
 
 # ============ Класс для работы с FatSecret API ============
 class FatSecretAPI:
     TOKEN_URL = "https://oauth.fatsecret.com/connect/token"
     BASE_URL = "https://platform.fatsecret.com/rest/server.api"
+    TIMEOUT = HttpTransport.timeout(connect=5.0, read=10.0)
+    REFRESH_MARGIN = 300  # обновляем токен за 5 минут до истечения
+    REFRESH_RETRY_DELAY = 30
 
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str, http: HttpTransport):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.http = http
         self._token: str = ""
+        self._expires_at: float = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._background_refresh: Optional[asyncio.Task] = None
+        self.token_stats = {
+            "refreshes": 0,
+            "failures": 0,
+            "retries_after_401": 0,
+            "last_refresh_ms": 0.0,
+            "max_refresh_ms": 0.0,
+        }
+
+    async def _get_token(self) -> str:
+        if not self._token or time.monotonic() >= self._expires_at:
+            await self._refresh_token()
+        return self._token
+
+    async def _refresh_token(self):
+        """Одновременные обновления сливаются в один запрос к OAuth"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._fetch_token())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        await asyncio.shield(self._refresh_task)
+
+    def _refresh_done(self, task: asyncio.Task):
+        self._refresh_task = None
 
-    def _refresh_token(self):
+    @REGISTRY.instrument("upstream", "fatsecret.token")
+    async def _fetch_token(self):
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = {
             "grant_type": "client_credentials",
@@ -109,27 +258,66 @@ class FatSecretAPI:
             "client_id": self.client_id,
             "client_secret": self.client_secret
         }
-        resp = requests.post(self.TOKEN_URL, headers=headers, data=data)
-        resp.raise_for_status()
-        payload = resp.json()
-        if "access_token" not in payload:
-            logger.error("FatSecret: no access_token in response %s", payload)
-            raise RuntimeError("FatSecret token error")
+        started = time.perf_counter()
+        try:
+            resp = await self.http.post(self.TOKEN_URL, headers=headers, data=data, timeout=self.TIMEOUT)
+            resp.raise_for_status()
+            payload = resp.json()
+            if "access_token" not in payload:
+                logger.error("FatSecret: no access_token in response %s", payload)
+                raise RuntimeError("FatSecret token error")
+        except Exception:
+            self.token_stats["failures"] += 1
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.token_stats["last_refresh_ms"] = elapsed
+            self.token_stats["max_refresh_ms"] = max(self.token_stats["max_refresh_ms"], elapsed)
+
+        expires_in = float(payload.get("expires_in", 86400))
         self._token = payload["access_token"]
+        self._expires_at = time.monotonic() + expires_in
+        self.token_stats["refreshes"] += 1
+        self._schedule_refresh(max(expires_in - self.REFRESH_MARGIN, expires_in / 2))
 
-    def search_food(self, query: str) -> dict:
-        if not self._token:
-            self._refresh_token()
+    def _schedule_refresh(self, delay: float):
+        if self._background_refresh is not None and self._background_refresh is not asyncio.current_task():
+            self._background_refresh.cancel()
+        self._background_refresh = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await self._refresh_token()
+        except Exception as e:
+            logger.error(f"FatSecret background token refresh failed: {e}")
+            if time.monotonic() < self._expires_at:
+                self._schedule_refresh(self.REFRESH_RETRY_DELAY)
+
+    @REGISTRY.instrument("upstream", "fatsecret.search")
+    async def search_food(self, query: str) -> dict:
         params = {
             "method": "foods.search",
             "search_expression": query,
             "format": "json"
         }
-        headers = {"Authorization": f"Bearer {self._token}"}
-        resp = requests.get(self.BASE_URL, params=params, headers=headers)
+        token = await self._get_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        resp = await self.http.get(self.BASE_URL, params=params, headers=headers, timeout=self.TIMEOUT)
+        if resp.status_code == 401:
+            # токен отозван раньше срока: обновляем и повторяем один раз
+            self.token_stats["retries_after_401"] += 1
+            if self._token == token:
+                self._expires_at = 0.0
+            headers = {"Authorization": f"Bearer {await self._get_token()}"}
+            resp = await self.http.get(self.BASE_URL, params=params, headers=headers, timeout=self.TIMEOUT)
         resp.raise_for_status()
         return resp.json()
 
+    def close(self):
+        if self._background_refresh is not None:
+            self._background_refresh.cancel()
+
 
 # ============ Калькулятор BMR и калорий ============
 class CalorieCalculator:
@@ -143,32 +331,61 @@ class CalorieCalculator:
         return bmr_value * factor
 
 
-# ============ Сессия пользователя ============
-class UserSession:
-    def __init__(self):
-        self.data: dict = {}
-
-    def clear(self):
-        self.data.clear()
-
-
 # ============ Основной контроллер бота ============
 class BotController:
-    def __init__(self):
-        self.db = Database()
-        self.fatsecret_api = FatSecretAPI(FATSECRET_CLIENT_ID, FATSECRET_CLIENT_SECRET)
-        self.yandex_gpt = YandexGPTAPI(YANDEX_API_KEY, YANDEX_FOLDER_ID)
+    def __init__(self, shard: Optional[tuple[int, int]] = None):
+        self.shard = shard  # (номер, всего) при запуске в нескольких процессах
+        self.db = AsyncDatabase(Database(DB_NAME, synchronous=DB_SYNCHRONOUS),
+                                meal_batching=MEAL_BATCHING, durability=DB_DURABILITY)
+        self.http = HttpTransport()
+        self.fatsecret_api = FatSecretAPI(FATSECRET_CLIENT_ID, FATSECRET_CLIENT_SECRET, self.http)
+        self.yandex_gpt = YandexGPTAPI(YANDEX_API_KEY, YANDEX_FOLDER_ID, self.http)
+        # таймауты подстраиваются под обычные задержки сервиса, верхняя граница — прежние TIMEOUT
+        self.fatsecret = Upstream("fatsecret", FATSECRET_CONCURRENCY, min_timeout=1.0, max_timeout=10.0,
+                                  failure_threshold=UPSTREAM_FAILURES, reset_timeout=UPSTREAM_RESET_TIMEOUT)
+        self.yandex = Upstream("yandexgpt", YANDEX_CONCURRENCY, min_timeout=3.0, max_timeout=30.0,
+                               queue_timeout=5.0, failure_threshold=UPSTREAM_FAILURES,
+                               reset_timeout=UPSTREAM_RESET_TIMEOUT)
+        self.food_cache = TieredCache("fatsecret", DB_NAME, max_size=5000, ttl=FOOD_CACHE_TTL,
+                                      stale_grace=FOOD_CACHE_STALE_GRACE)
+        self.food_index = self._load_food_index()
+        self.recipes = RecipeCatalog(IMAGE_RECIPES_DIR)
+        self._background: list[asyncio.Task] = []
+        self.ai_cache = ResponseCache(DB_NAME, max_size=5000, ttl=AI_CACHE_TTL,
+                                      similarity_threshold=AI_CACHE_SIMILARITY,
+                                      cost_per_call=AI_COST_PER_CALL)
         self.calc = CalorieCalculator()
-        self.sessions: dict[int, UserSession] = {}
+        self.sessions = SessionStore(SESSION_IDLE_TTL, SESSION_MAX_BYTES,
+                                     db_name=DB_NAME if SESSION_PERSIST else None)
+        self._metrics_server: Optional[asyncio.AbstractServer] = None
+        self.digests: Optional[DigestScheduler] = None
+        REGISTRY.add_collector("food_cache", self.food_cache.stats)
+        REGISTRY.add_collector("ai_cache", self.ai_cache.stats)
+        REGISTRY.add_collector("sessions", self.sessions.stats)
+        REGISTRY.add_collector("profiles", self.db.profiles.stats)
+        REGISTRY.add_collector("gateway_fatsecret", self.fatsecret.stats)
+        REGISTRY.add_collector("gateway_yandexgpt", self.yandex.stats)
+
+    @staticmethod
+    def _load_food_index():
+        if not os.path.exists(FOOD_INDEX_PATH):
+            logger.info(f"Local food index {FOOD_INDEX_PATH} not found, using FatSecret only")
+            return None
+        try:
+            index = FoodIndex.load(FOOD_INDEX_PATH)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load food index: {e}")
+            return None
+        logger.info(f"Local food index loaded: {len(index)} foods")
+        return index
 
     def _get_session(self, user_id: int) -> UserSession:
-        if user_id not in self.sessions:
-            self.sessions[user_id] = UserSession()
-        return self.sessions[user_id]
+        return self.sessions.get(user_id)
 
+    @REGISTRY.instrument("handler")
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_name = update.effective_user.first_name
-        reg_done = context.user_data.get('registration_complete', False)
+        reg_done = self.db.is_registered(update.effective_user.id)
         first_run = context.user_data.get('first_run', False)
 
         if first_run:
@@ -185,10 +402,11 @@ class BotController:
         )
         return CHOOSE_ACTION
 
+    @REGISTRY.instrument("handler")
     async def choose_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text
         sess = self._get_session(update.effective_user.id)
-        reg_done = context.user_data.get('registration_complete', False)
+        reg_done = self.db.is_registered(update.effective_user.id)
 
         if text == "Регистрация" and not reg_done:
             sess.clear()
@@ -203,10 +421,12 @@ class BotController:
             return GENDER
 
         elif text == "Подсчёт ккал блюда":
-            # await update.message.reply_text("Какое блюдо вы ели или готовите? Опишите кратко.")
-            # return ENTER_DISH_NAME
-            await update.message.reply_text("Сервис в разработке...")
-            return CHOOSE_ACTION
+            await update.message.reply_text(
+                "Какое блюдо вы ели или готовите? Опишите кратко или напишите рецепт целиком:\n"
+                "|200 г гречки, 150 г курицы, 10 г масла|",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ENTER_DISH_NAME
 
         elif str(text) == "Профиль":
             if not reg_done:
@@ -216,18 +436,18 @@ class BotController:
                 )
                 return CHOOSE_ACTION
 
-            # вывод данных профиля
-            data = self.db.get_user_data(update.effective_user.id)
+            # вывод данных профиля (из кэша, в базу только при первом просмотре)
+            data = await self.db.get_profile(update.effective_user.id)
             text = (
                 f"👤 Ваш профиль:\n"
-                f"• Пол: {data['gender']}\n"
-                f"• Возраст: {data['age']}\n"
-                f"• Рост: {data['height']} см\n"
-                f"• Вес: {data['weight']} кг\n"
-                f"• Активность: {data['activity_level'][2:]}\n"
-                f"• BMR: {data['bmr']:.0f} ккал\n"
-                f"• Норма: {data['daily_calories']:.0f} ккал\n"
-                f"• Зарегистрирован: {data['registration_date']}"
+                f"• Пол: {data.gender}\n"
+                f"• Возраст: {data.age}\n"
+                f"• Рост: {data.height} см\n"
+                f"• Вес: {data.weight} кг\n"
+                f"• Активность: {data.activity_level[2:]}\n"
+                f"• BMR: {data.bmr:.0f} ккал\n"
+                f"• Норма: {data.daily_calories:.0f} ккал\n"
+                f"• Зарегистрирован: {data.registration_date}"
             )
             await update.message.reply_text(text)
             return await self.start(update, context)
@@ -247,6 +467,7 @@ class BotController:
             await update.message.reply_text("Пожалуйста, используйте кнопки ниже:")
             return await self.start(update, context)
 
+    @REGISTRY.instrument("handler")
     async def gender(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         gender = update.message.text.upper()
         if gender not in ['М', 'Ж']:
@@ -259,6 +480,7 @@ class BotController:
         await update.message.reply_text("Введите ваш возраст (полных лет):\n| 25 |")
         return AGE
 
+    @REGISTRY.instrument("handler")
     async def age(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             age = int(update.message.text)
@@ -271,6 +493,7 @@ class BotController:
             await update.message.reply_text("Пожалуйста, введите корректное, целое число \n| 20 | (10-120)")
             return AGE
 
+    @REGISTRY.instrument("handler")
     async def height(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             height = int(update.message.text)
@@ -283,6 +506,7 @@ class BotController:
             await update.message.reply_text("Пожалуйста, введите корректное, целое число  \n| 150 | (100-250)")
             return HEIGHT
 
+    @REGISTRY.instrument("handler")
     async def weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             weight = float(update.message.text.replace(",", "."))
@@ -310,9 +534,14 @@ class BotController:
             await update.message.reply_text("Пожалуйста, введите корректный вес \n| 70 | 70,5 | 70.55 | (30-300)")
             return WEIGHT
 
+    @REGISTRY.instrument("handler")
     async def activity_level(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         sess = self._get_session(user_id)
+        if not {"gender", "age", "height", "weight"} <= sess.data.keys():
+            # диалог восстановлен после перезапуска, а ответы успели потеряться
+            await update.message.reply_text("Данные регистрации потерялись, давайте начнём заново.")
+            return await self.start(update, context)
 
         activity = update.message.text
         if activity not in ACTIVITY_LEVELS and int(activity[0]) not in range(1, 7):
@@ -340,7 +569,6 @@ class BotController:
             "✅ Регистрация завершена!",
             reply_markup=ReplyKeyboardRemove()
         )
-        context.user_data['registration_complete'] = True
 
         bmr_val = self.calc.bmr(
             sess.data["gender"], sess.data["weight"], sess.data["height"], sess.data["age"]
@@ -363,101 +591,481 @@ class BotController:
             "daily_calories": dc,
             "registration_date": datetime.now().isoformat(sep=" ", timespec="seconds")
         }
-        self.db.save_user_data(user_data)
+        await self.db.save_user_data(user_data)  # заодно отмечает пользователя зарегистрированным
+        sess.clear()  # данные регистрации сохранены в users
         return await self.start(update, context)
 
+    async def _find_food(self, query: str) -> dict:
+        """Сначала локальный индекс, затем FatSecret через кэш"""
+        if self.food_index is not None:
+            matches = self.food_index.search(query, k=1)
+            if matches and matches[0].score >= LOCAL_MATCH_SCORE:
+                return matches[0].food
+
+        try:
+            result = await self.food_cache.get_or_load(query, lambda: self._search_remote(query))
+        except Exception as e:
+            # FatSecret недоступен: устаревший ответ из кэша или лучшее, что есть в локальном индексе
+            result = await self.food_cache.get_stale(query)
+            if result is None:
+                matches = self.food_index.search(query, k=1) if self.food_index is not None else []
+                if not matches or matches[0].score < LOCAL_FALLBACK_SCORE:
+                    raise
+                logger.warning(f"FatSecret unavailable ({e}), weak local match for '{query}'")
+                return matches[0].food
+            logger.warning(f"FatSecret unavailable ({e}), stale cache for '{query}'")
+        foods = search_results(result)
+        if not foods:
+            raise ValueError("не найдено")
+        return foods[0]
+
+    async def _search_remote(self, query: str) -> dict:
+        """Поиск в FatSecret; КБЖУ разбираются один раз и кэшируются вместе с ответом"""
+        # поиск идемпотентен: медленную попытку можно продублировать
+        result = await self.fatsecret.call("search", lambda: self.fatsecret_api.search_food(query), hedge=True)
+        for food in search_results(result):
+            attach_macros(food)
+        return result
+
+    @REGISTRY.instrument("handler")
     async def enter_dish_name(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.message.text
+        ingredients = parse_ingredients(query)
+        if any(grams is not None for _, grams in ingredients):
+            return await self._count_recipe(update, context, ingredients)
         sess = self._get_session(update.effective_user.id)
         sess.data["dish_query"] = query
 
         try:
-            result = self.fatsecret_api.search_food(query)
-            foods = result.get("foods", {}).get("food", [])
-            if not foods:
-                raise ValueError("не найдено")
-            food = foods[0]
+            food = await self._find_food(query)
+            macros = food_macros(food)
+            if macros is not None and macros.grams is None:
+                await update.message.reply_text(self._serving_text([(food, macros)]))
+                return ENTER_DISH_NAME
             sess.data["food"] = food
             await update.message.reply_text(
                 f"Нашёл: {food['food_name']}\nОписание: {food.get('food_description', '-')}\nВведите граммы:"
             )
             return ENTER_WEIGHT
-        except Exception:
+        except ValueError:
+            await update.message.reply_text("Ничего не нашлось, попробуйте назвать блюдо иначе")
+        except UpstreamUnavailable:
+            await update.message.reply_text("Поиск продуктов временно недоступен, попробуйте через минуту")
+        except Exception as e:
+            logger.error(f"Food search failed for '{query}': {e}")
             await update.message.reply_text("Ошибка поиска, попробуйте позже")
+        return await self.start(update, context)
+
+    async def _count_recipe(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            ingredients: list[tuple[str, Optional[float]]]):
+        """Рецепт из нескольких ингредиентов: поиск параллельно, КБЖУ одним проходом, запись одной транзакцией"""
+        if len(ingredients) > MAX_INGREDIENTS:
+            await update.message.reply_text(f"Слишком длинный рецепт: не больше {MAX_INGREDIENTS} ингредиентов")
+            return ENTER_DISH_NAME
+        # «2 яйца» — штуки, а не граммы: вес переспрашиваем
+        missing = [name for name, grams in ingredients if not grams]
+        if missing:
+            await update.message.reply_text(
+                f"Укажите вес в граммах для: {', '.join(missing)}\nНапример: |200 г гречки, 120 г яиц|"
+            )
+            return ENTER_DISH_NAME
+
+        # одинаковые продукты ищутся один раз; одновременные запросы к тому же ключу кэш тоже склеивает
+        queries = {normalize_query(name): name for name, _ in ingredients}
+        with REGISTRY.track("recipe", "lookup"):
+            found = await asyncio.gather(*(self._find_food(name) for name in queries.values()),
+                                         return_exceptions=True)
+        foods = dict(zip(queries, found))
+
+        rows, not_found, per_serving, unavailable = [], [], [], False
+        for name, grams in ingredients:
+            food = foods[normalize_query(name)]
+            macros = food_macros(food) if isinstance(food, dict) else None
+            if macros is not None and macros.grams is None:
+                per_serving.append((food, macros))
+                continue
+            if macros is None:
+                not_found.append(name)
+                if isinstance(food, UpstreamUnavailable):
+                    unavailable = True
+                elif isinstance(food, Exception) and not isinstance(food, ValueError):
+                    logger.error(f"Food search failed for '{name}': {food}")
+                continue
+            rows.append((food["food_name"], grams, macros))
+
+        # КБЖУ на штуку не пересчитать в граммы: ничего не сохраняем, просим другой продукт
+        if per_serving:
+            await update.message.reply_text(self._serving_text(per_serving))
+            return ENTER_DISH_NAME
+
+        if not rows:
+            await update.message.reply_text(
+                "Поиск продуктов временно недоступен, попробуйте через минуту" if unavailable
+                else "Ничего не нашлось, попробуйте назвать ингредиенты иначе"
+            )
             return await self.start(update, context)
 
+        records, weights = [m for _, _, m in rows], [g for _, g, _ in rows]
+        values = ingredient_macros(records, weights)
+        per_item = values.round(1).tolist()
+        totals = dict(zip(("calories", "protein", "fat", "carbs"), values.sum(axis=0).tolist()))
+        meals = [
+            (update.effective_user.id, {"food_name": name, "calories": kcal, "protein": protein,
+                                        "fat": fat, "carbs": carbs, "weight": grams})
+            for (name, grams, _), (kcal, protein, fat, carbs) in zip(rows, per_item)
+        ]
+        await self.db.save_meals(meals)
+
+        lines = [f"🍽 Блюдо: {sum(weights):.0f} г"]
+        lines += [f"• {name} — {grams:.0f} г: {kcal:.0f} ккал"
+                  for (name, grams, _), (kcal, *_) in zip(rows, per_item)]
+        lines.append(f"Итого: {totals['calories']:.0f} ккал, Б/Ж/У "
+                     f"{totals['protein']:.0f}/{totals['fat']:.0f}/{totals['carbs']:.0f} г")
+        if not_found:
+            lines.append(f"Не нашёл и не учёл: {', '.join(not_found)}")
+
+        kb = [[KeyboardButton("Подсчёт ккал блюда")]]
+        await update.message.reply_text("\n".join(lines), reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        return CHOOSE_ACTION
+
+    @staticmethod
+    def _serving_text(foods: list[tuple[dict, Macros]]) -> str:
+        names = ", ".join(f"{food['food_name']} (на {macros.amount:g} {macros.unit})" for food, macros in foods)
+        return f"КБЖУ указаны на порцию, а не на вес: {names}\nНазовите продукт иначе, например |гречка отварная|"
+
+    @REGISTRY.instrument("handler")
     async def enter_weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        grams = float(update.message.text.replace(",", "."))
+        try:
+            grams = float(update.message.text.replace(",", "."))
+        except ValueError:
+            await update.message.reply_text("Введите вес числом, например |150|")
+            return ENTER_WEIGHT
         sess = self._get_session(update.effective_user.id)
         food = sess.data.get("food", {})
-        desc = food.get("food_description", "")
-        if "Calories:" not in desc:
-            return await update.message.reply_text("Нет данных о калориях")
-        per100 = float(desc.split("Calories:")[-1].split("kcal")[0].strip())
-        total = per100 * grams / 100
-        await update.message.reply_text(f"{grams:.0f} г ≈ {total:.0f} ккал")
+        macros = food_macros(food) if food else None
+        values = macros.for_weight(grams) if macros is not None else None
+        if values is None:
+            await update.message.reply_text("Нет данных о калориях на вес")
+            return await self.start(update, context)
+        await update.message.reply_text(f"{grams:.0f} г ≈ {values['calories']:.0f} ккал")
 
         meal = {
             "food_name": food["food_name"],
-            "calories": total,
-            "protein": None, "fat": None, "carbs": None,
+            **values,
             "weight": grams
         }
-        self.db.save_meal(update.effective_user.id, meal)  # Раскомментируйте, если реализуете базу данных
+        await self.db.save_meal(update.effective_user.id, meal)  # Раскомментируйте, если реализуете базу данных
 
         kb = [[KeyboardButton("Подсчёт ккал блюда")]]
-        return await update.message.reply_text("Готово!", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text("Готово!", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        return CHOOSE_ACTION
 
+    @REGISTRY.instrument("handler")
     async def chat_with_ai(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_message = update.message.text
 
-        ai_response = await self.yandex_gpt.get_response(user_message)
-        await update.message.reply_text(ai_response, parse_mode="Markdown")
+        cached = await self.ai_cache.lookup(user_message)
+        if cached is not None:
+            await update.message.reply_text(cached, parse_mode="Markdown")
+            return CHAT_WITH_AI
+
+        if not self.yandex.available:
+            await self._degraded_ai_reply(update, user_message)
+            return CHAT_WITH_AI
+
+        if AI_STREAMING:
+            ai_response = await self._stream_ai_response(update, user_message)
+        else:
+            try:
+                ai_response = await self.yandex.call("complete", lambda: self.yandex_gpt.complete(user_message))
+            except UpstreamUnavailable:
+                await self._degraded_ai_reply(update, user_message)
+                return CHAT_WITH_AI
+            except Exception as e:
+                logger.error(f"YandexGPT API error: {e}")
+                ai_response = None
+            await update.message.reply_text(ai_response or self.yandex_gpt.ERROR_TEXT, parse_mode="Markdown")
+
+        if ai_response:
+            await self.ai_cache.store(user_message, ai_response)
         return CHAT_WITH_AI
 
+    async def _degraded_ai_reply(self, update: Update, user_message: str, reply: Optional[Message] = None):
+        """AI недоступен: похожий ответ из кэша или быстрый отказ вместо ожидания таймаута.
+
+        reply — уже отправленное сообщение-заглушка потокового ответа, его текст заменяется.
+        """
+        cached = await self.ai_cache.lookup_fallback(user_message, AI_DEGRADED_SIMILARITY)
+        if cached is not None:
+            text = f"⚠️ AI временно недоступен, вот ответ на похожий вопрос:\n\n{cached}"
+        else:
+            text = "⚠️ AI временно недоступен, попробуйте через минуту"
+        if reply is not None:
+            await reply.edit_text(text)
+        else:
+            await update.message.reply_text(text)
+
+    async def _stream_ai_response(self, update: Update, user_message: str) -> Optional[str]:
+        """Одно сообщение, которое дописывается по мере генерации ответа.
+
+        Возвращает полный текст ответа или None, если поток оборвался.
+        """
+        reply = await update.message.reply_text("…")
+        text, shown = "", ""
+        next_edit = time.monotonic()
+        try:
+            async for text in self.yandex.stream("stream", lambda: self.yandex_gpt.stream_response(user_message)):
+                # Telegram обрезает пробелы в конце: фрагмент из одних переводов строк правкой не считается
+                if time.monotonic() < next_edit or text.rstrip() == shown:
+                    continue
+                try:
+                    # промежуточный текст без разметки: Markdown может быть незакрытым
+                    await reply.edit_text(text)
+                    shown = text.rstrip()
+                    next_edit = time.monotonic() + AI_EDIT_INTERVAL
+                except RetryAfter as e:
+                    next_edit = time.monotonic() + e.retry_after
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        raise
+                    shown = text.rstrip()
+            complete = True
+            if not text.strip():
+                logger.warning("YandexGPT stream finished without text")
+                text, complete = self.yandex_gpt.ERROR_TEXT, False
+        except UpstreamUnavailable:
+            # шлюз не пустил запрос: как и без потоковой передачи, ответ из кэша или быстрый отказ
+            await self._degraded_ai_reply(update, user_message, reply)
+            return None
+        except Exception as e:
+            logger.error(f"YandexGPT stream error: {e}")
+            text = text or self.yandex_gpt.ERROR_TEXT
+            complete = False
+
+        try:
+            await reply.edit_text(text, parse_mode="Markdown")
+        except BadRequest:
+            # невалидная разметка или текст не изменился
+            if text.rstrip() != shown:
+                await reply.edit_text(text)
+        return text if complete else None
+
+    async def _send_recipe(self, bot, chat_id: int) -> bool:
+        """Случайный рецепт в чат; False, если рецептов нет"""
+        recipe = self.recipes.pick()
+        if recipe is None:
+            return False
+        logger.info(f"Selected recipe image: {recipe.source}")
+
+        # Повторная отправка по file_id: Telegram не требует загружать файл заново
+        file_id = self.recipes.file_id(recipe)
+        if file_id:
+            try:
+                await bot.send_photo(chat_id=chat_id, photo=file_id, caption="🍴 Ваш ежедневный рецепт")
+                return True
+            except BadRequest as e:
+                logger.warning(f"Stale file_id for {recipe.source}: {e}")
+                await asyncio.to_thread(self.recipes.remember_file_id, recipe, None)
+
+        data = await asyncio.to_thread(recipe.read)
+        message = await bot.send_photo(chat_id=chat_id, photo=data, caption="🍴 Ваш ежедневный рецепт")
+        if message.photo:
+            await asyncio.to_thread(self.recipes.remember_file_id, recipe, message.photo[-1].file_id)
+        return True
+
+    @REGISTRY.instrument("handler")
     async def send_daily_recipe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            # Абсолютный путь и содержимое директории
-            abs_dir = os.path.abspath(IMAGE_RECIPES_DIR)
-            logger.info(f"Looking in {abs_dir}")
-            files = [f for f in os.listdir(abs_dir)
-                     if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-            logger.info(f"Found recipe images: {files}")
-            if not files:
+            if not await self._send_recipe(context.bot, update.effective_chat.id):
                 await update.message.reply_text("Рецепты недоступны.")
-                return CHOOSE_ACTION
-
-            choice = random.choice(files)
-            src_path = os.path.join(abs_dir, choice)
-            logger.info(f"Selected image: {src_path}")
-
-            # Проверка валидности и конвертация в RGB JPEG
-            with Image.open(src_path) as img:
-                img.verify()  # проверка
-            with Image.open(src_path) as img:
-                safe_img = img.convert('RGB')
-                temp_path = os.path.join(abs_dir, f"safe_{choice}.jpg")
-                safe_img.save(temp_path, 'JPEG')
-
-            # Отправка файла
-            with open(temp_path, 'rb') as f:
-                data = f.read()
-            await update.message.reply_photo(photo=data, caption="🍴 Ваш ежедневный рецепт")
-            # Опционально удалить временный
-            os.remove(temp_path)
-
         except Exception as e:
             logger.error(f"Error sending recipe image: {e}", exc_info=True)
             await update.message.reply_text("Ошибка при отправке рецепта.")
         return CHOOSE_ACTION
 
+    @REGISTRY.instrument("handler")
+    async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/export [csv|parquet|arrow] — вся история приёмов пищи файлом"""
+        fmt = context.args[0].lower() if context.args else "csv"
+        if fmt not in available_formats():
+            await update.message.reply_text(f"Доступные форматы: {', '.join(available_formats())}")
+            return
+        user_id = update.effective_user.id
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}", prefix="export-")
+        os.close(fd)
+        try:
+            # история пишется в файл пачками, целиком в памяти не держится
+            rows = await self.db.read(export_table, "meals", path, fmt, user_id)
+            if not rows:
+                await update.message.reply_text("История питания пока пуста.")
+                return
+            with open(path, 'rb') as f:
+                await update.message.reply_document(
+                    document=f, filename=f"meals-{datetime.now():%Y%m%d}.{fmt}",
+                    caption=f"История питания: {rows} записей"
+                )
+        finally:
+            os.remove(path)
+
+    @REGISTRY.instrument("handler")
+    async def trends(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/trends [дней] — потребление против нормы за период (по умолчанию 30 дней)"""
+        try:
+            days = min(max(int(context.args[0]), 7), 365) if context.args else 30
+        except ValueError:
+            days = 30
+        r = await self.db.read(user_report, update.effective_user.id, days)
+        if not r["logged_days"]:
+            await update.message.reply_text("За этот период нет записей о питании.")
+            return
+        lines = [
+            f"📈 {r['start']} — {r['end']}: записи за {r['logged_days']} дн.",
+            f"• В среднем: {r['avg_calories']:.0f} ккал/день",
+            f"• Последние 7 дней: {r['rolling_7d'] or 0:.0f} ккал/день",
+        ]
+        if r["target"] is not None:
+            sign = "профицит" if r["avg_balance"] > 0 else "дефицит"
+            lines.append(f"• Норма {r['target']:.0f} ккал, {sign} {abs(r['avg_balance']):.0f} ккал/день")
+            lines.append(f"• В норме подряд: {r['target_streak']} дн. (рекорд {r['longest_target_streak']})")
+        if r["protein_pct"] is not None:
+            lines.append(f"• Б/Ж/У: {r['protein_pct']:.0f}% / {r['fat_pct']:.0f}% / {r['carbs_pct']:.0f}%")
+        lines.append(f"• Записи подряд: {r['logging_streak']} дн. (рекорд {r['longest_logging_streak']})")
+        await update.message.reply_text("\n".join(lines))
+
+    @REGISTRY.instrument("handler")
+    async def digest(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/digest ЧЧ:ММ [daily|weekly] — сводка по расписанию, /digest off — отключить"""
+        args = context.args or []
+        user_id = update.effective_user.id
+        if args and args[0].lower() == "off":
+            await self.db.set_digest(user_id, None)
+            await update.message.reply_text("Сводки отключены.")
+            return
+        try:
+            digest_time = datetime.strptime(args[0], "%H:%M").strftime("%H:%M")
+            period = args[1].lower() if len(args) > 1 else "daily"
+            if period not in ("daily", "weekly"):
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                "Использование: /digest 21:00 [daily|weekly] или /digest off"
+            )
+            return
+        if not await self.db.set_digest(user_id, digest_time, period):
+            await update.message.reply_text("Сначала пройдите регистрацию.")
+            return
+        when = "каждый день" if period == "daily" else "раз в неделю"
+        await update.message.reply_text(f"Сводка будет приходить {when} в {digest_time}.")
+
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/stats — метрики; /stats profile [секунды] — профиль обработчиков"""
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        if context.args and context.args[0] == "profile":
+            try:
+                seconds = float(context.args[1]) if len(context.args) > 1 else 10.0
+                if not math.isfinite(seconds):
+                    raise ValueError
+            except ValueError:
+                await update.message.reply_text("Использование: /stats profile [секунды от 1 до 120]")
+                return
+            await self._profile(update, seconds)
+            return
+
+        food, ai = self.food_cache.stats(), self.ai_cache.stats()
+        sess, profiles = self.sessions.stats(), self.db.profiles.stats()
+        text = (
+            f"{REGISTRY.summary()}\n\n"
+            f"Кэш FatSecret: {food['size']} записей, hit rate {food['hit_rate']:.0%}\n"
+            f"Кэш AI: hit rate {ai['hit_rate']:.0%}, сэкономлено {ai['calls_saved']} вызовов\n"
+            f"Сессии: {sess['live_sessions']}, {sess['bytes'] // 1024} КБ\n"
+            f"Профили: {profiles['registered']} зарегистрированных, hit rate {profiles['hit_rate']:.0%}\n"
+            f"Автоматы: FatSecret {self.fatsecret.breaker.state}, YandexGPT {self.yandex.breaker.state}"
+        )
+        await update.message.reply_text(text[:4000])
+
+    async def _profile(self, update: Update, seconds: float):
+        seconds = min(max(seconds, 1.0), 120.0)
+        profiler = SamplingProfiler(REGISTRY.instrumented["handler"])
+        await update.message.reply_text(f"Профилирую {seconds:.0f} с...")
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+        await asyncio.to_thread(profiler.dump, path)
+        top = "\n".join(f"{name}: {n}" for name, n in list(profiler.by_handler().items())[:15])
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f, filename=os.path.basename(path),
+                caption=f"{profiler.samples} сэмплов (flamegraph.pl)\n{top}"[:1000]
+            )
+
     async def error(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.exception("Handler error")
         if update.message:
             await update.message.reply_text("❌ Ошибка, попробуйте позже")
 
-    def run(self):
-        app = ApplicationBuilder().token(TOKEN).build()
+    async def startup(self, app):
+        await asyncio.to_thread(self.recipes.refresh)
+        await asyncio.to_thread(self.sessions.load, self.shard)
+        await self.db.load_profiles(self.shard)
+        self._background.append(asyncio.create_task(self.recipes.watch(RECIPE_REFRESH_INTERVAL)))
+        self._background.append(asyncio.create_task(
+            self.sessions.run(PERSISTENCE_INTERVAL if SESSION_PERSIST else 60.0)
+        ))
+        if METRICS_PORT:
+            # у каждого процесса-обработчика свой порт: METRICS_PORT + номер
+            port = METRICS_PORT + (self.shard[0] if self.shard else 0)
+            self._metrics_server = await serve_metrics(REGISTRY, METRICS_HOST, port)
+        if DIGESTS_ENABLED:
+            # каждый процесс рассылает своим пользователям, общий темп делится поровну
+            workers = self.shard[1] if self.shard else 1
+            self.digests = DigestScheduler(self.db, app.bot, self._send_recipe,
+                                           SendLimiter(DIGEST_RATE / workers),
+                                           weekly_day=DIGEST_WEEKDAY, shard=self.shard)
+            REGISTRY.add_collector("digests", lambda: self.digests.stats)
+            self._background.append(asyncio.create_task(self.digests.run(DIGEST_INTERVAL)))
+
+    async def shutdown(self, app):
+        for task in self._background:
+            task.cancel()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        await self.sessions.flush()
+        logger.info(f"Session stats: {self.sessions.stats()}")
+        await self.db.flush()
+        if self.db.meal_queue is not None:
+            logger.info(f"Meal batching stats: {self.db.meal_queue.summary()}")
+        logger.info(f"Food cache stats: {self.food_cache.stats()}")
+        logger.info(f"FatSecret token stats: {self.fatsecret_api.token_stats}")
+        logger.info(f"YandexGPT stream stats: {self.yandex_gpt.stream_stats}")
+        logger.info(self.ai_cache.report())
+        self.ai_cache.close()
+        self.fatsecret_api.close()
+        self.food_cache.close()
+        self.db.close()
+        await self.http.aclose()
+
+    def build_application(self, token: str = TOKEN, request=None):
+        builder = (
+            ApplicationBuilder().token(token)
+            .update_queue(BackpressureQueue(MAX_PENDING_UPDATES))
+            .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+            .post_init(self.startup)
+            .post_shutdown(self.shutdown)
+        )
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        if PERSISTENCE_ENABLED:
+            builder = builder.persistence(
+                SQLitePersistence(DB_NAME, update_interval=PERSISTENCE_INTERVAL, shard=self.shard)
+            )
+        app = builder.build()
+        REGISTRY.add_collector("updates", lambda: {"pending": app.update_queue.pending})
 
         conv = ConversationHandler(
             entry_points=[CommandHandler("start", self.start)],
@@ -473,15 +1081,53 @@ class BotController:
                 ENTER_WEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.enter_weight)],
                 CHAT_WITH_AI: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.chat_with_ai)],
             },
-            fallbacks=[CommandHandler("cancel", self.start)]
+            fallbacks=[CommandHandler("cancel", self.start)],
+            name="main",
+            persistent=PERSISTENCE_ENABLED,
         )
 
         app.add_handler(conv)
+        app.add_handler(CommandHandler("stats", self.stats))
+        app.add_handler(CommandHandler("export", self.export))
+        app.add_handler(CommandHandler("trends", self.trends))
+        app.add_handler(CommandHandler("digest", self.digest))
+        return app
+
+    def run(self):
+        app = self.build_application()
         logger.info("Бот запущен")
         print("Бот запущен...")
-        app.run_polling()
+        if BOT_MODE == "webhook":
+            app.run_webhook(**webhook_options())
+        else:
+            app.run_polling()
         print("Бот остановлен.")
 
 
+def webhook_options() -> dict:
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret for this run")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL,
+        "secret_token": secret,
+    }
+
+
+def main():
+    if BOT_WORKERS > 1:
+        # миграции один раз, до того как процессы откроют базу
+        Database(DB_NAME, synchronous=DB_SYNCHRONOUS).close()
+        logger.info(f"Бот запущен: {BOT_WORKERS} процессов")
+        run_sharded(TOKEN, BOT_WORKERS,
+                    webhook=webhook_options() if BOT_MODE == "webhook" else None,
+                    max_pending=MAX_PENDING_UPDATES, drain_timeout=SHARD_DRAIN_TIMEOUT)
+    else:
+        BotController().run()
+
+
 if __name__ == "__main__":
-    BotController().run()
+    main()
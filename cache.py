@@ -0,0 +1,439 @@
+# cache.py
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from database import ensure_schema
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def normalize_query(text: str) -> str:
+    """'  Куриная  Грудка ' и 'куриная грудка' дают один ключ"""
+    text = text.lower().replace('ё', 'е')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def trigrams(text: str) -> set[str]:
+    """Триграммы с границами слов: 'суп' -> {' су', 'суп', 'уп '}"""
+    return normalized_trigrams(normalize_query(text))
+
+
+def normalized_trigrams(normalized: str) -> set[str]:
+    grams = set()
+    for word in normalized.split():
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class LRUCache:
+    """In-memory кэш с ограничением по числу записей и временем жизни"""
+
+    def __init__(self, max_size: int = 5000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        expires_at, value = item
+        if expires_at < time.time():
+            del self._data[key]
+            self.expirations += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, expires_at: Optional[float] = None) -> None:
+        self._data[key] = (expires_at or time.time() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """Персистентный уровень кэша: переживает перезапуск бота.
+
+    Записи разных кэшей разделяются по namespace, значения хранятся
+    в JSON. Просроченные строки удаляются при старте и периодически
+    при записи, но не раньше чем через stale_grace секунд после истечения:
+    до тех пор их отдаёт get(include_expired=True), когда источник недоступен.
+    """
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, db_name: str, namespace: str, stale_grace: float = 0.0):
+        self.namespace = namespace
+        self.stale_grace = stale_grace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_name, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        ensure_schema(db_name)
+        self._writes = 0
+        self.prune()
+
+    def get(self, key: str, include_expired: bool = False) -> tuple[Any, float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace=? AND key=? AND expires_at>=?",
+                (self.namespace, key, 0.0 if include_expired else time.time())
+            ).fetchone()
+        if row is None:
+            return _MISSING, 0.0
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries VALUES (?,?,?,?)",
+                (self.namespace, key, payload, expires_at)
+            )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def keys(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM cache_entries WHERE namespace=? AND expires_at>=?",
+                (self.namespace, time.time())
+            ).fetchall()
+        return [key for (key,) in rows]
+
+    def prune(self) -> int:
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace=? AND expires_at<?",
+                (self.namespace, time.time() - self.stale_grace)
+            )
+        return cur.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class TieredCache:
+    """Двухуровневый кэш: LRU в памяти поверх SQLite.
+
+    get_or_load нормализует ключ, ищет его сначала в памяти, затем
+    в базе и только потом вызывает loader. Одновременные запросы
+    с одинаковым ключом ждут один и тот же вызов loader (single-flight).
+    Просроченные записи хранятся в SQLite ещё stale_grace секунд для get_stale.
+    """
+
+    def __init__(self, namespace: str, db_name: Optional[str] = None,
+                 max_size: int = 5000, ttl: float = 24 * 3600.0, stale_grace: float = 0.0):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.disk = SQLiteCache(db_name, namespace, stale_grace) if db_name else None
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        key = normalize_query(key)
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            self.hits_memory += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise  # отменили нас самих
+                # отменили ведущего (таймаут обработчика, остановка): загружаем сами
+                return await self.get_or_load(key, loader)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await self._load(key, loader)
+        except Exception as e:
+            fut.set_exception(e)
+            # исключение уже доставлено вызывающему, ожидающих может не быть
+            fut.exception()
+            raise
+        else:
+            fut.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+            # CancelledError не Exception: без этого ожидающие повисли бы навсегда
+            if not fut.done():
+                fut.cancel()
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        if self.disk is not None:
+            value, expires_at = await asyncio.to_thread(self.disk.get, key)
+            if value is not _MISSING:
+                self.hits_disk += 1
+                self.memory.set(key, value, expires_at)
+                return value
+
+        self.misses += 1
+        value = await loader()
+        await self.set(key, value)
+        return value
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        """Значение без загрузки: память, затем SQLite"""
+        key = normalize_query(key)
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            self.hits_memory += 1
+            return value
+        if self.disk is not None:
+            value, expires_at = await asyncio.to_thread(self.disk.get, key)
+            if value is not _MISSING:
+                self.hits_disk += 1
+                self.memory.set(key, value, expires_at)
+                return value
+        self.misses += 1
+        return default
+
+    async def get_stale(self, key: str) -> Any:
+        """Значение, даже просроченное (ещё не удалённое из SQLite), — когда источник недоступен"""
+        key = normalize_query(key)
+        value = self.memory.get(key)
+        if value is _MISSING and self.disk is not None:
+            value, _ = await asyncio.to_thread(self.disk.get, key, True)
+        if value is _MISSING:
+            return None
+        self.stale_hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        key = normalize_query(key)
+        expires_at = time.time() + self.ttl
+        self.memory.set(key, value, expires_at)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value, expires_at)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "namespace": self.namespace,
+            "size": len(self.memory),
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits,
+            "evictions": self.memory.evictions,
+            "expirations": self.memory.expirations,
+            "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+def normalize_prompt(text: str) -> str:
+    """Нормализация вопроса к AI: регистр, ё, пунктуация и пробелы"""
+    return normalize_query(re.sub(r'[^\w\s%]', ' ', text))
+
+
+# слова вопроса, от которых ответ не зависит
+_STOP_WORDS = frozenset("""
+сколько какой какая какое какие каков что как где чем ли же бы а и или но в во на с со к ко о об
+от до из по за для при про у без это этой этом есть будет можно нужно
+калорий калории калорийность ккал кбжу белков жиров углеводов содержится
+""".split())
+# грубый стеммер: окончания прилагательных и существительных, основа не короче трёх букв
+_ENDING_RE = re.compile(r'(ами|ями|ого|его|ому|ему|ыми|ими|ой|ей|ый|ий|ая|яя|ое|ее|ые|ие|ых|их|ым|им|ую|юю'
+                        r'|ом|ем|ах|ях|ам|ям|ов|ев|а|я|о|е|ы|и|у|ю|ь)$')
+
+
+def content_stems(key: str) -> frozenset[str]:
+    """Основы значимых слов нормализованного вопроса: «жареной курице» -> {жарен, куриц}"""
+    stems = set()
+    for word in key.split():
+        if word in _STOP_WORDS or word.isdigit():
+            continue
+        stem = _ENDING_RE.sub('', word)
+        stems.add(stem if len(stem) >= 3 else word)
+    return frozenset(stems)
+
+
+class SimilarityIndex:
+    """Поиск ранее заданных вопросов по доле общих основ значимых слов (Жаккар).
+
+    Основы (content_stems) сглаживают падежи и порядок слов: «калорийность
+    жареной курицы» и «сколько калорий в жареной курице» совпадают на 1.0,
+    а «жареной» и «вареной» курице — лишь на 1/3. Числа — жёсткое условие:
+    «100 г» и «200 г» банана — разные вопросы. Порог 0.95 требует тех же
+    основ, порог 0.6 допускает лишнее слово, например «с кожей».
+    """
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 5000):
+        self.threshold = threshold
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[frozenset[str], list[str]]] = OrderedDict()
+        self._postings: dict[str, set[str]] = {}
+
+    def add(self, key: str) -> None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        stems = content_stems(key)
+        if not stems:
+            return
+        self._entries[key] = (stems, re.findall(r'\d+', key))
+        for stem in stems:
+            self._postings.setdefault(stem, set()).add(key)
+        while len(self._entries) > self.max_size:
+            old_key, (old_stems, _) = self._entries.popitem(last=False)
+            for stem in old_stems:
+                keys = self._postings[stem]
+                keys.discard(old_key)
+                if not keys:
+                    del self._postings[stem]
+
+    def find(self, key: str, threshold: Optional[float] = None) -> Optional[tuple[str, float]]:
+        stems = content_stems(key)
+        if not stems:
+            return None
+        shared = Counter()
+        for stem in stems:
+            shared.update(self._postings.get(stem, ()))
+        numbers = re.findall(r'\d+', key)
+        best, best_score = None, 0.0
+        for candidate, common in shared.items():
+            candidate_stems, candidate_numbers = self._entries[candidate]
+            score = common / (len(stems) + len(candidate_stems) - common)
+            if score > best_score and candidate_numbers == numbers:
+                best, best_score = candidate, score
+        if best is None or best_score < (threshold or self.threshold):
+            return None
+        return best, best_score
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ResponseCache:
+    """Кэш ответов AI: точный по нормализованному вопросу и, опционально, по похожести.
+
+    Экономия считается в вызовах API; стоимость вызова задаётся
+    cost_per_call (в рублях), отчёт выдаёт report().
+    """
+
+    def __init__(self, db_name: Optional[str] = None, max_size: int = 5000,
+                 ttl: float = 7 * 24 * 3600.0, similarity_threshold: Optional[float] = 0.95,
+                 cost_per_call: float = 0.0):
+        self.exact = TieredCache("yandexgpt", db_name, max_size=max_size, ttl=ttl)
+        self.similar = None
+        if similarity_threshold:
+            self.similar = SimilarityIndex(similarity_threshold, max_size)
+            if self.exact.disk is not None:
+                for key in self.exact.disk.keys():
+                    self.similar.add(key)
+        self.cost_per_call = cost_per_call
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    async def lookup(self, prompt: str) -> Optional[str]:
+        key = normalize_prompt(prompt)
+        if not key:
+            return None
+        text = await self.exact.get(key)
+        if text is not None:
+            self.exact_hits += 1
+            REGISTRY.inc("ai_cache_lookups_total", result="exact")
+            return text
+
+        text = await self._similar(key)
+        if text is not None:
+            # похожий ответ — не точное попадание, считаем отдельно
+            self.similar_hits += 1
+            REGISTRY.inc("ai_cache_lookups_total", result="similar")
+            return text
+
+        self.misses += 1
+        REGISTRY.inc("ai_cache_lookups_total", result="miss")
+        return None
+
+    async def lookup_fallback(self, prompt: str, threshold: float) -> Optional[str]:
+        """Похожий ответ по пониженному порогу, когда AI недоступен.
+
+        Вызывается после промаха lookup для того же вопроса: промах уже
+        посчитан, а вызова API такой ответ не экономит, поэтому в hit rate
+        он не входит и учитывается только в ai_cache_lookups_total.
+        """
+        key = normalize_prompt(prompt)
+        text = await self._similar(key, threshold) if key else None
+        if text is not None:
+            REGISTRY.inc("ai_cache_lookups_total", result="similar_fallback")
+        return text
+
+    async def _similar(self, key: str, threshold: Optional[float] = None) -> Optional[str]:
+        if self.similar is None:
+            return None
+        match = self.similar.find(key, threshold)
+        if match is None:
+            return None
+        text = await self.exact.get(match[0])
+        if text is not None:
+            logger.info(f"AI cache: '{key}' served by similar '{match[0]}' ({match[1]:.2f})")
+        return text
+
+    async def store(self, prompt: str, text: str) -> None:
+        key = normalize_prompt(prompt)
+        if not key:
+            return
+        await self.exact.set(key, text)
+        if self.similar is not None:
+            self.similar.add(key)
+
+    def stats(self) -> dict[str, Any]:
+        hits = self.exact_hits + self.similar_hits
+        lookups = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "calls_saved": hits,
+            "cost_saved": hits * self.cost_per_call,
+        }
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"AI-кэш: {s['exact_hits']} точных и {s['similar_hits']} похожих попаданий, "
+                f"{s['misses']} промахов (hit rate {s['hit_rate']:.0%}); "
+                f"сэкономлено {s['calls_saved']} вызовов ≈ {s['cost_saved']:.2f} ₽")
+
+    def close(self) -> None:
+        self.exact.close()
@@ -1,136 +1,787 @@
 # database.py
 
+import asyncio
 import sqlite3
-from datetime import datetime
-from typing import Optional, Dict, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable, Iterator, NamedTuple
 import logging
+from metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
+# WAL позволяет читателям не блокироваться пишущим потоком,
+# synchronous=NORMAL в режиме WAL делает fsync только на чекпоинтах
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+STATEMENT_CACHE_SIZE = 256
+
+# Пересчёт daily_totals из сырых meals
+ROLLUP_SELECT = '''
+SELECT user_id, substr(date, 1, 10) AS day,
+       SUM(calories), COALESCE(SUM(protein),0), COALESCE(SUM(fat),0), COALESCE(SUM(carbs),0),
+       COUNT(*)
+FROM meals
+GROUP BY user_id, day
+'''
+
+MEAL_COLUMNS = ('meal_id', 'user_id', 'food_name', 'calories', 'protein', 'fat', 'carbs', 'weight', 'date')
+USER_COLUMNS = ('user_id', 'username', 'first_name', 'last_name', 'gender', 'age', 'height', 'weight',
+                'activity_level', 'bmr', 'daily_calories', 'registration_date', 'last_update_date',
+                'digest_time', 'digest_period')
+
+
+class UserProfile(NamedTuple):
+    """Профиль для экрана «Профиль»: только нужные поля, без dict на запись"""
+    user_id: int
+    gender: Optional[str]
+    age: Optional[int]
+    height: Optional[float]
+    weight: Optional[float]
+    activity_level: Optional[str]
+    bmr: Optional[float]
+    daily_calories: Optional[float]
+    registration_date: Optional[str]
+
+
+PROFILE_SELECT = f"SELECT {', '.join(UserProfile._fields)} FROM users WHERE user_id=?"
+
+
+# Исходные таблицы; всё, что добавлено позже, — в MIGRATIONS
+BASE_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT NOT NULL,
+        last_name TEXT,
+        gender TEXT CHECK(gender IN ('М','Ж')),
+        age INTEGER CHECK(age BETWEEN 10 AND 120),
+        height REAL CHECK(height BETWEEN 100 AND 250),
+        weight REAL CHECK(weight BETWEEN 30 AND 300),
+        activity_level TEXT,
+        bmr REAL,
+        daily_calories REAL,
+        registration_date TEXT,
+        last_update_date TEXT
+    )''',
+    '''
+    CREATE TABLE IF NOT EXISTS meals (
+        meal_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id   INTEGER NOT NULL REFERENCES users(user_id),
+        food_name TEXT    NOT NULL,
+        calories  REAL    NOT NULL,
+        protein   REAL,
+        fat       REAL,
+        carbs     REAL,
+        weight    REAL    NOT NULL,
+        date      TEXT    NOT NULL
+    )''',
+)
+
+# Миграции схемы, номер применённой хранится в PRAGMA user_version
+MIGRATIONS = (
+    # 1: даты в каноническом виде 'YYYY-MM-DD HH:MM:SS' (сравнимы как строки)
+    #    и составной индекс для выборок по пользователю и диапазону дат
+    (
+        "UPDATE meals SET date = replace(substr(date, 1, 19), 'T', ' ') "
+        "WHERE date GLOB '????-??-??T*' OR length(date) > 19",
+        "CREATE INDEX IF NOT EXISTS idx_meals_user_date ON meals(user_id, date)",
+    ),
+    # 2: дневные итоги, обновляются в той же транзакции, что и meals
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            user_id  INTEGER NOT NULL,
+            day      TEXT    NOT NULL,
+            calories REAL    NOT NULL DEFAULT 0,
+            protein  REAL    NOT NULL DEFAULT 0,
+            fat      REAL    NOT NULL DEFAULT 0,
+            carbs    REAL    NOT NULL DEFAULT 0,
+            meals    INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID''',
+        f"INSERT INTO daily_totals {ROLLUP_SELECT}",
+    ),
+    # 3: время рассылки сводки (HH:MM, NULL — отключена) и журнал отправок
+    #    за день: по нему рассылка продолжается после перезапуска
+    (
+        "ALTER TABLE users ADD COLUMN digest_time TEXT",
+        "ALTER TABLE users ADD COLUMN digest_period TEXT",  # daily | weekly
+        '''
+        CREATE TABLE IF NOT EXISTS digest_runs (
+            user_id  INTEGER NOT NULL,
+            run_date TEXT    NOT NULL,
+            status   TEXT    NOT NULL,
+            attempts INTEGER NOT NULL,
+            sent_at  TEXT    NOT NULL,
+            PRIMARY KEY (user_id, run_date)
+        ) WITHOUT ROWID''',
+    ),
+    # 4: выгрузка истории пользователя пачками по meal_id без сортировки всей истории
+    (
+        "CREATE INDEX IF NOT EXISTS idx_meals_user_id ON meals(user_id, meal_id)",
+    ),
+    # 5: персистентный уровень кэша (cache.SQLiteCache), значения в JSON
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            namespace  TEXT NOT NULL,
+            key        TEXT NOT NULL,
+            value      TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID''',
+    ),
+    # 6: незавершённые сессии диалогов (sessions.SessionStore)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id   INTEGER PRIMARY KEY,
+            data      TEXT NOT NULL,
+            last_seen REAL NOT NULL
+        )''',
+    ),
+    # 7: состояния ConversationHandler и user_data (persistence.SQLitePersistence)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name    TEXT    NOT NULL,
+            key     TEXT    NOT NULL,
+            user_id INTEGER NOT NULL,
+            state   TEXT    NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data    TEXT NOT NULL
+        )''',
+    ),
+)
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Исходные таблицы и недостающие миграции одной транзакцией"""
+    # версия читается уже под блокировкой записи, иначе два процесса
+    # могут применить одну миграцию дважды
+    conn.execute("BEGIN IMMEDIATE")
+    for sql in BASE_SCHEMA:
+        conn.execute(sql)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for sql in statements:
+            conn.execute(sql)
+        conn.execute(f"PRAGMA user_version={number}")
+        logger.info(f"DB migrated to version {number}")
+
+
+def ensure_schema(db_name: str) -> None:
+    """Схема для модулей со своими соединениями (кэш, сессии, persistence)"""
+    conn = sqlite3.connect(db_name)
+    try:
+        conn.execute("PRAGMA busy_timeout=5000")
+        with conn:
+            migrate(conn)
+    finally:
+        conn.close()
+
 
 class Database:
-    def __init__(self, db_name: str = 'fitness_bot.db'):
+    def __init__(self, db_name: str = 'fitness_bot.db', synchronous: str = 'NORMAL'):
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"Unknown synchronous mode: {synchronous}")
         self.db_name = db_name
+        self.synchronous = synchronous.upper()
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        # sqlite3 открывает транзакцию (BEGIN IMMEDIATE) только перед первой
+        # изменяющей командой: блокировка записи берётся сразу, без SQLITE_BUSY
+        # при её повышении, но SELECT до этого идёт вне транзакции — поэтому
+        # чтение-затем-запись оформляется одним upsert
+        self._writer.isolation_level = 'IMMEDIATE'
         self._init_db()
         logger.info(f"DB initialized: {db_name}")
 
+    def _connect(self) -> sqlite3.Connection:
+        # соединения живут всё время работы, поэтому кэш подготовленных
+        # выражений sqlite3 переиспользуется между вызовами
+        conn = sqlite3.connect(self.db_name, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
     def _get_connection(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_name)
+        """Читающее соединение, своё для каждого потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Единственное пишущее соединение, транзакция на весь блок"""
+        with self._write_lock, self._writer as conn:
+            yield conn
+
+    def close(self) -> None:
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        with self._write_lock:
+            self._writer.close()
 
     def _init_db(self) -> None:
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT NOT NULL,
-                last_name TEXT,
-                gender TEXT CHECK(gender IN ('М','Ж')),
-                age INTEGER CHECK(age BETWEEN 10 AND 120),
-                height REAL CHECK(height BETWEEN 100 AND 250),
-                weight REAL CHECK(weight BETWEEN 30 AND 300),
-                activity_level TEXT,
-                bmr REAL,
-                daily_calories REAL,
-                registration_date TEXT,
-                last_update_date TEXT
-            )''')
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS meals (
-                meal_id   INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id   INTEGER NOT NULL REFERENCES users(user_id),
-                food_name TEXT    NOT NULL,
-                calories  REAL    NOT NULL,
-                protein   REAL,
-                fat       REAL,
-                carbs     REAL,
-                weight    REAL    NOT NULL,
-                date      TEXT    NOT NULL
-            )''')
-            conn.commit()
+        with self._write() as conn:
+            migrate(conn)
 
     def save_user_data(self, d: Dict[str, Any]) -> None:
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT 1 FROM users WHERE user_id=?", (d['user_id'],))
-            if cur.fetchone():
-                cur.execute('''
-                UPDATE users SET
-                    username=?, first_name=?, last_name=?,
-                    gender=?, age=?, height=?, weight=?, activity_level=?,
-                    bmr=?, daily_calories=?, last_update_date=?
-                WHERE user_id=?
-                ''', (
-                    d.get('username'), d['first_name'], d.get('last_name'),
-                    d['gender'], d['age'], d['height'], d['weight'], d.get('activity_level'),
-                    d['bmr'], d['daily_calories'], now, d['user_id']
-                ))
-                logger.info(f"User {d['user_id']} updated")
-            else:
-                cur.execute('''
-                INSERT INTO users VALUES
-                (?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ''', (
-                    d['user_id'], d.get('username'), d['first_name'], d.get('last_name'),
-                    d['gender'], d['age'], d['height'], d['weight'], d.get('activity_level'),
-                    d['bmr'], d['daily_calories'], d.get('registration_date', now), now
-                ))
-                logger.info(f"User {d['user_id']} inserted")
-            conn.commit()
+        # одна команда вместо SELECT и INSERT/UPDATE: два процесса не гоняются за вставкой
+        with self._write() as conn:
+            conn.execute('''
+            INSERT INTO users (
+                user_id, username, first_name, last_name, gender, age, height, weight,
+                activity_level, bmr, daily_calories, registration_date, last_update_date
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username, first_name=excluded.first_name,
+                last_name=excluded.last_name, gender=excluded.gender, age=excluded.age,
+                height=excluded.height, weight=excluded.weight,
+                activity_level=excluded.activity_level, bmr=excluded.bmr,
+                daily_calories=excluded.daily_calories, last_update_date=excluded.last_update_date
+            ''', (
+                d['user_id'], d.get('username'), d['first_name'], d.get('last_name'),
+                d['gender'], d['age'], d['height'], d['weight'], d.get('activity_level'),
+                d['bmr'], d['daily_calories'], d.get('registration_date', now), now
+            ))
+        logger.info(f"User {d['user_id']} saved")
 
     def save_meal(self, user_id: int, meal: Dict[str, Any]) -> None:
+        self.save_meals([(user_id, meal)])
+        logger.info(f"Meal for {user_id} saved")
+
+    def save_meals(self, meals: list[tuple[int, Dict[str, Any]]]) -> None:
+        """Несколько приёмов пищи одной транзакцией (один fsync на пачку)"""
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('''
+        rows = [
+            (
+                user_id, meal['food_name'], meal['calories'],
+                meal.get('protein'), meal.get('fat'), meal.get('carbs'),
+                meal['weight'], meal.get('date', now)
+            )
+            for user_id, meal in meals
+        ]
+        with self._write() as conn:
+            conn.executemany('''
             INSERT INTO meals (
                 user_id, food_name, calories, protein, fat, carbs, weight, date
             ) VALUES (?,?,?,?,?,?,?,?)
-            ''', (
-                user_id, meal['food_name'], meal['calories'],
-                meal.get('protein'), meal.get('fat'), meal.get('carbs'),
-                meal['weight'], now
-            ))
-            conn.commit()
-            logger.info(f"Meal for {user_id} saved")
+            ''', rows)
+            conn.executemany('''
+            INSERT INTO daily_totals (user_id, day, calories, protein, fat, carbs, meals)
+            VALUES (?, substr(?, 1, 10), ?, COALESCE(?,0), COALESCE(?,0), COALESCE(?,0), 1)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                calories = calories + excluded.calories,
+                protein  = protein + excluded.protein,
+                fat      = fat + excluded.fat,
+                carbs    = carbs + excluded.carbs,
+                meals    = meals + 1
+            ''', [(r[0], r[7], r[2], r[3], r[4], r[5]) for r in rows])
 
     def get_user_data(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            cols = [c[0] for c in cur.description]
-            return dict(zip(cols, row))
+        conn = self._get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cols = [c[0] for c in cur.description]
+        return dict(zip(cols, row))
+
+    def get_profile(self, user_id: int) -> Optional[UserProfile]:
+        row = self._get_connection().execute(PROFILE_SELECT, (user_id,)).fetchone()
+        return UserProfile._make(row) if row else None
+
+    def get_registered_users(self, shard: Optional[tuple[int, int]] = None) -> list[int]:
+        """user_id всех зарегистрированных; shard=(index, count) — только user_id % count == index"""
+        index, count = shard or (0, 1)
+        conn = self._get_connection()
+        return [uid for uid, in conn.execute(
+            "SELECT user_id FROM users WHERE user_id % ? = ?", (count, index))]
 
     def get_daily_nutrition(self, user_id: int, date: Optional[str] = None) -> Dict[str, float]:
         target = date or datetime.now().strftime('%Y-%m-%d')
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-            SELECT
-                COALESCE(SUM(calories),0),
-                COALESCE(SUM(protein),0),
-                COALESCE(SUM(fat),0),
-                COALESCE(SUM(carbs),0)
-            FROM meals
-            WHERE user_id=? AND date LIKE ?
-            ''', (user_id, f"{target}%"))
-            cal, p, f, c = cur.fetchone()
-            return {"calories": cal, "protein": p, "fat": f, "carbs": c}
+        conn = self._get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+        SELECT calories, protein, fat, carbs
+        FROM daily_totals
+        WHERE user_id=? AND day=?
+        ''', (user_id, target))
+        cal, p, f, c = cur.fetchone() or (0, 0, 0, 0)
+        return {"calories": cal, "protein": p, "fat": f, "carbs": c}
+
+    def get_period_nutrition(self, user_id: int, start: str, end: str) -> Dict[str, float]:
+        """Итоги за дни [start, end] включительно из daily_totals"""
+        conn = self._get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+        SELECT
+            COALESCE(SUM(calories),0),
+            COALESCE(SUM(protein),0),
+            COALESCE(SUM(fat),0),
+            COALESCE(SUM(carbs),0),
+            COUNT(*)
+        FROM daily_totals
+        WHERE user_id=? AND day BETWEEN ? AND ?
+        ''', (user_id, start, end))
+        cal, p, f, c, days = cur.fetchone()
+        return {
+            "start": start, "end": end, "days": days,
+            "calories": cal, "protein": p, "fat": f, "carbs": c,
+            "avg_calories": cal / days if days else 0,
+        }
+
+    def get_daily_totals(self, start: str, end: str, first_user: int,
+                         last_user: int) -> list[tuple]:
+        """(user_id, day, calories, protein, fat, carbs) за дни [start, end]
+        для user_id от first_user до last_user — один запрос по ключу daily_totals"""
+        conn = self._get_connection()
+        return conn.execute('''
+        SELECT user_id, day, calories, protein, fat, carbs
+        FROM daily_totals
+        WHERE user_id BETWEEN ? AND ? AND day BETWEEN ? AND ?
+        ''', (first_user, last_user, start, end)).fetchall()
+
+    def get_calorie_targets(self) -> list[tuple[int, Optional[float]]]:
+        """(user_id, daily_calories) всех пользователей по возрастанию user_id"""
+        conn = self._get_connection()
+        return conn.execute("SELECT user_id, daily_calories FROM users ORDER BY user_id").fetchall()
+
+    # ============ Рассылка сводок ============
+    def set_digest(self, user_id: int, digest_time: Optional[str], period: str = 'daily') -> bool:
+        """Время рассылки HH:MM или None, чтобы отключить; False, если пользователя нет"""
+        with self._write() as conn:
+            cur = conn.execute(
+                "UPDATE users SET digest_time=?, digest_period=? WHERE user_id=?",
+                (digest_time, period, user_id)
+            )
+        return cur.rowcount > 0
+
+    def get_due_digests(self, run_date: str, now: str, weekly: bool, after_user: int,
+                        limit: int, shard: Optional[tuple[int, int]] = None) -> list[tuple]:
+        """(user_id, digest_period, daily_calories) тех, кому пора отправить сводку
+        и кому её ещё не отправляли за run_date; по возрастанию user_id после after_user"""
+        index, count = shard or (0, 1)
+        conn = self._get_connection()
+        return conn.execute('''
+        SELECT u.user_id, COALESCE(u.digest_period, 'daily'), u.daily_calories
+        FROM users u
+        WHERE u.user_id > ? AND u.digest_time IS NOT NULL AND u.digest_time <= ?
+          AND (COALESCE(u.digest_period, 'daily') = 'daily' OR ?)
+          AND u.user_id % ? = ?
+          AND NOT EXISTS (SELECT 1 FROM digest_runs r WHERE r.user_id = u.user_id AND r.run_date = ?)
+        ORDER BY u.user_id
+        LIMIT ?
+        ''', (after_user, now, weekly, count, index, run_date, limit)).fetchall()
+
+    def save_digest_results(self, run_date: str, results: list[tuple[int, str, int]]) -> None:
+        """(user_id, status, attempts) одной транзакцией"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._write() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO digest_runs VALUES (?,?,?,?,?)",
+                [(user_id, run_date, status, attempts, now) for user_id, status, attempts in results]
+            )
+
+    def get_weekly_summary(self, user_id: int, date: Optional[str] = None) -> Dict[str, float]:
+        """Последние 7 дней, заканчивая date (по умолчанию сегодня)"""
+        end = datetime.strptime(date, '%Y-%m-%d') if date else datetime.now()
+        start = end - timedelta(days=6)
+        return self.get_period_nutrition(user_id, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+
+    def get_monthly_summary(self, user_id: int, month: Optional[str] = None) -> Dict[str, float]:
+        """Календарный месяц 'YYYY-MM' (по умолчанию текущий)"""
+        month = month or datetime.now().strftime('%Y-%m')
+        return self.get_period_nutrition(user_id, f"{month}-01", f"{month}-31")
+
+    def rebuild_daily_totals(self) -> int:
+        """Пересобирает daily_totals из meals, возвращает число дней"""
+        with self._write() as conn:
+            conn.execute("DELETE FROM daily_totals")
+            conn.execute(f"INSERT INTO daily_totals {ROLLUP_SELECT}")
+            count = conn.execute("SELECT COUNT(*) FROM daily_totals").fetchone()[0]
+        logger.info(f"daily_totals rebuilt: {count} rows")
+        return count
+
+    def verify_daily_totals(self, tolerance: float = 1e-6) -> list[tuple[int, str]]:
+        """(user_id, day), для которых daily_totals расходится с meals"""
+        conn = self._get_connection()
+        cur = conn.cursor()
+        cur.execute(f'''
+        WITH expected(user_id, day, calories, protein, fat, carbs, meals) AS ({ROLLUP_SELECT})
+        SELECT e.user_id, e.day FROM expected e
+        LEFT JOIN daily_totals t ON t.user_id = e.user_id AND t.day = e.day
+        WHERE t.user_id IS NULL OR t.meals != e.meals
+           OR abs(t.calories - e.calories) > :tol OR abs(t.protein - e.protein) > :tol
+           OR abs(t.fat - e.fat) > :tol OR abs(t.carbs - e.carbs) > :tol
+        UNION
+        SELECT t.user_id, t.day FROM daily_totals t
+        LEFT JOIN expected e ON t.user_id = e.user_id AND t.day = e.day
+        WHERE e.user_id IS NULL
+        ''', {"tol": tolerance})
+        return cur.fetchall()
 
     def get_user_meals(self, user_id: int, limit: int = 10) -> list[Dict[str, Any]]:
-        with self._get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-            SELECT food_name, calories, weight, date
-            FROM meals
-            WHERE user_id=?
-            ORDER BY date DESC
-            LIMIT ?
-            ''', (user_id, limit))
-            cols = [c[0] for c in cur.description]
-            return [dict(zip(cols, row)) for row in cur.fetchall()]
+        conn = self._get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+        SELECT food_name, calories, weight, date
+        FROM meals
+        WHERE user_id=?
+        ORDER BY date DESC
+        LIMIT ?
+        ''', (user_id, limit))
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    # ============ Выгрузка и загрузка ============
+    def iter_meals(self, user_id: Optional[int] = None,
+                   chunk_size: int = 5000) -> Iterator[list[tuple]]:
+        """Все приёмы пищи пачками по chunk_size строк (столбцы MEAL_COLUMNS).
+
+        Каждая пачка — отдельный короткий запрос с продолжением по meal_id,
+        поэтому долгая выгрузка не держит открытую транзакцию чтения. История
+        одного пользователя читается по индексу (user_id, meal_id), без сортировки.
+        """
+        conn = self._get_connection()
+        where = "AND user_id=?" if user_id is not None else ""
+        last_id = 0
+        while True:
+            params = (last_id, user_id, chunk_size) if user_id is not None else (last_id, chunk_size)
+            rows = conn.execute(
+                f"SELECT {', '.join(MEAL_COLUMNS)} FROM meals "
+                f"WHERE meal_id > ? {where} ORDER BY meal_id LIMIT ?", params
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def iter_users(self, chunk_size: int = 5000) -> Iterator[list[tuple]]:
+        """Все пользователи пачками по chunk_size строк (столбцы USER_COLUMNS)"""
+        conn = self._get_connection()
+        last_id = None
+        while True:
+            rows = conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users "
+                f"WHERE ? IS NULL OR user_id > ? ORDER BY user_id LIMIT ?",
+                (last_id, last_id, chunk_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def save_users(self, users: list[Dict[str, Any]]) -> None:
+        """Пакетная запись пользователей как есть (импорт), одной транзакцией"""
+        rows = [tuple(user.get(col) for col in USER_COLUMNS) for user in users]
+        with self._write() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(USER_COLUMNS))})", rows
+            )
+
+
+class MealWriteQueue:
+    """Отложенная групповая запись приёмов пищи.
+
+    Строки от разных пользователей копятся и пишутся одним executemany
+    в одной транзакции, когда набирается max_batch строк или проходит
+    max_delay секунд с первой строки в пачке.
+
+    durability:
+        'commit'   — save_meal ждёт коммита своей пачки (ничего не теряется);
+        'buffered' — save_meal возвращается сразу, при падении процесса
+                     теряется не более одной неподтверждённой пачки.
+    """
+
+    DURABILITY_MODES = ('commit', 'buffered')
+
+    def __init__(self, write_batch, max_batch: int = 200, max_delay: float = 0.05,
+                 durability: str = 'commit'):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self._write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self._pending: list[tuple[tuple[int, Dict[str, Any]], Optional[asyncio.Future]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {
+            "batches": 0,
+            "rows": 0,
+            "max_batch_size": 0,
+            "flush_seconds_total": 0.0,
+            "flush_seconds_max": 0.0,
+            "errors": 0,
+        }
+
+    async def put(self, user_id: int, meal: Dict[str, Any]) -> None:
+        loop = asyncio.get_running_loop()
+        # время приёма пищи фиксируем в момент запроса, а не записи
+        meal = {**meal, 'date': meal.get('date') or datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        fut = loop.create_future() if self.durability == 'commit' else None
+        self._pending.append(((user_id, meal), fut))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        if fut is not None:
+            await fut
+
+    def _start_flush(self) -> None:
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        # пачки пишутся строго по очереди, чтобы сохранить порядок
+        async with self._flush_lock:
+            t0 = time.perf_counter()
+            try:
+                await self._write_batch([row for row, _ in batch])
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Meal batch of {len(batch)} failed: {e}")
+                for _, fut in batch:
+                    if fut is not None and not fut.done():
+                        fut.set_exception(e)
+                return
+            elapsed = time.perf_counter() - t0
+
+        self.stats["batches"] += 1
+        self.stats["rows"] += len(batch)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+        self.stats["flush_seconds_total"] += elapsed
+        self.stats["flush_seconds_max"] = max(self.stats["flush_seconds_max"], elapsed)
+        for _, fut in batch:
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+
+    async def close(self) -> None:
+        """Дописывает всё накопленное, включая уже запущенные сбросы"""
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def summary(self) -> Dict[str, float]:
+        batches = self.stats["batches"] or 1
+        return {
+            **self.stats,
+            "avg_batch_size": self.stats["rows"] / batches,
+            "avg_flush_ms": self.stats["flush_seconds_total"] / batches * 1000,
+        }
+
+
+class ProfileCache:
+    """Профили пользователей в памяти процесса.
+
+    registered — множество зарегистрированных user_id, загружается из
+    users одним запросом при старте (load_profiles) и пополняется при
+    сохранении. Сами профили кэшируются по первому чтению и вытесняются
+    сверх max_size; запись через AsyncDatabase.save_user_data сбрасывает
+    запись кэша. Запись в users в обход AsyncDatabase (импорт, второй
+    процесс с тем же пользователем) кэш не видит.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.registered: set[int] = set()
+        self._profiles: OrderedDict[int, UserProfile] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._profiles.move_to_end(user_id)
+        return profile
+
+    def put(self, profile: UserProfile) -> None:
+        self._profiles[profile.user_id] = profile
+        self._profiles.move_to_end(profile.user_id)
+        self.registered.add(profile.user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._profiles.pop(user_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "registered": len(self.registered),
+            "cached": len(self._profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class AsyncDatabase:
+    """Неблокирующий доступ к Database из обработчиков бота.
+
+    Все записи выполняются одним потоком-писателем (SQLite всё равно
+    допускает только одного писателя), чтения — пулом потоков,
+    у каждого из которых своё соединение.
+
+    meal_batching=True включает групповую запись save_meal через
+    MealWriteQueue, параметры очереди передаются в meal_queue_options.
+    """
+
+    def __init__(self, db: Database, readers: int = 4, meal_batching: bool = False,
+                 profile_cache_size: int = 10000, **meal_queue_options):
+        self.db = db
+        self.profiles = ProfileCache(profile_cache_size)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self.meal_queue: Optional[MealWriteQueue] = None
+        if meal_batching:
+            self.meal_queue = MealWriteQueue(self.save_meals, **meal_queue_options)
+
+    async def _run(self, executor: ThreadPoolExecutor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with REGISTRY.track("db", func.__name__):
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    async def save_user_data(self, d: Dict[str, Any]) -> None:
+        await self._run(self._writer, self.db.save_user_data, d)
+        # после коммита: следующее чтение возьмёт профиль из базы
+        self.profiles.invalidate(d['user_id'])
+        self.profiles.registered.add(d['user_id'])
+
+    async def save_meal(self, user_id: int, meal: Dict[str, Any]) -> None:
+        if self.meal_queue is not None:
+            with REGISTRY.track("db", "save_meal_queued"):
+                await self.meal_queue.put(user_id, meal)
+        else:
+            await self._run(self._writer, self.db.save_meal, user_id, meal)
+
+    async def save_meals(self, meals: list[tuple[int, Dict[str, Any]]]) -> None:
+        await self._run(self._writer, self.db.save_meals, meals)
+
+    async def get_user_data(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(self._readers, self.db.get_user_data, user_id)
+
+    async def get_profile(self, user_id: int) -> Optional[UserProfile]:
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            profile = await self._run(self._readers, self.db.get_profile, user_id)
+            if profile is not None:
+                self.profiles.put(profile)
+        return profile
+
+    def is_registered(self, user_id: int) -> bool:
+        return user_id in self.profiles.registered
+
+    async def load_profiles(self, shard: Optional[tuple[int, int]] = None) -> int:
+        """Состояние регистрации из users, вызывается при старте"""
+        users = await self._run(self._readers, self.db.get_registered_users, shard)
+        self.profiles.registered.update(users)
+        logger.info(f"Loaded {len(users)} registered users")
+        return len(users)
+
+    async def get_daily_nutrition(self, user_id: int, date: Optional[str] = None) -> Dict[str, float]:
+        return await self._run(self._readers, self.db.get_daily_nutrition, user_id, date)
+
+    async def get_user_meals(self, user_id: int, limit: int = 10) -> list[Dict[str, Any]]:
+        return await self._run(self._readers, self.db.get_user_meals, user_id, limit)
+
+    async def get_weekly_summary(self, user_id: int, date: Optional[str] = None) -> Dict[str, float]:
+        return await self._run(self._readers, self.db.get_weekly_summary, user_id, date)
+
+    async def get_monthly_summary(self, user_id: int, month: Optional[str] = None) -> Dict[str, float]:
+        return await self._run(self._readers, self.db.get_monthly_summary, user_id, month)
+
+    async def read(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Блокирующее чтение func(db, ...) в пуле читателей: отчёты analytics, выгрузка export"""
+        return await self._run(self._readers, func, self.db, *args, **kwargs)
+
+    # ============ Рассылка сводок ============
+    async def set_digest(self, user_id: int, digest_time: Optional[str], period: str = 'daily') -> bool:
+        return await self._run(self._writer, self.db.set_digest, user_id, digest_time, period)
+
+    async def get_due_digests(self, run_date: str, now: str, weekly: bool, after_user: int,
+                              limit: int, shard: Optional[tuple[int, int]] = None) -> list[tuple]:
+        return await self._run(self._readers, self.db.get_due_digests, run_date, now, weekly,
+                               after_user, limit, shard)
+
+    async def save_digest_results(self, run_date: str, results: list[tuple[int, str, int]]) -> None:
+        await self._run(self._writer, self.db.save_digest_results, run_date, results)
+
+    async def flush(self) -> None:
+        if self.meal_queue is not None:
+            await self.meal_queue.close()
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Обслуживание базы бота")
+    parser.add_argument('command', choices=['migrate', 'rebuild-rollup', 'verify-rollup'])
+    parser.add_argument('--db', default='fitness_bot.db')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'migrate':
+        # миграции применяются при открытии базы
+        Database(args.db).close()
+    elif args.command == 'rebuild-rollup':
+        db = Database(args.db)
+        db.rebuild_daily_totals()
+        db.close()
+    elif args.command == 'verify-rollup':
+        db = Database(args.db)
+        drift = db.verify_daily_totals()
+        db.close()
+        for user_id, day in drift:
+            print(f"drift: user {user_id} day {day}")
+        print(f"{len(drift)} rows drifted" if drift else "daily_totals OK")
+        raise SystemExit(1 if drift else 0)
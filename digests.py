@@ -0,0 +1,212 @@
+# digests.py
+
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from analytics import reports_for_users
+from database import AsyncDatabase
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SendLimiter:
+    """Лимиты Telegram на рассылку: общий темп и интервал между сообщениями в один чат"""
+
+    def __init__(self, global_rate: float = 25.0, per_chat_interval: float = 1.0):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._next_in_chat: dict[int, float] = {}
+
+    async def acquire(self, chat_id: int) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_in_chat.get(chat_id, 0.0))
+        self._next_in_chat[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+
+    def forget(self, chat_id: int) -> None:
+        self._next_in_chat.pop(chat_id, None)
+
+
+def digest_text(period: str, r: dict[str, Any]) -> str:
+    if period == 'weekly':
+        lines = [f"📅 Итоги недели {r['start']} — {r['end']}"]
+        if not r["logged_days"]:
+            return lines[0] + "\nЗа неделю нет записей о питании. Самое время начать!"
+        lines.append(f"• В среднем {r['avg_calories']:.0f} ккал/день, записи за {r['logged_days']} дн.")
+        if r["avg_balance"] is not None:
+            sign = "профицит" if r["avg_balance"] > 0 else "дефицит"
+            lines.append(f"• Норма {r['target']:.0f} ккал: {sign} {abs(r['avg_balance']):.0f} ккал/день")
+        if r["protein_pct"] is not None:
+            lines.append(f"• Б/Ж/У: {r['protein_pct']:.0f}% / {r['fat_pct']:.0f}% / {r['carbs_pct']:.0f}%")
+        return "\n".join(lines)
+
+    lines = [f"🌙 Итоги дня {r['end']}"]
+    if r["last_day_calories"] is None:
+        lines.append("• Сегодня записей нет")
+    elif r["target"] is not None:
+        lines.append(f"• Сегодня {r['last_day_calories']:.0f} из {r['target']:.0f} ккал")
+    else:
+        lines.append(f"• Сегодня {r['last_day_calories']:.0f} ккал")
+    if r["rolling_7d"] is not None:
+        lines.append(f"• В среднем за 7 дней: {r['rolling_7d']:.0f} ккал/день")
+    lines.append(f"• Записи подряд: {r['logging_streak']} дн.")
+    return "\n".join(lines)
+
+
+class DigestScheduler:
+    """Рассылка сводок в выбранное пользователем время.
+
+    Раз в interval секунд выбирает пользователей, у которых наступило
+    digest_time и которым сегодня ещё ничего не отправлено, пачками по
+    chunk_size. Для пачки сводки считаются одним запросом (analytics),
+    отправка идёт параллельно через SendLimiter, результаты пачки
+    пишутся в digest_runs одной транзакцией. После падения рассылка
+    продолжается с неотмеченных пользователей; повторно может уйти не
+    больше одной пачки.
+    """
+
+    def __init__(self, db: AsyncDatabase, bot, send_recipe: Optional[Callable[[Any, int], Awaitable[Any]]] = None,
+                 limiter: Optional[SendLimiter] = None, chunk_size: int = 200, concurrency: int = 20,
+                 max_attempts: int = 4, backoff: float = 1.0, weekly_day: int = 0,
+                 shard: Optional[tuple[int, int]] = None):
+        self.db = db
+        self.bot = bot
+        self.send_recipe = send_recipe
+        self.limiter = limiter or SendLimiter()
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.weekly_day = weekly_day  # 0 — понедельник
+        self.shard = shard
+        self.stats = {"runs": 0, "sent": 0, "failed": 0, "blocked": 0, "retries": 0,
+                      "last_run_seconds": 0.0, "last_run_rate": 0.0}
+
+    async def run(self, interval: float = 60.0) -> None:
+        """Фоновая задача"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Digest run failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now()
+        run_date, clock = now.strftime('%Y-%m-%d'), now.strftime('%H:%M')
+        weekly = now.weekday() == self.weekly_day
+        started, sent, after = time.perf_counter(), 0, 0
+        while True:
+            due = await self.db.get_due_digests(run_date, clock, weekly, after, self.chunk_size, self.shard)
+            if not due:
+                break
+            after = due[-1][0]
+            results = await self._send_chunk(due, run_date)
+            await self.db.save_digest_results(run_date, results)
+            sent += sum(1 for _, status, _ in results if status == 'sent')
+
+        if sent:
+            elapsed = time.perf_counter() - started
+            self.stats["runs"] += 1
+            self.stats["last_run_seconds"] = elapsed
+            self.stats["last_run_rate"] = sent / elapsed
+            logger.info(f"Digests {run_date} {clock}: {sent} sent in {elapsed:.1f}s ({sent / elapsed:.1f}/s)")
+        return sent
+
+    async def _send_chunk(self, due: list[tuple], run_date: str) -> list[tuple[int, str, int]]:
+        by_period: dict[str, list[tuple[int, Optional[float]]]] = {}
+        for user_id, period, target in due:
+            by_period.setdefault(period, []).append((user_id, target))
+        texts: dict[int, str] = {}
+        for period, users in by_period.items():
+            days = 7 if period == 'weekly' else 30
+            reports = await self.db.read(reports_for_users, users, days, run_date)
+            for r in reports:
+                texts[r["user_id"]] = digest_text(period, r)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id: int) -> tuple[int, str, int]:
+            async with semaphore:
+                status, attempts = await self._deliver(user_id, texts[user_id])
+            self.limiter.forget(user_id)
+            self.stats[status] += 1
+            REGISTRY.inc("digests_total", status=status)
+            return user_id, status, attempts
+
+        return await asyncio.gather(*(deliver(user_id) for user_id, _, _ in due))
+
+    async def _deliver(self, chat_id: int, text: str) -> tuple[str, int]:
+        """Статус (sent, failed, blocked) и число попыток.
+
+        Текст и рецепт повторяются по отдельности: сбой на картинке не
+        отправляет текст второй раз. Сводка с дошедшим текстом считается
+        отправленной, даже если рецепт так и не ушёл.
+        """
+        status, attempts = await self._send_step(
+            chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text))
+        if status != 'sent' or self.send_recipe is None:
+            return status, attempts
+        recipe_status, recipe_attempts = await self._send_step(
+            chat_id, lambda: self.send_recipe(self.bot, chat_id))
+        if recipe_status == 'failed':
+            logger.warning(f"Digest for {chat_id} sent without recipe")
+            recipe_status = 'sent'
+        return recipe_status, attempts + recipe_attempts
+
+    async def _send_step(self, chat_id: int, send: Callable[[], Awaitable[Any]]) -> tuple[str, int]:
+        """Одно сообщение с повторами: статус (sent, failed, blocked) и число попыток"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with REGISTRY.track("digest", "send"):
+                    await self.limiter.acquire(chat_id)
+                    await send()
+                return 'sent', attempt
+            except Forbidden:
+                # пользователь заблокировал бота: рассылку ему выключаем
+                await self.db.set_digest(chat_id, None)
+                return 'blocked', attempt
+            except RetryAfter as e:
+                delay = float(e.retry_after.total_seconds()
+                              if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+            except BadRequest as e:
+                logger.error(f"Digest message for {chat_id} rejected: {e}")
+                return 'failed', attempt
+            except NetworkError as e:
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.warning(f"Digest message for {chat_id} failed ({e}), retry in {delay:.1f}s")
+            if attempt < self.max_attempts:
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+        return 'failed', self.max_attempts
@@ -0,0 +1,207 @@
+# export.py
+
+import csv
+import logging
+import os
+from typing import Any, Iterable, Iterator, Optional
+
+from database import Database, MEAL_COLUMNS, USER_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # без pyarrow доступен только CSV
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+
+# типы столбцов для Arrow/Parquet; остальное — строки
+FLOAT_COLUMNS = {'calories', 'protein', 'fat', 'carbs', 'weight', 'height', 'bmr', 'daily_calories'}
+INT_COLUMNS = {'meal_id', 'user_id', 'age'}
+
+TABLES = {
+    'meals': MEAL_COLUMNS,
+    'users': USER_COLUMNS,
+}
+
+FORMATS = ('csv', 'parquet', 'arrow')  # формат совпадает с расширением файла
+
+
+def available_formats() -> tuple[str, ...]:
+    return FORMATS if pa is not None else ('csv',)
+
+
+def guess_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext in FORMATS:
+        return ext
+    raise ValueError(f"Не удалось определить формат по имени файла: {path}")
+
+
+def _check_format(fmt: str) -> None:
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    if fmt not in available_formats():
+        raise RuntimeError(f"Для формата {fmt} нужен pyarrow (pip install pyarrow)")
+
+
+def _schema(columns: tuple[str, ...]):
+    def arrow_type(col: str):
+        if col in INT_COLUMNS:
+            return pa.int64()
+        if col in FLOAT_COLUMNS:
+            return pa.float64()
+        return pa.string()
+    return pa.schema([(col, arrow_type(col)) for col in columns])
+
+
+def _record_batch(schema, columns: tuple[str, ...], rows: list[tuple]):
+    return pa.RecordBatch.from_arrays(
+        [pa.array([row[i] for row in rows], type=schema.field(i).type) for i in range(len(columns))],
+        schema=schema,
+    )
+
+
+# ============ Экспорт ============
+def table_chunks(db: Database, table: str, user_id: Optional[int] = None,
+                 chunk_size: int = CHUNK_SIZE) -> Iterator[list[tuple]]:
+    if table == 'meals':
+        return db.iter_meals(user_id, chunk_size)
+    if table == 'users':
+        if user_id is not None:
+            raise ValueError("Выгрузка users по одному пользователю не поддерживается")
+        return db.iter_users(chunk_size)
+    raise ValueError(f"Неизвестная таблица: {table}")
+
+
+def write_chunks(path: str, fmt: str, columns: tuple[str, ...],
+                 chunks: Iterable[list[tuple]]) -> int:
+    """Пишет пачки строк в файл, в памяти одновременно не больше одной пачки"""
+    _check_format(fmt)
+    rows = 0
+    if fmt == 'csv':
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for chunk in chunks:
+                writer.writerows(chunk)
+                rows += len(chunk)
+        return rows
+
+    schema = _schema(columns)
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(path, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        for chunk in chunks:
+            writer.write_batch(_record_batch(schema, columns, chunk))
+            rows += len(chunk)
+    finally:
+        writer.close()
+    return rows
+
+
+def export_table(db: Database, table: str, path: str, fmt: Optional[str] = None,
+                 user_id: Optional[int] = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """Выгрузка таблицы (или истории одного пользователя) в файл, возвращает число строк.
+
+    Блокирующая функция: из event loop вызывать через asyncio.to_thread.
+    """
+    fmt = fmt or guess_format(path)
+    rows = write_chunks(path, fmt, TABLES[table], table_chunks(db, table, user_id, chunk_size))
+    logger.info(f"Exported {rows} {table} rows to {path}")
+    return rows
+
+
+# ============ Импорт ============
+def read_chunks(path: str, fmt: Optional[str] = None,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[list[dict[str, Any]]]:
+    """Строки файла пачками словарей по chunk_size"""
+    fmt = fmt or guess_format(path)
+    _check_format(fmt)
+    if fmt == 'csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            chunk = []
+            for row in csv.DictReader(f):
+                chunk.append({k: (v if v != '' else None) for k, v in row.items()})
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        return
+
+    if fmt == 'parquet':
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size)
+    else:
+        reader = pa.ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        yield batch.to_pylist()
+
+
+def _meal(row: dict[str, Any]) -> dict[str, Any]:
+    # CSV отдаёт строки: приводим числа, meal_id назначит база
+    meal = {'food_name': row['food_name'], 'date': row['date'],
+            'calories': float(row['calories']), 'weight': float(row['weight'])}
+    for col in ('protein', 'fat', 'carbs'):
+        meal[col] = float(row[col]) if row.get(col) is not None else None
+    return meal
+
+
+def _user(row: dict[str, Any]) -> dict[str, Any]:
+    user = dict(row)
+    for col in INT_COLUMNS & user.keys():
+        if user[col] is not None:
+            user[col] = int(user[col])
+    for col in FLOAT_COLUMNS & user.keys():
+        if user[col] is not None:
+            user[col] = float(user[col])
+    return user
+
+
+def import_table(db: Database, table: str, path: str, fmt: Optional[str] = None,
+                 chunk_size: int = CHUNK_SIZE) -> int:
+    """Пакетная загрузка из файла: одна транзакция на пачку, возвращает число строк.
+
+    Приёмы пищи получают новые meal_id, daily_totals обновляется вместе с ними.
+    """
+    rows = 0
+    for chunk in read_chunks(path, fmt, chunk_size):
+        if table == 'meals':
+            db.save_meals([(int(row['user_id']), _meal(row)) for row in chunk])
+        elif table == 'users':
+            db.save_users([_user(row) for row in chunk])
+        else:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        rows += len(chunk)
+    logger.info(f"Imported {rows} {table} rows from {path}")
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка истории питания")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help="файл .csv, .parquet или .arrow")
+    parser.add_argument('--db', default='fitness_bot.db')
+    parser.add_argument('--table', choices=sorted(TABLES), default='meals')
+    parser.add_argument('--format', choices=FORMATS, help="по умолчанию — по расширению")
+    parser.add_argument('--user', type=int, help="только история этого пользователя (export meals)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    database = Database(args.db)
+    try:
+        if args.command == 'export':
+            export_table(database, args.table, args.path, args.format, args.user, args.chunk_size)
+        else:
+            import_table(database, args.table, args.path, args.format, args.chunk_size)
+    finally:
+        database.close()
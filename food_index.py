@@ -0,0 +1,226 @@
+# food_index.py
+"""Локальный индекс продуктов с нечётким поиском по триграммам.
+
+    python food_index.py build --csv foods.csv --from-cache fitness_bot.db -o food_index.json
+    python food_index.py search "гречк"
+
+CSV: name,calories,protein,fat,carbs (на 100 г). JSON: список объектов
+с теми же полями или с food_name/food_description как у FatSecret.
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import logging
+import sqlite3
+import time
+from array import array
+from collections import Counter, defaultdict
+from typing import Iterable, NamedTuple, Optional
+
+from cache import normalized_trigrams, normalize_query, trigrams
+from nutrition import parse_food_description, search_results
+
+logger = logging.getLogger(__name__)
+
+FORMAT_NAME = "fito-food-index"
+FORMAT_VERSION = 1
+CANDIDATES_PER_RESULT = 8
+
+
+class FoodMatch(NamedTuple):
+    score: float
+    food: dict
+
+
+def describe_per_100g(calories: float, protein: float, fat: float, carbs: float) -> str:
+    """Описание в формате FatSecret, чтобы локальные записи не отличались от удалённых"""
+    return (f"Per 100g - Calories: {calories:g}kcal | Fat: {fat:.2f}g | "
+            f"Carbs: {carbs:.2f}g | Protein: {protein:.2f}g")
+
+
+class FoodIndex:
+    """Индекс в памяти: имена и описания в списках, постинги триграмм в array('I')"""
+
+    def __init__(self, names: list[str], descriptions: list[str]):
+        self.names = names
+        self.descriptions = descriptions
+        self._sizes = array('H')
+        postings: dict[str, list[int]] = defaultdict(list)
+        for food_id, name in enumerate(names):
+            grams = trigrams(name)
+            self._sizes.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                postings[gram].append(food_id)
+        self._postings = {gram: array('I', ids) for gram, ids in postings.items()}
+        self._normalized = [normalize_query(name) for name in names]
+        # КБЖУ разбираются один раз при загрузке, а не на каждый запрос
+        self._macros = [parse_food_description(desc) for desc in descriptions]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def search(self, query: str, k: int = 5) -> list[FoodMatch]:
+        """Топ-k по коэффициенту Жаккара триграмм, с бонусом за совпадение префикса"""
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        # Имя, разделяющее с запросом хотя бы половину триграмм, обязано
+        # встретиться в одном из (n - n/2 + 1) самых редких постингов, поэтому
+        # частые триграммы можно не обходить. Counter.update считает в C.
+        ranked = sorted(query_grams, key=lambda gram: len(self._postings.get(gram, ())))
+        shared = Counter()
+        for gram in ranked[:len(ranked) - (len(ranked) + 1) // 2 + 1]:
+            postings = self._postings.get(gram)
+            if postings is not None:
+                shared.update(postings)
+
+        prefix = normalize_query(query)
+
+        def score(food_id: int) -> float:
+            common = len(query_grams & normalized_trigrams(self._normalized[food_id]))
+            jaccard = common / (len(query_grams) + self._sizes[food_id] - common)
+            if self._normalized[food_id].startswith(prefix):
+                jaccard = min(1.0, jaccard + 0.3)
+            return jaccard
+
+        # точный скор считаем только для лидеров по числу общих редких триграмм
+        scored = [(score(food_id), food_id)
+                  for food_id, _ in shared.most_common(k * CANDIDATES_PER_RESULT)]
+        best = heapq.nlargest(k, scored)
+        return [FoodMatch(value, self.food(food_id)) for value, food_id in best]
+
+    def food(self, food_id: int) -> dict:
+        return {
+            "food_id": f"local-{food_id}",
+            "food_name": self.names[food_id],
+            "food_description": self.descriptions[food_id],
+            "macros": list(self._macros[food_id]) if self._macros[food_id] else None,
+        }
+
+    # ============ Формат на диске ============
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format": FORMAT_NAME,
+                "version": FORMAT_VERSION,
+                "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "names": self.names,
+                "descriptions": self.descriptions,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "FoodIndex":
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+        if payload.get("format") != FORMAT_NAME:
+            raise ValueError(f"{path} is not a food index")
+        if payload.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported food index version {payload.get('version')}, "
+                             f"expected {FORMAT_VERSION}; rebuild it with food_index.py build")
+        return cls(payload["names"], payload["descriptions"])
+
+    @classmethod
+    def build(cls, foods: Iterable[dict]) -> "FoodIndex":
+        names, descriptions, seen = [], [], set()
+        for food in foods:
+            key = normalize_query(food["food_name"])
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            names.append(food["food_name"])
+            descriptions.append(food["food_description"])
+        return cls(names, descriptions)
+
+
+# ============ Источники данных ============
+def _table_row_to_food(row: dict) -> Optional[dict]:
+    if "food_description" in row:
+        return {"food_name": row["food_name"], "food_description": row["food_description"]}
+    try:
+        return {
+            "food_name": row["name"].strip(),
+            "food_description": describe_per_100g(
+                float(row["calories"]), float(row.get("protein") or 0),
+                float(row.get("fat") or 0), float(row.get("carbs") or 0)
+            ),
+        }
+    except (KeyError, ValueError) as e:
+        logger.warning(f"Skipping food row {row}: {e}")
+        return None
+
+
+def read_csv(path: str) -> Iterable[dict]:
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            food = _table_row_to_food(row)
+            if food:
+                yield food
+
+
+def read_json(path: str) -> Iterable[dict]:
+    with open(path, encoding="utf-8") as f:
+        for row in json.load(f):
+            food = _table_row_to_food(row)
+            if food:
+                yield food
+
+
+def read_fatsecret_cache(db_name: str) -> Iterable[dict]:
+    """Продукты из закэшированных ответов FatSecret (таблица cache_entries)"""
+    conn = sqlite3.connect(db_name)
+    try:
+        rows = conn.execute("SELECT value FROM cache_entries WHERE namespace='fatsecret'").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        conn.close()
+    for (value,) in rows:
+        for food in search_results(json.loads(value)):
+            if "food_description" in food:
+                yield {"food_name": food["food_name"], "food_description": food["food_description"]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="собрать индекс")
+    p.add_argument("--csv", action="append", default=[])
+    p.add_argument("--json", action="append", default=[])
+    p.add_argument("--from-cache", metavar="DB", help="добавить закэшированные ответы FatSecret")
+    p.add_argument("-o", "--output", default="food_index.json")
+
+    p = sub.add_parser("search", help="поиск по готовому индексу")
+    p.add_argument("query")
+    p.add_argument("-k", type=int, default=5)
+    p.add_argument("--index", default="food_index.json")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "build":
+        def sources():
+            for path in args.csv:
+                yield from read_csv(path)
+            for path in args.json:
+                yield from read_json(path)
+            if args.from_cache:
+                yield from read_fatsecret_cache(args.from_cache)
+
+        index = FoodIndex.build(sources())
+        index.save(args.output)
+        print(f"{len(index)} продуктов записано в {args.output}")
+    else:
+        index = FoodIndex.load(args.index)
+        t0 = time.perf_counter()
+        matches = index.search(args.query, k=args.k)
+        elapsed = (time.perf_counter() - t0) * 1000
+        for match in matches:
+            print(f"{match.score:.2f}  {match.food['food_name']}  ({match.food['food_description']})")
+        print(f"{elapsed:.3f} мс")
+
+
+if __name__ == "__main__":
+    main()
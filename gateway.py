@@ -0,0 +1,316 @@
+# gateway.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class UpstreamUnavailable(Exception):
+    """Запрос не отправлялся: автомат разомкнут или заняты все слоты"""
+
+
+class AdaptiveTimeout:
+    """Таймаут по недавним задержкам: quantile × multiplier в пределах [minimum, maximum].
+
+    Пока замеров меньше min_samples, действует maximum.
+    """
+
+    def __init__(self, minimum: float, maximum: float, quantile: float = 0.99,
+                 multiplier: float = 2.0, window: int = 200, min_samples: int = 20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        if len(self._samples) < self.min_samples:
+            return self.maximum
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def current(self) -> float:
+        if len(self._samples) < self.min_samples:
+            return self.maximum
+        return min(self.maximum, max(self.minimum, self.percentile(self.quantile) * self.multiplier))
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд.
+
+    Через reset_timeout секунд пропускает один пробный запрос
+    (half-open): успех замыкает автомат, ошибка снова размыкает.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+
+    @property
+    def available(self) -> bool:
+        """Пропустит ли автомат запрос сейчас (без занятия пробного слота)"""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not (self.state == self.HALF_OPEN and self._probing)
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def cancel(self) -> None:
+        """Пропущенный запрос так и не ушёл в сервис: пробный слот свободен"""
+        self._probing = False
+
+    def success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        self.state = self.CLOSED
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def is_upstream_fault(error: BaseException) -> bool:
+    """Таймауты, сетевые ошибки, 5xx и 429 — сбой сервиса; прочие 4xx — ошибка запроса"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError))
+
+
+class Upstream:
+    """Шлюз к внешнему сервису: слоты, адаптивные таймауты, автомат и хеджирование.
+
+    Не больше max_concurrent запросов одновременно; кто не дождался
+    слота за queue_timeout секунд, получает UpstreamUnavailable, как и
+    все вызовы при разомкнутом автомате. Таймаут считается отдельно
+    для каждой операции op по её недавним задержкам.
+
+    call(hedge=True) — для идемпотентных запросов: если ответа нет
+    дольше hedge_quantile обычной задержки или попытка упала, уходит
+    ещё одна (всего до hedge_attempts), побеждает первый успешный ответ.
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 10, min_timeout: float = 1.0,
+                 max_timeout: float = 10.0, queue_timeout: float = 1.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 hedge_quantile: float = 0.95, hedge_attempts: int = 2):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.queue_timeout = queue_timeout
+        self.hedge_quantile = hedge_quantile
+        self.hedge_attempts = hedge_attempts
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.timeouts: dict[str, AdaptiveTimeout] = {}
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.stats_counters = {"calls": 0, "failures": 0, "timeouts": 0, "rejected": 0, "hedged": 0}
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.available
+
+    def timeout(self, op: str) -> AdaptiveTimeout:
+        timeout = self.timeouts.get(op)
+        if timeout is None:
+            timeout = self.timeouts[op] = AdaptiveTimeout(self.min_timeout, self.max_timeout)
+        return timeout
+
+    def _reject(self, reason: str) -> UpstreamUnavailable:
+        self.stats_counters["rejected"] += 1
+        REGISTRY.inc("upstream_rejected_total", upstream=self.name, reason=reason)
+        return UpstreamUnavailable(f"{self.name}: {reason}")
+
+    async def _acquire(self) -> None:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._reject("busy") from None
+        self.in_flight += 1
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._slots.release()
+
+    def _record(self, error: Optional[BaseException]) -> None:
+        if error is None:
+            self.breaker.success()
+            return
+        if isinstance(error, asyncio.TimeoutError):
+            self.stats_counters["timeouts"] += 1
+        if is_upstream_fault(error):
+            self.stats_counters["failures"] += 1
+            was_open = self.breaker.state == CircuitBreaker.OPEN
+            self.breaker.failure()
+            if not was_open and self.breaker.state == CircuitBreaker.OPEN:
+                logger.warning(f"Circuit for {self.name} opened after {self.breaker.failures} failures: {error!r}")
+        else:
+            # сервис ответил, пусть и отказом: он жив
+            self.breaker.success()
+
+    def _admit(self) -> bool:
+        """Занимает место в автомате; True — этот запрос пробный (half-open)"""
+        if not self.breaker.allow():
+            raise self._reject("open")
+        self.stats_counters["calls"] += 1
+        return self.breaker.state == CircuitBreaker.HALF_OPEN
+
+    async def call(self, op: str, func: Callable[[], Awaitable[T]], hedge: bool = False) -> T:
+        probe = self._admit()
+        try:
+            if hedge and self.hedge_attempts > 1:
+                result = await self._hedged(op, func)
+            else:
+                result = await self._attempt(op, func)
+        except UpstreamUnavailable:
+            # запрос не ушёл: о сервисе это ничего не говорит; слот пробы освободит
+            # finally, и только если он наш — иначе сбросили бы чужую пробу
+            raise
+        except Exception as e:
+            self._record(e)
+            raise
+        finally:
+            # отменённый пробный запрос ничего не сказал о сервисе, но слот пробы
+            # иначе остался бы занят навсегда и автомат отклонял бы все вызовы
+            if probe:
+                self.breaker.cancel()
+        self._record(None)
+        return result
+
+    async def _attempt(self, op: str, func: Callable[[], Awaitable[T]]) -> T:
+        timeout = self.timeout(op)
+        await self._acquire()
+        limit = timeout.current
+        try:
+            started = time.perf_counter()
+            result = await asyncio.wait_for(func(), limit)
+            timeout.observe(time.perf_counter() - started)
+            return result
+        except asyncio.TimeoutError:
+            # иначе медленные ответы не попадут в выборку и таймаут не вырастет
+            timeout.observe(limit)
+            raise
+        finally:
+            self._release()
+
+    async def _hedged(self, op: str, func: Callable[[], Awaitable[T]]) -> T:
+        delay = self.timeout(op).percentile(self.hedge_quantile)
+        pending: set[asyncio.Task] = set()
+        error: Optional[BaseException] = None
+        try:
+            for attempt in range(self.hedge_attempts):
+                if attempt:
+                    self.stats_counters["hedged"] += 1
+                    REGISTRY.inc("upstream_hedged_total", upstream=self.name)
+                pending.add(asyncio.create_task(self._attempt(op, func)))
+                last = attempt == self.hedge_attempts - 1
+                while pending:
+                    done, pending = await asyncio.wait(pending, timeout=None if last else delay,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                    for task in sorted(done, key=lambda t: t.exception() is not None):
+                        if task.exception() is None:
+                            return task.result()
+                        error = task.exception()
+                        if isinstance(error, UpstreamUnavailable) and pending:
+                            continue  # дубль не дождался слота: ждём попытку, что уже идёт
+                        if not is_upstream_fault(error):
+                            raise error
+                    if not last:
+                        break  # ответа нет дольше обычного или попытка упала: ещё одна
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                # исход проигравшей попытки никому не нужен
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def stream(self, op: str, open_stream: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Потоковый ответ через шлюз: адаптивный таймаут на первый фрагмент, max_timeout на остальные"""
+        probe = self._admit()
+        timeout = self.timeout(op)
+        try:
+            await self._acquire()
+        except UpstreamUnavailable:
+            if probe:
+                self.breaker.cancel()
+            raise
+        chunks = open_stream().__aiter__()
+        error: Optional[BaseException] = None
+        cancelled = False
+        try:
+            started, first = time.perf_counter(), True
+            while True:
+                try:
+                    item = await asyncio.wait_for(chunks.__anext__(),
+                                                  timeout.current if first else self.max_timeout)
+                except StopAsyncIteration:
+                    break
+                if first:
+                    timeout.observe(time.perf_counter() - started)
+                    first = False
+                yield item
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._release()
+            if cancelled:
+                if probe:
+                    self.breaker.cancel()
+            else:
+                self._record(error)
+            aclose = getattr(chunks, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+    def stats(self) -> dict[str, float]:
+        states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        result = {
+            **self.stats_counters,
+            "in_flight": self.in_flight,
+            "circuit_state": states[self.breaker.state],
+            "circuit_trips": self.breaker.trips,
+        }
+        for op, timeout in self.timeouts.items():
+            result[f"timeout_{op}_seconds"] = round(timeout.current, 3)
+        return result
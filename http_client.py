@@ -0,0 +1,74 @@
+# http_client.py
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class HttpTransport:
+    """Общий пул HTTP-соединений для внешних API (FatSecret, YandexGPT).
+
+    Соединения держатся открытыми (keep-alive) и переиспользуются всеми
+    клиентами, число одновременных запросов к одному хосту ограничено
+    семафором, чтобы медленный сервис не забирал весь пул.
+
+    transport подменяет сетевой уровень httpx (например, httpx.MockTransport в тестах).
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20,
+                 per_host_limit: int = 10, host_limits: Optional[dict[str, int]] = None,
+                 connect_timeout: float = 5.0, read_timeout: float = 15.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=30.0,
+            ),
+            timeout=self.timeout(connect_timeout, read_timeout),
+            transport=transport,
+        )
+        self.per_host_limit = per_host_limit
+        self.host_limits = host_limits or {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    @staticmethod
+    def timeout(connect: float, read: float) -> httpx.Timeout:
+        return httpx.Timeout(connect=connect, read=read, write=connect, pool=connect)
+
+    def _semaphore(self, url: str) -> asyncio.Semaphore:
+        host = httpx.URL(url).host
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, self.per_host_limit))
+        return self._semaphores[host]
+
+    async def request(self, method: str, url: str, timeout: Optional[httpx.Timeout] = None,
+                      **kwargs) -> httpx.Response:
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        async with self._semaphore(url):
+            return await self._client.request(method, url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, timeout: Optional[httpx.Timeout] = None,
+                     **kwargs) -> AsyncIterator[httpx.Response]:
+        """Потоковый ответ; слот хоста занят, пока читается тело"""
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        async with self._semaphore(url):
+            async with self._client.stream(method, url, **kwargs) as response:
+                yield response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
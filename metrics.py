@@ -0,0 +1,276 @@
+# metrics.py
+
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# секунды; верхние корзины — для потоковых ответов AI
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как у Prometheus"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Задержки, ошибки и число выполняющихся операций по видам.
+
+    kind — группа операций (handler, db, upstream), name — конкретная
+    операция. track() и instrument() пишут гистограмму задержек,
+    счётчик ошибок и gauge «в работе»; render() отдаёт всё в текстовом
+    формате Prometheus, summary() — таблицу для /stats.
+    """
+
+    def __init__(self, prefix: str = 'fito'):
+        self.prefix = prefix
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.errors: Counter[tuple[str, str]] = Counter()
+        self.in_flight: Counter[tuple[str, str]] = Counter()
+        self.counters: Counter[tuple[str, tuple]] = Counter()
+        self.instrumented: defaultdict[str, set[str]] = defaultdict(set)
+        self._collectors: list[tuple[str, Callable[[], dict[str, Any]]]] = []
+
+    def observe(self, kind: str, name: str, seconds: float) -> None:
+        hist = self.histograms.get((kind, name))
+        if hist is None:
+            hist = self.histograms[(kind, name)] = Histogram()
+        hist.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    @contextmanager
+    def track(self, kind: str, name: str):
+        key = (kind, name)
+        self.in_flight[key] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[key] += 1
+            raise
+        finally:
+            self.in_flight[key] -= 1
+            self.observe(kind, name, time.perf_counter() - started)
+
+    def instrument(self, kind: str, name: Optional[str] = None):
+        """Декоратор для корутин: тот же track() вокруг вызова"""
+        def decorate(func):
+            label = name or func.__name__
+            self.instrumented[kind].add(label)
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.track(kind, label):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def reset(self) -> None:
+        """Обнуление накопленных значений, например между прогонами бенчмарка"""
+        self.histograms.clear()
+        self.errors.clear()
+        self.in_flight.clear()
+        self.counters.clear()
+
+    def add_collector(self, prefix: str, collect: Callable[[], dict[str, Any]]) -> None:
+        """Числовые поля collect() экспортируются как gauge <prefix>_<поле>"""
+        self._collectors.append((prefix, collect))
+
+    # ============ Экспорт ============
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _labels(cls, pairs: Iterable[tuple[str, Any]]) -> str:
+        body = ','.join(f'{k}="{cls._escape(v)}"' for k, v in pairs)
+        return f'{{{body}}}' if body else ''
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (exposition format 0.0.4)"""
+        lines = []
+        by_kind: dict[str, list[tuple[str, Histogram]]] = defaultdict(list)
+        for (kind, name), hist in sorted(self.histograms.items()):
+            by_kind[kind].append((name, hist))
+        for kind, items in by_kind.items():
+            metric = f"{self.prefix}_{kind}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, hist in items:
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append(f"{metric}_bucket{self._labels([('name', name), ('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_bucket{self._labels([('name', name), ('le', '+Inf')])} {hist.count}")
+                lines.append(f"{metric}_sum{self._labels([('name', name)])} {hist.sum}")
+                lines.append(f"{metric}_count{self._labels([('name', name)])} {hist.count}")
+
+        for suffix, values, kind_type in (('errors_total', self.errors, 'counter'),
+                                          ('in_flight', self.in_flight, 'gauge')):
+            for kind in sorted({kind for kind, _ in values}):
+                metric = f"{self.prefix}_{kind}_{suffix}"
+                lines.append(f"# TYPE {metric} {kind_type}")
+                for (k, name), value in sorted(values.items()):
+                    if k == kind:
+                        lines.append(f"{metric}{self._labels([('name', name)])} {value}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value}")
+
+        for prefix, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f"Metrics collector {prefix} failed: {e}")
+                continue
+            for field, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{self.prefix}_{prefix}_{field} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, kinds: Iterable[str] = ('handler', 'db', 'upstream')) -> str:
+        """Короткая таблица для /stats: count, p50/p99 в мс, ошибки, в работе"""
+        lines = []
+        for kind in kinds:
+            rows = [(name, hist) for (k, name), hist in sorted(self.histograms.items()) if k == kind]
+            if not rows:
+                continue
+            lines.append(f"[{kind}]")
+            for name, hist in rows:
+                lines.append(
+                    f"{name}: n={hist.count} p50={hist.percentile(0.5) * 1000:.0f}мс "
+                    f"p99={hist.percentile(0.99) * 1000:.0f}мс "
+                    f"err={self.errors[(kind, name)]} now={self.in_flight[(kind, name)]}"
+                )
+        return '\n'.join(lines) or "Пока нет данных"
+
+
+REGISTRY = Metrics()
+
+
+async def serve_metrics(registry: Metrics, host: str, port: int) -> asyncio.AbstractServer:
+    """Минимальный HTTP-сервер: на любой GET отдаёт registry.render()"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5.0)
+            body = registry.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return server
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер потока event loop.
+
+    Фоновый поток раз в interval секунд снимает стек целевого потока.
+    Стек обрезается до вызова обработчика из handlers, и в дамп пишется
+    в свёрнутом формате flamegraph.pl («handler;frame;frame N»); сэмплы
+    вне обработчиков учитываются как <idle> или <other>.
+    """
+
+    def __init__(self, handlers: Iterable[str], interval: float = 0.005,
+                 thread_id: Optional[int] = None):
+        self.handlers = frozenset(handlers)
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self._fold(frame)] += 1
+                self.samples += 1
+
+    def _fold(self, frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append((code.co_name, f"{os.path.basename(code.co_filename)}:{code.co_name}"))
+            frame = frame.f_back
+        names.reverse()  # от внешнего вызова к внутреннему
+        for i, (func, _) in enumerate(names):
+            if func in self.handlers:
+                return ';'.join([func] + [label for _, label in names[i:]])
+        return '<idle>' if names and names[-1][0] in ('select', 'poll', 'epoll') else '<other>'
+
+    def by_handler(self) -> dict[str, int]:
+        totals: Counter[str] = Counter()
+        for stack, n in self.stacks.items():
+            totals[stack.split(';', 1)[0]] += n
+        return dict(totals.most_common())
+
+    def dump(self, path: str) -> str:
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+        return path
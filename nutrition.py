@@ -0,0 +1,136 @@
+# nutrition.py
+
+import re
+from typing import NamedTuple, Optional, Sequence
+
+import numpy as np
+
+# "Per 100g - Calories: 165kcal | Fat: 3.57g | Carbs: 0.00g | Protein: 31.02g"
+# "Per 1 serving - Calories: 120kcal | ..."
+_PORTION_RE = re.compile(r"Per\s+([\d.,/]+)\s*([^-]*?)\s*-", re.IGNORECASE)
+_VALUE_RE = re.compile(r"(Calories|Fat|Carbs|Protein):\s*([\d.,]+)", re.IGNORECASE)
+WEIGHT_UNITS = {"g": 1.0, "ml": 1.0, "kg": 1000.0, "l": 1000.0, "oz": 28.3495}
+# "Per 1 serving (240g)": масса штучной порции, если FatSecret её указал
+_METRIC_RE = re.compile(r"\(\s*([\d.,]+)\s*(" + "|".join(WEIGHT_UNITS) + r")\s*\)", re.IGNORECASE)
+
+# "200 г гречки", "курица 0,5 кг", "молоко 250мл"; число без единицы («2 яйца», «хлеб 7 злаков») — часть названия
+_INGREDIENT_UNITS = {"г": 1.0, "гр": 1.0, "грамм": 1.0, "грамма": 1.0, "граммов": 1.0,
+                     "кг": 1000.0, "мл": 1.0, "л": 1000.0, **WEIGHT_UNITS}
+_QUANTITY_RE = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*(" + "|".join(sorted(_INGREDIENT_UNITS, key=len, reverse=True)) + r")\.?(?![а-яёa-z])",
+    re.IGNORECASE,
+)
+# запятая разделяет ингредиенты, если это не десятичная запятая между цифрами
+_INGREDIENT_SEP_RE = re.compile(r"[;\n]|(?<!\d),|,(?!\d)")
+
+
+class Macros(NamedTuple):
+    """КБЖУ на порцию amount × unit (например, 100 g или 1 serving)"""
+    kcal: float
+    protein: float
+    fat: float
+    carbs: float
+    amount: float = 100.0
+    unit: str = "g"
+
+    @property
+    def grams(self) -> Optional[float]:
+        """Масса порции в граммах: по весовой единице или по массе, указанной в скобках"""
+        factor = WEIGHT_UNITS.get(self.unit)
+        if factor:
+            return self.amount * factor
+        metric = _METRIC_RE.search(self.unit)
+        if metric:
+            return _number(metric.group(1)) * WEIGHT_UNITS[metric.group(2).lower()]
+        return None
+
+    def per_gram(self) -> Optional[np.ndarray]:
+        """kcal, protein, fat, carbs на 1 г; None для порций без массы (1 serving, 1 cup)"""
+        grams = self.grams
+        if not grams:
+            return None
+        return np.array(self[:4], dtype=np.float64) / grams
+
+    def for_weight(self, grams: float) -> Optional[dict[str, float]]:
+        per_gram = self.per_gram()
+        if per_gram is None:
+            return None
+        kcal, protein, fat, carbs = per_gram * grams
+        return {"calories": float(kcal), "protein": float(protein),
+                "fat": float(fat), "carbs": float(carbs)}
+
+
+def _number(text: str) -> float:
+    text = text.replace(",", ".")
+    if "/" in text:
+        num, den = text.split("/", 1)
+        return float(num) / float(den)
+    return float(text)
+
+
+def parse_food_description(desc: str) -> Optional[Macros]:
+    """Разбор food_description FatSecret в Macros, None если калорий нет"""
+    values = {name.lower(): _number(value) for name, value in _VALUE_RE.findall(desc or "")}
+    if "calories" not in values:
+        return None
+    amount, unit = 100.0, "g"
+    portion = _PORTION_RE.search(desc)
+    if portion:
+        amount = _number(portion.group(1))
+        unit = portion.group(2).strip().lower() or "g"
+    return Macros(values["calories"], values.get("protein", 0.0), values.get("fat", 0.0),
+                  values.get("carbs", 0.0), amount, unit)
+
+
+def attach_macros(food: dict) -> dict:
+    """Разбирает описание один раз и кладёт результат в food['macros']"""
+    if "macros" not in food:
+        macros = parse_food_description(food.get("food_description", ""))
+        food["macros"] = list(macros) if macros else None
+    return food
+
+
+def search_results(result: dict) -> list[dict]:
+    """Продукты из ответа foods.search: при одном совпадении FatSecret отдаёт food объектом, а не списком"""
+    foods = result.get("foods", {}).get("food", [])
+    return [foods] if isinstance(foods, dict) else foods
+
+
+def food_macros(food: dict) -> Optional[Macros]:
+    """Macros из food, разобранного attach_macros (в т.ч. после JSON-кэша)"""
+    attach_macros(food)
+    return Macros(*food["macros"]) if food["macros"] else None
+
+
+def parse_ingredients(text: str) -> list[tuple[str, Optional[float]]]:
+    """«200 г гречки, 150 г курицы, 10 г масла» -> [(название, граммы или None), ...]
+
+    Граммы известны только при явной единице массы или объёма. Если ни у
+    одной части её нет, текст — название одного блюда, а не рецепт:
+    «Куриная грудка, запечённая» возвращается одним элементом целиком.
+    """
+    items = []
+    for part in _INGREDIENT_SEP_RE.split(text):
+        match = _QUANTITY_RE.search(part)
+        grams = None
+        if match:
+            grams = _number(match.group(1)) * _INGREDIENT_UNITS[match.group(2).lower()]
+            part = part[:match.start()] + part[match.end():]
+        name = " ".join(part.split()).strip(" .-—:")
+        if name:
+            items.append((name, grams))
+    if all(grams is None for _, grams in items):
+        name = " ".join(text.split())
+        return [(name, None)] if name else []
+    return items
+
+
+def ingredient_macros(records: Sequence[Macros], grams: Sequence[float]) -> np.ndarray:
+    """КБЖУ каждого ингредиента: строки (kcal, protein, fat, carbs) одной операцией.
+
+    Порция каждой записи должна иметь массу (Macros.grams не None).
+    """
+    per_gram = np.array([r[:4] for r in records], dtype=np.float64).reshape(-1, 4)
+    portion = np.array([r.grams for r in records], dtype=np.float64)
+    return per_gram * (np.asarray(grams, dtype=np.float64) / portion)[:, None]
+
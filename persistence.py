@@ -0,0 +1,235 @@
+# persistence.py
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Optional, Union
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import ensure_schema
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ConversationKey = tuple[Union[int, str], ...]
+ConversationDict = dict[ConversationKey, object]
+
+
+def _encode_key(key: ConversationKey) -> str:
+    # части ключа — целые id чата, пользователя и сообщения
+    return ':'.join(str(int(part)) for part in key)
+
+
+def _loads_many(texts: list[str]) -> list[Any]:
+    # один вызов json.loads на все строки в разы быстрее, чем по строке
+    return json.loads('[' + ','.join(texts) + ']')
+
+
+def _key_user(key: ConversationKey) -> int:
+    # ключ по умолчанию (chat_id, user_id); процессы делят пользователей по user_id
+    return key[1] if len(key) > 1 else key[0]
+
+
+class SQLitePersistence(BasePersistence):
+    """Состояния ConversationHandler и user_data в основной базе бота.
+
+    Application сам собирает изменения и раз в update_interval секунд
+    вызывает update_*; здесь они только складываются в память (последнее
+    значение по ключу побеждает), а через flush_delay секунд после первого
+    изменения всё накопленное пишется одной транзакцией в отдельном
+    потоке. Неизменившиеся user_data не перезаписываются. При падении
+    теряется не больше update_interval + flush_delay секунд изменений.
+    Неудачная запись повторяется с удвоением задержки до max_retry_delay.
+
+    shard=(index, count) загружает при старте только пользователей
+    с user_id % count == index.
+    """
+
+    def __init__(self, db_name: str, update_interval: float = 5.0, flush_delay: float = 0.1,
+                 shard: Optional[tuple[int, int]] = None, max_retry_delay: float = 30.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db_name = db_name
+        self.flush_delay = flush_delay
+        self.max_retry_delay = max_retry_delay
+        self.shard = shard
+        self._failures = 0  # неудачных записей подряд
+        self._conversations: dict[tuple[str, str], tuple[int, Optional[str]]] = {}
+        self._user_data: dict[int, Optional[str]] = {}  # None — удалить
+        self._saved_user_data: dict[int, str] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"flushes": 0, "rows": 0, "skipped_unchanged": 0, "errors": 0,
+                      "flush_seconds_max": 0.0, "restore_seconds": 0.0}
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _init_db(self) -> None:
+        # таблицы conversations и user_data создаются миграцией database.MIGRATIONS
+        ensure_schema(self.db_name)
+
+    def _select(self, sql: str, *params) -> list[tuple]:
+        index, count = self.shard or (0, 1)
+        conn = self._connect()
+        try:
+            return conn.execute(sql, (*params, count, index)).fetchall()
+        finally:
+            conn.close()
+
+    # ============ Загрузка при старте ============
+    async def get_user_data(self) -> dict[int, dict[Any, Any]]:
+        t0 = time.perf_counter()
+        rows = await asyncio.to_thread(self._select, "SELECT user_id, data FROM user_data WHERE user_id % ? = ?")
+        self._saved_user_data = dict(rows)
+        result = dict(zip(self._saved_user_data, _loads_many([data for _, data in rows])))
+        self.stats["restore_seconds"] += time.perf_counter() - t0
+        logger.info(f"Restored user_data of {len(result)} users")
+        return result
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        t0 = time.perf_counter()
+        rows = await asyncio.to_thread(
+            self._select, "SELECT key, state FROM conversations WHERE name = ? AND user_id % ? = ?", name
+        )
+        keys = _loads_many([f"[{key.replace(':', ',')}]" for key, _ in rows])
+        result = dict(zip(map(tuple, keys), _loads_many([state for _, state in rows])))
+        self.stats["restore_seconds"] += time.perf_counter() - t0
+        logger.info(f"Restored {len(result)} {name} conversations")
+        return result
+
+    async def get_chat_data(self) -> dict[int, dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # ============ Изменения ============
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._conversations[(name, _encode_key(key))] = (_key_user(key), state)
+        self._schedule()
+
+    async def update_user_data(self, user_id: int, data: dict[Any, Any]) -> None:
+        payload = json.dumps(data, ensure_ascii=False, default=str) if data else None
+        if payload == self._saved_user_data.get(user_id):
+            self.stats["skipped_unchanged"] += 1
+            return
+        self._user_data[user_id] = payload
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data[user_id] = None
+        self._schedule()
+
+    async def update_chat_data(self, chat_id: int, data: dict[Any, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict[Any, Any]) -> None:
+        pass
+
+    # ============ Запись ============
+    def _schedule(self, delay: Optional[float] = None) -> None:
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.flush_delay if delay is None else delay, self._start_flush
+            )
+
+    def _start_flush(self) -> None:
+        task = asyncio.get_running_loop().create_task(self._flush_pending())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write(self, conversations: dict, user_data: dict) -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO conversations VALUES (?,?,?,?)",
+                    [(name, key, user_id, state)
+                     for (name, key), (user_id, state) in conversations.items() if state is not None]
+                )
+                conn.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [name_key for name_key, (_, state) in conversations.items() if state is None]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO user_data VALUES (?,?)",
+                    [(user_id, data) for user_id, data in user_data.items() if data is not None]
+                )
+                conn.executemany(
+                    "DELETE FROM user_data WHERE user_id = ?",
+                    [(user_id,) for user_id, data in user_data.items() if data is None]
+                )
+        finally:
+            conn.close()
+
+    async def _flush_pending(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        conversations, self._conversations = self._conversations, {}
+        user_data, self._user_data = self._user_data, {}
+        if not conversations and not user_data:
+            return
+
+        async with self._flush_lock:
+            t0 = time.perf_counter()
+            try:
+                with REGISTRY.track("db", "persistence_flush"):
+                    await asyncio.to_thread(self._write, conversations, user_data)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Persistence flush of {len(conversations) + len(user_data)} rows failed: {e}")
+                # вернём в очередь, если новых значений для этих ключей ещё нет
+                self._conversations = {**conversations, **self._conversations}
+                self._user_data = {**user_data, **self._user_data}
+                # без нового таймера изменения ждали бы следующего обновления или остановки
+                self._failures += 1
+                self._schedule(min(self.max_retry_delay, self.flush_delay * 2 ** self._failures))
+                return
+            elapsed = time.perf_counter() - t0
+            self._failures = 0
+
+        for user_id, data in user_data.items():
+            if data is None:
+                self._saved_user_data.pop(user_id, None)
+            else:
+                self._saved_user_data[user_id] = data
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(conversations) + len(user_data)
+        self.stats["flush_seconds_max"] = max(self.stats["flush_seconds_max"], elapsed)
+
+    async def flush(self) -> None:
+        """Вызывается Application при остановке: дописывает всё накопленное"""
+        await self._flush_pending()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info(f"Persistence stats: {self.stats}")
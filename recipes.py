@@ -0,0 +1,159 @@
+# recipes.py
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class RecipeImage(NamedTuple):
+    digest: str  # sha256 исходного файла
+    source: str  # имя исходного файла
+    path: str    # подготовленный JPEG в кэше
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class RecipeCatalog:
+    """Каталог картинок рецептов, подготовленных один раз.
+
+    refresh() проверяет и конвертирует исходники в RGB JPEG не больше
+    max_side пикселей и складывает их в cache_dir под именем sha256
+    содержимого: повторная обработка того же файла не нужна. После
+    первой отправки запоминается file_id Telegram, и дальше картинка
+    отправляется без загрузки байтов.
+    """
+
+    FILE_IDS = 'file_ids.json'
+
+    def __init__(self, source_dir: str, cache_dir: Optional[str] = None,
+                 max_side: int = 1280, quality: int = 85):
+        self.source_dir = os.path.abspath(source_dir)
+        self.cache_dir = os.path.abspath(cache_dir or os.path.join(source_dir, '.cache'))
+        self.max_side = max_side
+        self.quality = quality
+        self._images: list[RecipeImage] = []
+        self._signature: Optional[tuple] = None
+        self._lock = threading.Lock()
+        # отдельная блокировка: refresh() держит _lock на всё время конвертации картинок
+        self._file_ids_lock = threading.Lock()
+        self._file_ids: dict[str, str] = self._load_file_ids()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def _load_file_ids(self) -> dict[str, str]:
+        try:
+            with open(os.path.join(self.cache_dir, self.FILE_IDS), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_file_ids(self, file_ids: dict[str, str]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, self.FILE_IDS)
+        # у каждой записи свой временный файл: пишут и потоки, и другие процессы бота
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.cache_dir,
+                                         prefix=f"{self.FILE_IDS}.", suffix='.tmp', delete=False) as f:
+            tmp = f.name
+            json.dump(file_ids, f)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def _scan(self) -> list[os.DirEntry]:
+        return sorted(
+            (entry for entry in os.scandir(self.source_dir)
+             if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)),
+            key=lambda entry: entry.name
+        )
+
+    def refresh(self) -> bool:
+        """Синхронизация с исходной папкой, True если каталог изменился.
+
+        Блокирующий метод: из event loop вызывать через asyncio.to_thread.
+        """
+        with self._lock:
+            entries = self._scan()
+            signature = tuple((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in entries)
+            if signature == self._signature:
+                return False
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            images = []
+            for entry in entries:
+                image = self._ingest(entry.path, entry.name)
+                if image is not None:
+                    images.append(image)
+            self._images = images
+            self._signature = signature
+            logger.info(f"Recipe catalog: {len(images)} images from {self.source_dir}")
+            return True
+
+    def _ingest(self, src_path: str, name: str) -> Optional[RecipeImage]:
+        try:
+            with open(src_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            path = os.path.join(self.cache_dir, f"{digest}.jpg")
+            if not os.path.exists(path):
+                # кэш общий для процессов бота: у каждого свой временный файл
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with Image.open(src_path) as img:
+                    img.verify()
+                with Image.open(src_path) as img:
+                    img = img.convert('RGB')
+                    img.thumbnail((self.max_side, self.max_side))
+                    img.save(tmp, 'JPEG', quality=self.quality, optimize=True)
+                os.replace(tmp, path)
+            return RecipeImage(digest, name, path)
+        except Exception as e:
+            logger.error(f"Skipping recipe image {name}: {e}")
+            return None
+
+    def pick(self) -> Optional[RecipeImage]:
+        images = self._images
+        return random.choice(images) if images else None
+
+    def file_id(self, image: RecipeImage) -> Optional[str]:
+        return self._file_ids.get(image.digest)
+
+    def remember_file_id(self, image: RecipeImage, file_id: Optional[str]) -> None:
+        """file_id=None забывает сохранённый идентификатор.
+
+        Блокирующий метод: из event loop вызывать через asyncio.to_thread.
+        Ошибки записи только логируются: отправка картинки уже состоялась.
+        """
+        with self._file_ids_lock:
+            if file_id:
+                self._file_ids[image.digest] = file_id
+            else:
+                self._file_ids.pop(image.digest, None)
+            # запись под той же блокировкой: иначе старый снимок мог бы перезаписать новый
+            try:
+                self._save_file_ids(dict(self._file_ids))
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"Failed to save recipe file_ids: {e}")
+
+    async def watch(self, interval: float = 60.0) -> None:
+        """Фоновая задача: подхватывает новые и изменённые картинки"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Recipe catalog refresh failed: {e}")
@@ -0,0 +1,190 @@
+# sessions.py
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from database import ensure_schema
+
+logger = logging.getLogger(__name__)
+
+
+class UserSession:
+    __slots__ = ('user_id', 'data', 'last_seen', 'nbytes')
+
+    def __init__(self, user_id: int = 0, data: Optional[dict] = None, last_seen: float = 0.0):
+        self.user_id = user_id
+        self.data: dict = data if data is not None else {}
+        self.last_seen = last_seen or time.time()
+        self.nbytes = 0
+
+    def clear(self):
+        self.data.clear()
+
+
+class SessionStore:
+    """Сессии пользователей с вытеснением.
+
+    Сессия удаляется, если пользователь молчит дольше idle_ttl секунд,
+    а при превышении max_bytes вытесняются самые давние. Размер сессии
+    оценивается по длине её data в JSON и пересчитывается в maintain()
+    для сессий, к которым обращались с прошлого раза.
+
+    С db_name незавершённые сессии (например, регистрация) сохраняются
+    в SQLite и восстанавливаются при старте.
+    """
+
+    def __init__(self, idle_ttl: float = 3600.0, max_bytes: int = 64 * 1024 * 1024,
+                 db_name: Optional[str] = None):
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.db_name = db_name
+        self._sessions: OrderedDict[int, UserSession] = OrderedDict()
+        self._dirty: set[int] = set()    # к сохранению в SQLite
+        self._touched: set[int] = set()  # к пересчёту размера
+        self._removed: set[int] = set()
+        self.total_bytes = 0
+        self.evicted_idle = 0
+        self.evicted_budget = 0
+        if db_name:
+            self._init_db()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, user_id: int) -> UserSession:
+        sess = self._sessions.get(user_id)
+        if sess is None:
+            sess = self._sessions[user_id] = UserSession(user_id)
+            self._removed.discard(user_id)
+        else:
+            sess.last_seen = time.time()
+            self._sessions.move_to_end(user_id)
+        if self.db_name:
+            self._dirty.add(user_id)
+        self._touched.add(user_id)
+        return sess
+
+    def discard(self, user_id: int) -> None:
+        sess = self._sessions.pop(user_id, None)
+        if sess is not None:
+            self.total_bytes -= sess.nbytes
+            self._dirty.discard(user_id)
+            self._touched.discard(user_id)
+            if self.db_name:
+                self._removed.add(user_id)
+
+    # ============ Вытеснение ============
+    @staticmethod
+    def _measure(sess: UserSession) -> int:
+        try:
+            payload = json.dumps(sess.data, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            payload = repr(sess.data)
+        return len(payload.encode('utf-8')) + 100  # + сам объект со слотами
+
+    def maintain(self) -> None:
+        """Удаляет простаивающие сессии и укладывает остальные в бюджет памяти"""
+        deadline = time.time() - self.idle_ttl
+        # OrderedDict упорядочен по последнему обращению: старые в начале
+        while self._sessions:
+            user_id, sess = next(iter(self._sessions.items()))
+            if sess.last_seen >= deadline:
+                break
+            self.discard(user_id)
+            self.evicted_idle += 1
+
+        for user_id in self._touched:
+            sess = self._sessions[user_id]
+            nbytes = self._measure(sess)
+            self.total_bytes += nbytes - sess.nbytes
+            sess.nbytes = nbytes
+        self._touched.clear()
+
+        while self.total_bytes > self.max_bytes and self._sessions:
+            self.discard(next(iter(self._sessions)))
+            self.evicted_budget += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "live_sessions": len(self._sessions),
+            "bytes": self.total_bytes,
+            "evicted_idle": self.evicted_idle,
+            "evicted_budget": self.evicted_budget,
+        }
+
+    # ============ Персистентность ============
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _init_db(self) -> None:
+        # таблица sessions создаётся миграцией database.MIGRATIONS
+        ensure_schema(self.db_name)
+
+    def load(self, shard: Optional[tuple[int, int]] = None) -> int:
+        """Восстановление незавершённых сессий, вызывается при старте.
+
+        shard=(index, count) загружает только пользователей с user_id % count == index.
+        """
+        if not self.db_name:
+            return 0
+        index, count = shard or (0, 1)
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT user_id, data, last_seen FROM sessions "
+            "WHERE last_seen >= ? AND user_id % ? = ? ORDER BY last_seen",
+            (time.time() - self.idle_ttl, count, index)
+        ).fetchall()
+        conn.close()
+        for user_id, data, last_seen in rows:
+            self._sessions[user_id] = UserSession(user_id, json.loads(data), last_seen)
+            self._touched.add(user_id)
+        self.maintain()
+        logger.info(f"Restored {len(rows)} sessions")
+        return len(rows)
+
+    def _snapshot(self) -> tuple[list[tuple[int, str, float]], list[tuple[int]]]:
+        """Сериализация в потоке event loop, пока data никто не меняет"""
+        upserts, deletes = [], [(user_id,) for user_id in self._removed]
+        for user_id in self._dirty:
+            sess = self._sessions.get(user_id)
+            if sess is None:
+                continue
+            if sess.data:
+                upserts.append((user_id, json.dumps(sess.data, ensure_ascii=False, default=str), sess.last_seen))
+            else:
+                deletes.append((user_id,))
+        self._dirty.clear()
+        self._removed.clear()
+        return upserts, deletes
+
+    def _write(self, upserts: list, deletes: list) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO sessions VALUES (?,?,?)", upserts)
+            conn.executemany("DELETE FROM sessions WHERE user_id=?", deletes)
+            conn.execute("DELETE FROM sessions WHERE last_seen < ?", (time.time() - self.idle_ttl,))
+        conn.close()
+
+    async def flush(self) -> None:
+        if not self.db_name:
+            return
+        upserts, deletes = self._snapshot()
+        if upserts or deletes:
+            await asyncio.to_thread(self._write, upserts, deletes)
+
+    async def run(self, interval: float = 60.0) -> None:
+        """Фоновая задача: вытеснение и сохранение раз в interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.maintain()
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Session maintenance failed: {e}")
@@ -0,0 +1,182 @@
+# sharding.py
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from typing import Any, Callable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+_STOP = None  # обработчику: новых обновлений не будет
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """Номер процесса для обновления: все обновления пользователя идут в один"""
+    user = update.effective_user
+    chat = update.effective_chat
+    key = user.id if user else chat.id if chat else 0
+    return key % workers
+
+
+def _worker_main(index: int, workers: int, inbox, events, token: str,
+                 request_factory: Optional[Callable[[], Any]]) -> None:
+    # Ctrl+C получает вся группа процессов, а остановкой управляет фронт
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(index, workers, inbox, events, token, request_factory))
+
+
+async def _serve(index: int, workers: int, inbox, events, token: str,
+                 request_factory: Optional[Callable[[], Any]]) -> None:
+    from bot import BotController
+
+    controller = BotController(shard=(index, workers))
+    request = request_factory() if request_factory else None
+    app = controller.build_application(token=token, request=request)
+    await app.initialize()
+    await controller.startup(app)
+    await app.start()
+    events.put(("ready", index, None))
+    logger.info(f"Shard {index}/{workers} started")
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            data = await asyncio.to_thread(inbox.get, True, 1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                logger.warning(f"Shard {index}: dispatcher is gone, stopping")
+                break
+            continue
+        if data is _STOP:
+            break
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    # дообрабатываем всё, что уже принято, и только потом закрываемся
+    await app.update_queue.join()
+    processor = app.update_processor
+    stats = {"processed": processor.processed, "failed": processor.failed,
+             **processor.latency_percentiles()}
+    await app.stop()
+    await controller.shutdown(app)
+    await app.shutdown()
+    events.put(("done", index, stats))
+    logger.info(f"Shard {index}: drained, {stats}")
+
+
+class ShardedBot:
+    """Бот в нескольких процессах, пользователи разбиты по user_id.
+
+    Фронт получает обновления и раскладывает их по процессам-обработчикам
+    (user_id % workers). Диалог и сессия пользователя живут в одном
+    процессе, общая у процессов только база SQLite. Очередь каждого
+    обработчика ограничена inbox_size: если он не успевает, фронт ждёт.
+    """
+
+    def __init__(self, token: str, workers: int, inbox_size: int = 1024,
+                 drain_timeout: float = 30.0,
+                 request_factory: Optional[Callable[[], Any]] = None):
+        ctx = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self._events = ctx.Queue()
+        self._inboxes = [ctx.Queue(inbox_size) for _ in range(workers)]
+        self._processes = [
+            ctx.Process(target=_worker_main, name=f"bot-shard-{i}",
+                        args=(i, workers, self._inboxes[i], self._events, token, request_factory))
+            for i in range(workers)
+        ]
+        self.dispatched = [0] * workers
+
+    def start(self) -> None:
+        for process in self._processes:
+            process.start()
+
+    async def _wait_events(self, kind: str, timeout: Optional[float]) -> dict[int, Any]:
+        results: dict[int, Any] = {}
+        while len(results) < self.workers:
+            try:
+                event, index, payload = await asyncio.to_thread(self._events.get, True, timeout)
+            except queue.Empty:
+                break
+            if event == kind:
+                results[index] = payload
+        return results
+
+    async def wait_ready(self, timeout: float = 60.0) -> None:
+        ready = await self._wait_events("ready", timeout)
+        if len(ready) < self.workers:
+            raise RuntimeError(f"Only {len(ready)} of {self.workers} shards started")
+
+    async def dispatch(self, update: Update) -> None:
+        index = shard_for(update, self.workers)
+        data = update.to_dict()
+        inbox = self._inboxes[index]
+        try:
+            inbox.put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(inbox.put, data)
+        self.dispatched[index] += 1
+
+    async def pump(self, updates: asyncio.Queue) -> None:
+        while True:
+            update = await updates.get()
+            try:
+                await self.dispatch(update)
+            except Exception as e:
+                logger.error(f"Failed to dispatch update: {e}")
+            finally:
+                updates.task_done()
+
+    async def drain(self) -> dict[int, dict]:
+        """Останавливает обработчики, дождавшись обработки принятых обновлений"""
+        for inbox in self._inboxes:
+            await asyncio.to_thread(inbox.put, _STOP)
+        stats = await self._wait_events("done", self.drain_timeout)
+        for index, process in enumerate(self._processes):
+            await asyncio.to_thread(process.join, self.drain_timeout)
+            if process.is_alive():
+                logger.error(f"Shard {index} did not stop in {self.drain_timeout}s, terminating")
+                process.terminate()
+        logger.info(f"Dispatched per shard: {self.dispatched}")
+        return stats
+
+
+async def _run_front(sharded: ShardedBot, token: str, webhook: Optional[dict],
+                     max_pending: int) -> None:
+    # фронт только раскладывает обновления, поэтому обычной очереди
+    # с maxsize достаточно: put() Updater'а ждёт, пока pump её разгрузит
+    updates: asyncio.Queue = asyncio.Queue(max_pending)
+    updater = Updater(Bot(token), updates)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    sharded.start()
+    await sharded.wait_ready()
+    async with updater:
+        if webhook:
+            await updater.start_webhook(**webhook)
+        else:
+            await updater.start_polling()
+        pump = asyncio.create_task(sharded.pump(updates))
+        logger.info(f"Dispatcher started with {sharded.workers} shards")
+        await stop.wait()
+
+        logger.info("Stopping: draining shards")
+        await updater.stop()
+        await updates.join()
+        pump.cancel()
+    await sharded.drain()
+
+
+def run_sharded(token: str, workers: int, webhook: Optional[dict] = None,
+                max_pending: int = 256, drain_timeout: float = 30.0) -> None:
+    """Фронт (polling или webhook с параметрами webhook) и workers обработчиков"""
+    sharded = ShardedBot(token, workers, inbox_size=max_pending, drain_timeout=drain_timeout)
+    asyncio.run(_run_front(sharded, token, webhook, max_pending))
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from cache import ResponseCache, SimilarityIndex, TieredCache, normalize_prompt
+
+
+def test_cancelled_loader_does_not_strand_waiters():
+    async def scenario():
+        cache = TieredCache("test")
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.5 if len(calls) == 1 else 0)
+            return {"food_name": "Гречка"}
+
+        leader = asyncio.create_task(cache.get_or_load("гречка", loader))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_load("Гречка", loader))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        value = await asyncio.wait_for(waiter, 1.0)
+        return cache, calls, value
+
+    cache, calls, value = asyncio.run(scenario())
+    assert value == {"food_name": "Гречка"}
+    assert len(calls) == 2  # ожидающий повторил загрузку сам
+    assert cache.coalesced == 1
+    assert cache.stats()["size"] == 1
+
+
+def test_concurrent_loads_share_one_call():
+    async def scenario():
+        cache = TieredCache("test")
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        values = await asyncio.gather(*(cache.get_or_load("рис", loader) for _ in range(5)))
+        return calls, values
+
+    calls, values = asyncio.run(scenario())
+    assert values == ["ответ"] * 5
+    assert len(calls) == 1
+
+
+def test_reworded_question_hits_similar_answer():
+    async def scenario():
+        cache = ResponseCache()
+        await cache.store("Сколько калорий в жареной курице?", "Около 240 ккал на 100 г.")
+        return cache, await cache.lookup("Калорийность жареной курицы")
+
+    cache, text = asyncio.run(scenario())
+    assert text == "Около 240 ккал на 100 г."
+    assert cache.stats()["similar_hits"] == 1
+
+
+def test_similarity_is_partial_overlap_of_stems():
+    index = SimilarityIndex(threshold=0.95)
+    index.add(normalize_prompt("Сколько калорий в жареной курице?"))
+    index.add(normalize_prompt("Сколько калорий в 100 г банана?"))
+
+    assert index.find(normalize_prompt("сколько калорий в вареной курице")) is None
+    assert index.find(normalize_prompt("сколько калорий в 200 г банана"), threshold=0.1) is None
+    # лишнее слово: мимо обычного порога, но в пределах пониженного
+    extra = normalize_prompt("калорийность жареной курицы с кожей")
+    assert index.find(extra) is None
+    assert index.find(extra, threshold=0.6) == ("сколько калорий в жареной курице", pytest.approx(2 / 3))
+
+
+def test_degraded_fallback_does_not_count_a_second_miss():
+    async def scenario():
+        cache = ResponseCache()
+        await cache.store("Сколько калорий в жареной курице?", "Около 240 ккал на 100 г.")
+        question = "калорийность жареной курицы с кожей"
+        return cache, await cache.lookup(question), await cache.lookup_fallback(question, 0.6)
+
+    cache, first, fallback = asyncio.run(scenario())
+    assert first is None
+    assert fallback == "Около 240 ккал на 100 г."
+    stats = cache.stats()
+    assert (stats["misses"], stats["similar_hits"], stats["exact_hits"]) == (1, 0, 0)
+    assert cache.exact.misses == 1
@@ -0,0 +1,202 @@
+import asyncio
+from typing import Optional
+
+import httpx
+import pytest
+
+import bot
+from cache import TieredCache
+from food_index import FoodIndex, describe_per_100g
+from gateway import Upstream, UpstreamUnavailable
+from http_client import HttpTransport
+
+DESCRIPTION = "Per 100g - Calories: 343kcal | Fat: 3.40g | Carbs: 72.00g | Protein: 13.00g"
+
+
+class FakeFatSecretServer:
+    """Обработчик httpx.MockTransport: OAuth и foods.search"""
+
+    def __init__(self, search_delay: float = 0.0, search_status: int = 200, single: bool = False,
+                 descriptions: Optional[dict[str, str]] = None):
+        self.search_delay = search_delay
+        self.descriptions = descriptions or {}
+        self.search_status = search_status
+        self.single = single
+        self.tokens_issued = 0
+        self.revoked: set[str] = set()
+        self.searches: list[str] = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host == "oauth.fatsecret.com":
+            self.tokens_issued += 1
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={"access_token": f"token-{self.tokens_issued}", "expires_in": 86400})
+
+        token = request.headers["Authorization"].removeprefix("Bearer ")
+        self.searches.append(token)
+        if token in self.revoked:
+            return httpx.Response(401, json={"error": "invalid token"})
+        if self.search_delay:
+            await asyncio.sleep(self.search_delay)
+        if self.search_status != 200:
+            return httpx.Response(self.search_status, json={"error": "unavailable"})
+        query = request.url.params["search_expression"]
+        food = {"food_id": "1", "food_name": query.title(),
+                "food_description": self.descriptions.get(query, DESCRIPTION)}
+        return httpx.Response(200, json={"foods": {"food": food if self.single else [food]}})
+
+
+def make_api(server: FakeFatSecretServer) -> bot.FatSecretAPI:
+    http = HttpTransport(transport=httpx.MockTransport(server))
+    return bot.FatSecretAPI("id", "secret", http)
+
+
+def make_controller(api: bot.FatSecretAPI, cache: Optional[TieredCache] = None, **gateway) -> bot.BotController:
+    """BotController только с тем, что нужно для поиска продуктов"""
+    controller = object.__new__(bot.BotController)
+    controller.fatsecret_api = api
+    controller.fatsecret = Upstream("fatsecret", **{"min_timeout": 0.05, "max_timeout": 1.0, **gateway})
+    controller.food_cache = cache or TieredCache("fatsecret", None)
+    controller.food_index = None
+    return controller
+
+
+def test_concurrent_searches_share_one_token():
+    async def scenario():
+        server = FakeFatSecretServer()
+        api = make_api(server)
+        results = await asyncio.gather(*(api.search_food(q) for q in ("гречка", "рис", "творог")))
+        api.close()
+        return server, results
+
+    server, results = asyncio.run(scenario())
+    assert server.tokens_issued == 1
+    assert [r["foods"]["food"][0]["food_name"] for r in results] == ["Гречка", "Рис", "Творог"]
+
+
+def test_revoked_token_is_refreshed_and_retried_once():
+    async def scenario():
+        server = FakeFatSecretServer()
+        api = make_api(server)
+        await api.search_food("гречка")
+        server.revoked.add("token-1")
+        result = await api.search_food("рис")
+        api.close()
+        return server, api, result
+
+    server, api, result = asyncio.run(scenario())
+    assert result["foods"]["food"][0]["food_name"] == "Рис"
+    assert server.searches == ["token-1", "token-1", "token-2"]
+    assert api.token_stats["retries_after_401"] == 1
+    assert api.token_stats["refreshes"] == 2
+
+
+def test_single_food_object_is_found():
+    async def scenario():
+        controller = make_controller(make_api(FakeFatSecretServer(single=True)))
+        food = await controller._find_food("гречка")
+        controller.fatsecret_api.close()
+        return food
+
+    food = asyncio.run(scenario())
+    assert food["food_name"] == "Гречка"
+    assert bot.food_macros(food).kcal == 343
+
+
+def test_slow_search_times_out():
+    async def scenario():
+        controller = make_controller(make_api(FakeFatSecretServer(search_delay=0.5)), max_timeout=0.1)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await controller._find_food("гречка")
+        finally:
+            controller.fatsecret_api.close()
+        return controller.fatsecret.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["timeouts"] == 1
+
+
+def test_failing_upstream_opens_circuit_and_serves_stale_cache(tmp_path):
+    async def scenario():
+        server = FakeFatSecretServer()
+        cache = TieredCache("fatsecret", str(tmp_path / "cache.db"), ttl=0.05, stale_grace=60)
+        controller = make_controller(make_api(server), cache, failure_threshold=2, reset_timeout=60)
+        await controller._find_food("гречка")
+        await asyncio.sleep(0.1)  # запись в кэше истекла
+        server.search_status = 503
+        for query in ("рис", "творог"):
+            with pytest.raises(httpx.HTTPStatusError):
+                await controller._find_food(query)
+        searches = len(server.searches)
+        with pytest.raises(UpstreamUnavailable):
+            await controller._find_food("овсянка")
+        stale = await controller._find_food("гречка")
+        controller.fatsecret_api.close()
+        cache.close()
+        return controller, server, searches, stale
+
+    controller, server, searches, stale = asyncio.run(scenario())
+    assert controller.fatsecret.breaker.state == "open"
+    assert len(server.searches) == searches  # при разомкнутом автомате запрос не уходит
+    assert stale["food_name"] == "Гречка"
+    assert controller.food_cache.stale_hits == 1
+
+
+def test_unavailable_search_falls_back_only_to_close_local_match():
+    async def scenario():
+        server = FakeFatSecretServer()
+        controller = make_controller(make_api(server), failure_threshold=1, reset_timeout=60)
+        controller.food_index = FoodIndex(["Гречка отварная", "Рис бурый"],
+                                          [describe_per_100g(110, 4.2, 1.1, 21.3),
+                                           describe_per_100g(111, 2.6, 0.9, 23.0)])
+        server.search_status = 503
+        with pytest.raises(httpx.HTTPStatusError):
+            await controller._find_food("творог")  # размыкает автомат
+        close = await controller._find_food("каша гречка")  # 0.33: ниже LOCAL_MATCH_SCORE, но похоже
+        with pytest.raises(UpstreamUnavailable):
+            await controller._find_food("рис отварной")  # 0.25 с «Гречка отварная» — не угадываем
+        controller.fatsecret_api.close()
+        return close
+
+    close = asyncio.run(scenario())
+    assert close["food_name"] == "Гречка отварная"
+
+
+class FakeRecipeUpdate:
+    """Update с сообщением пользователя 1: ответы бота копятся в replies"""
+
+    def __init__(self):
+        self.effective_user = self
+        self.id = 1
+        self.message = self
+        self.replies: list[str] = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeMealsDB:
+    def __init__(self):
+        self.meals: list[tuple[int, dict]] = []
+
+    async def save_meals(self, meals):
+        self.meals.extend(meals)
+
+
+def test_recipe_rejects_per_serving_ingredient():
+    async def scenario():
+        server = FakeFatSecretServer(descriptions={
+            "молоко": "Per 1 cup - Calories: 122kcal | Fat: 4.81g | Carbs: 11.71g | Protein: 8.05g",
+        })
+        controller = make_controller(make_api(server))
+        controller.db = FakeMealsDB()
+        update = FakeRecipeUpdate()
+        state = await controller._count_recipe(update, None, [("гречка", 100.0), ("молоко", 200.0)])
+        controller.fatsecret_api.close()
+        return controller, update, state
+
+    controller, update, state = asyncio.run(scenario())
+    assert state == bot.ENTER_DISH_NAME
+    assert controller.db.meals == []  # 200 г не выдаём за 200 порций по 100 г
+    assert "Молоко (на 1 cup)" in update.replies[-1]
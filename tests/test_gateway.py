@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+import pytest
+
+from gateway import CircuitBreaker, Upstream, UpstreamUnavailable
+
+
+class Flaky:
+    """Заглушка сервиса: задержки и ошибки по очереди для каждого вызова"""
+
+    def __init__(self, *delays: float, error: BaseException = None):
+        self.delays = list(delays)
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        number = self.calls
+        delay = self.delays[min(number, len(self.delays)) - 1] if self.delays else 0.0
+        await asyncio.sleep(delay)
+        if self.error is not None:
+            raise self.error
+        return f"ответ {number}"
+
+
+def open_breaker(upstream: Upstream) -> None:
+    """Размыкает автомат так, будто reset_timeout уже прошёл"""
+    upstream.breaker.state = CircuitBreaker.OPEN
+    upstream.breaker.opened_at = time.monotonic() - upstream.breaker.reset_timeout
+
+
+def warm_up(upstream: Upstream, op: str, seconds: float) -> None:
+    """Заполняет выборку задержек, чтобы хедж уходил через seconds"""
+    for _ in range(20):
+        upstream.timeout(op).observe(seconds)
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.available
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # пробный запрос только один
+
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.05)
+    for _ in range(5):
+        breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 2
+    assert not breaker.allow()
+
+
+def test_half_open_lets_through_a_single_probe():
+    async def scenario():
+        upstream = Upstream("test", reset_timeout=60)
+        open_breaker(upstream)
+        probe = asyncio.create_task(upstream.call("op", Flaky(0.05)))
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamUnavailable):
+            await upstream.call("op", Flaky())
+        return upstream, await probe
+
+    upstream, result = asyncio.run(scenario())
+    assert result == "ответ 1"
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+    assert upstream.stats_counters["rejected"] == 1
+
+
+def test_hedge_wins_on_second_attempt():
+    async def scenario():
+        upstream = Upstream("test", min_timeout=1.0, max_timeout=2.0)
+        warm_up(upstream, "op", 0.01)
+        service = Flaky(0.5, 0.0)
+        started = time.perf_counter()
+        result = await upstream.call("op", service, hedge=True)
+        return upstream, service, result, time.perf_counter() - started
+
+    upstream, service, result, elapsed = asyncio.run(scenario())
+    assert result == "ответ 2"
+    assert elapsed < 0.3
+    assert service.calls == 2
+    assert upstream.stats_counters["hedged"] == 1
+    assert upstream.in_flight == 0
+
+
+def test_hedge_rejected_as_busy_waits_for_primary():
+    async def scenario():
+        upstream = Upstream("test", max_concurrent=1, min_timeout=1.0, max_timeout=2.0, queue_timeout=0.01)
+        warm_up(upstream, "op", 0.01)
+        service = Flaky(0.1)
+        result = await upstream.call("op", service, hedge=True)
+        return upstream, service, result
+
+    upstream, service, result = asyncio.run(scenario())
+    assert result == "ответ 1"
+    assert service.calls == 1
+    assert upstream.stats_counters["rejected"] == 1
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_probe_releases_its_slot():
+    async def scenario():
+        upstream = Upstream("test", reset_timeout=60)
+        open_breaker(upstream)
+        probe = asyncio.create_task(upstream.call("op", Flaky(10)))
+        await asyncio.sleep(0.01)
+        assert not upstream.available
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert upstream.available
+        return upstream, await upstream.call("op", Flaky())
+
+    upstream, result = asyncio.run(scenario())
+    assert result == "ответ 1"
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+    assert upstream.in_flight == 0
+
+
+def test_busy_call_keeps_foreign_probe_slot():
+    async def scenario():
+        upstream = Upstream("test", max_concurrent=1, queue_timeout=0.05, reset_timeout=60)
+        await upstream._acquire()  # слот занят
+        waiting = asyncio.create_task(upstream.call("op", Flaky()))
+        await asyncio.sleep(0)
+        open_breaker(upstream)
+        assert upstream.breaker.allow()  # проба другого вызова
+        with pytest.raises(UpstreamUnavailable):
+            await waiting
+        upstream._release()
+        return upstream
+
+    upstream = asyncio.run(scenario())
+    assert upstream.breaker.state == CircuitBreaker.HALF_OPEN
+    assert not upstream.available
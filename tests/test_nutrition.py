@@ -0,0 +1,34 @@
+import pytest
+
+from nutrition import ingredient_macros, parse_food_description, parse_ingredients
+
+PER_100G = "Per 100g - Calories: 343kcal | Fat: 3.40g | Carbs: 72.00g | Protein: 13.00g"
+PER_CUP = "Per 1 cup - Calories: 216kcal | Fat: 1.75g | Carbs: 44.77g | Protein: 5.03g"
+PER_SERVING_WITH_WEIGHT = "Per 1 serving (240g) - Calories: 120kcal | Fat: 2.40g | Carbs: 12.00g | Protein: 9.60g"
+
+
+def test_per_100g_description_scales_by_weight():
+    macros = parse_food_description(PER_100G)
+    assert macros.grams == 100
+    assert macros.for_weight(50)["calories"] == pytest.approx(171.5)
+
+
+def test_serving_without_weight_has_no_per_gram_values():
+    macros = parse_food_description(PER_CUP)
+    assert (macros.amount, macros.unit) == (1, "cup")
+    assert macros.grams is None
+    assert macros.per_gram() is None
+    assert macros.for_weight(100) is None
+
+
+def test_serving_with_metric_weight_uses_it():
+    macros = parse_food_description(PER_SERVING_WITH_WEIGHT)
+    assert macros.grams == 240
+    values = ingredient_macros([parse_food_description(PER_100G), macros], [200, 120])
+    assert values[:, 0].tolist() == pytest.approx([686.0, 60.0])
+
+
+def test_ingredients_need_an_explicit_unit():
+    assert parse_ingredients("200 г гречки, 0,5 кг курицы") == [("гречки", 200.0), ("курицы", 500.0)]
+    assert parse_ingredients("2 яйца, 200 г молока") == [("2 яйца", None), ("молока", 200.0)]
+    assert parse_ingredients("хлеб 7 злаков") == [("хлеб 7 злаков", None)]
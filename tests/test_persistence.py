@@ -0,0 +1,31 @@
+import asyncio
+import sqlite3
+
+from persistence import SQLitePersistence
+
+
+def test_failed_flush_is_retried_without_new_updates(tmp_path):
+    db_name = str(tmp_path / "bot.db")
+
+    async def scenario():
+        persistence = SQLitePersistence(db_name, flush_delay=0.01, max_retry_delay=0.05)
+        write, attempts = persistence._write, []
+
+        def flaky_write(conversations, user_data):
+            attempts.append(len(user_data))
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            write(conversations, user_data)
+
+        persistence._write = flaky_write
+        await persistence.update_user_data(1, {"weight": 80})
+        await asyncio.sleep(0.3)  # больше обновлений нет
+        return persistence, attempts
+
+    persistence, attempts = asyncio.run(scenario())
+    assert attempts == [1, 1, 1]
+    assert persistence.stats["errors"] == 2
+    assert persistence.stats["flushes"] == 1
+    conn = sqlite3.connect(db_name)
+    assert conn.execute("SELECT data FROM user_data WHERE user_id = 1").fetchone() == ('{"weight": 80}',)
+    conn.close()
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from update_processor import PerUserUpdateProcessor
+
+
+def _update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_busy_user_does_not_block_others():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4)
+        started = time.perf_counter()
+        finished = {}
+
+        async def handler(user_id, seconds):
+            await asyncio.sleep(seconds)
+            finished.setdefault(user_id, time.perf_counter() - started)
+
+        busy = [asyncio.create_task(processor.process_update(_update(1), handler(1, 0.2)))
+                for _ in range(8)]
+        await asyncio.sleep(0)
+        await processor.process_update(_update(2), handler(2, 0))
+        await asyncio.gather(*busy)
+        return finished
+
+    finished = asyncio.run(scenario())
+    assert finished[2] < 0.1
+
+
+def test_updates_of_one_user_are_sequential():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4)
+        active, peak = 0, 0
+
+        async def handler():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+        await asyncio.gather(*(processor.process_update(_update(1), handler()) for _ in range(5)))
+        return peak, processor
+
+    peak, processor = asyncio.run(scenario())
+    assert peak == 1
+    assert processor.processed == 5
+    assert not processor._locks
+
+
+def test_global_limit_is_kept():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        active, peak = 0, 0
+
+        async def handler():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+        await asyncio.gather(*(processor.process_update(_update(uid), handler()) for uid in range(6)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_library_process_update_is_not_overridden():
+    # process_update помечен в python-telegram-bot как @final
+    assert "process_update" not in PerUserUpdateProcessor.__dict__
+    processor = PerUserUpdateProcessor(4, max_pending=64)
+    assert processor.max_concurrent_updates == 64
+    assert processor.max_workers == 4
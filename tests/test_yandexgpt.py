@@ -0,0 +1,141 @@
+import asyncio
+import json
+
+import httpx
+from telegram.error import BadRequest
+
+import bot
+from gateway import Upstream
+from http_client import HttpTransport
+
+ANSWER = "В 100 г гречки примерно 343 ккал."
+
+
+def chunk(text: str) -> bytes:
+    return json.dumps({"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}},
+                      ensure_ascii=False).encode() + b"\n"
+
+
+class FakeYandexServer:
+    """Обработчик httpx.MockTransport: completion целиком или NDJSON-потоком"""
+
+    def __init__(self, parts: int = 10, delay: float = 0.01, texts: list[str] = None):
+        self.parts = parts
+        self.delay = delay
+        self.texts = texts
+        self.requests: list[dict] = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body)
+        if not body["completionOptions"]["stream"]:
+            return httpx.Response(200, content=chunk(ANSWER))
+
+        async def lines():
+            # каждая строка — весь текст на текущий момент
+            step = len(ANSWER) // self.parts + 1
+            texts = self.texts
+            if texts is None:
+                texts = [ANSWER[:end] for end in range(step, len(ANSWER) + step, step)]
+            for text in texts:
+                await asyncio.sleep(self.delay)
+                yield chunk(text)
+
+        return httpx.Response(200, content=lines())
+
+
+class FakeMessage:
+    def __init__(self, text: str = "", strict: bool = False):
+        self.text = text
+        self.strict = strict
+        self.edits: list[tuple[str, object]] = []
+
+    async def edit_text(self, text, parse_mode=None):
+        # как Telegram: пробелы в конце обрезаются, правка без изменений — ошибка
+        if self.strict and text.rstrip() == self.text:
+            raise BadRequest("Message is not modified: specified new message content and reply markup "
+                             "are exactly the same as a current content and reply markup of the message")
+        self.text = text.rstrip()
+        self.edits.append((text, parse_mode))
+
+
+class FakeUpdate:
+    def __init__(self, strict: bool = False):
+        self.strict = strict
+        self.reply = None
+        self.message = self
+
+    async def reply_text(self, text, **kwargs):
+        self.reply = FakeMessage(text, self.strict)
+        return self.reply
+
+
+def make_controller(server: FakeYandexServer) -> bot.BotController:
+    controller = object.__new__(bot.BotController)
+    http = HttpTransport(transport=httpx.MockTransport(server))
+    controller.yandex_gpt = bot.YandexGPTAPI("key", "folder", http)
+    controller.yandex = Upstream("yandexgpt", min_timeout=1.0, max_timeout=5.0)
+    return controller
+
+
+def test_complete_returns_answer_text():
+    server = FakeYandexServer()
+    controller = make_controller(server)
+    assert asyncio.run(controller.yandex_gpt.complete("гречка")) == ANSWER
+    assert server.requests[0]["messages"][-1]["text"] == "гречка"
+
+
+def test_stream_yields_growing_text():
+    async def scenario():
+        controller = make_controller(FakeYandexServer(parts=5))
+        return [text async for text in controller.yandex_gpt.stream_response("гречка")]
+
+    texts = asyncio.run(scenario())
+    assert len(texts) == 5
+    assert texts[-1] == ANSWER
+    assert all(ANSWER.startswith(text) for text in texts)
+
+
+def test_stream_edits_are_throttled(monkeypatch):
+    monkeypatch.setattr(bot, "AI_EDIT_INTERVAL", 0.05)
+
+    async def scenario():
+        controller = make_controller(FakeYandexServer(parts=20, delay=0.01))
+        update = FakeUpdate()
+        result = await controller._stream_ai_response(update, "гречка")
+        return controller, update.reply.edits, result
+
+    controller, edits, result = asyncio.run(scenario())
+    assert result == ANSWER
+    # 20 фрагментов за ~0.2 с при интервале 0.05 с: несколько промежуточных правок и итоговая
+    assert 2 <= len(edits) <= 8
+    assert edits[-1] == (ANSWER, "Markdown")
+    assert controller.yandex_gpt.stream_stats["streams"] == 1
+
+
+def test_whitespace_only_chunk_does_not_abort_stream(monkeypatch):
+    monkeypatch.setattr(bot, "AI_EDIT_INTERVAL", 0)
+    texts = ["В 100 г гречки", "В 100 г гречки\n", "В 100 г гречки\n\n", ANSWER]
+
+    async def scenario():
+        controller = make_controller(FakeYandexServer(texts=texts))
+        update = FakeUpdate(strict=True)
+        return await controller._stream_ai_response(update, "гречка"), update.reply
+
+    result, reply = asyncio.run(scenario())
+    assert result == ANSWER
+    assert [text for text, _ in reply.edits] == ["В 100 г гречки", ANSWER]
+    assert reply.text == ANSWER
+
+
+def test_empty_stream_replaces_placeholder(monkeypatch):
+    monkeypatch.setattr(bot, "AI_EDIT_INTERVAL", 0)
+
+    async def scenario():
+        controller = make_controller(FakeYandexServer(texts=[]))
+        update = FakeUpdate(strict=True)
+        return controller, await controller._stream_ai_response(update, "гречка"), update.reply
+
+    controller, result, reply = asyncio.run(scenario())
+    assert result is None  # в кэш нечего класть
+    assert reply.text == controller.yandex_gpt.ERROR_TEXT
@@ -0,0 +1,124 @@
+# update_processor.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class BackpressureQueue(asyncio.Queue):
+    """Очередь обновлений с ограничением на число необработанных.
+
+    Application забирает обновления из очереди сразу и запускает их
+    задачами, поэтому maxsize обычной очереди не сдерживает входящий
+    поток. Здесь put() ждёт, пока обновлений «в работе» (положено,
+    но ещё не task_done) меньше max_pending: polling перестаёт тянуть
+    getUpdates, а webhook отвечает Telegram с задержкой, и тот
+    притормаживает доставку.
+    """
+
+    def __init__(self, max_pending: int = 256):
+        super().__init__()
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(max_pending)
+        self._slotted = 0
+        self._unslotted = 0
+
+    async def put(self, item: Any) -> None:
+        await self._slots.acquire()
+        self._slotted += 1
+        super().put_nowait(item)
+
+    def put_nowait(self, item: Any) -> None:
+        # служебные вставки в обход лимита
+        self._unslotted += 1
+        super().put_nowait(item)
+
+    def task_done(self) -> None:
+        super().task_done()
+        if self._unslotted:
+            self._unslotted -= 1
+        else:
+            self._slotted -= 1
+            self._slots.release()
+
+    @property
+    def pending(self) -> int:
+        return self._slotted + self._unslotted
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Всего одновременно обрабатывается не больше max_concurrent_updates,
+    а обновления одного пользователя выполняются строго по очереди:
+    ConversationHandler хранит состояние на пользователя, и два его
+    сообщения, обработанные параллельно, перепутали бы шаги диалога.
+
+    Семафор базового process_update держится всё время обработки,
+    поэтому он ограничивает только число принятых обновлений (max_pending,
+    вместе с ждущими очереди своего пользователя). Рабочий слот берётся
+    в do_process_update уже после очереди пользователя: иначе сообщения
+    одного активного пользователя заняли бы все слоты.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = 256, latency_window: int = 10_000):
+        super().__init__(max(max_pending, max_concurrent_updates))
+        self.max_workers = max_concurrent_updates
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiting: dict[int, int] = {}
+        self.latencies: deque[float] = deque(maxlen=latency_window)
+        self.processed = 0
+        self.failed = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._workers:
+                await self._timed(coroutine)
+            return
+
+        lock = self._locks.setdefault(user.id, asyncio.Lock())
+        self._waiting[user.id] = self._waiting.get(user.id, 0) + 1
+        try:
+            async with lock:
+                async with self._workers:
+                    await self._timed(coroutine)
+        finally:
+            self._waiting[user.id] -= 1
+            if not self._waiting[user.id]:
+                del self._waiting[user.id]
+                del self._locks[user.id]
+
+    async def _timed(self, coroutine: Awaitable[Any]) -> None:
+        started = time.perf_counter()
+        try:
+            await coroutine
+            self.processed += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def latency_percentiles(self) -> dict[str, float]:
+        values = sorted(self.latencies)
+        if not values:
+            return {"p50_ms": 0.0, "p99_ms": 0.0}
+        return {
+            "p50_ms": values[len(values) // 2] * 1000,
+            "p99_ms": values[min(len(values) - 1, int(len(values) * 0.99))] * 1000,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        logger.info(f"Updates processed: {self.processed}, failed: {self.failed}, "
+                    f"latency: {self.latency_percentiles()}")